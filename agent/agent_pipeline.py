@@ -1,8 +1,19 @@
 import os
+import uuid
 import datetime
 import json
-from langgraph.graph import StateGraph, START, END
-from agent.state.state_types import State, ZeroShotOutput, DiagnosisOutput, ReflectionOutput
+import asyncio
+import contextlib
+import contextvars
+import threading
+import time
+import inspect
+from agent.state.state_types import State
+from agent.llm.prompt import prompt_dict
+from agent.tools.diskCache import content_hash
+from agent.metrics import collect_case, timed_node, record_node_skipped
+from agent.runLogger import RunLogger
+from agent.pipelineEvents import PipelineEvent, EventConverter, stream_modes, EVENT_DONE
 
 from agent.nodes import (
     PCFnode, createDiagnosisNode, createZeroShotNode, createHPODictNode,createAbsentHPODictNode, 
@@ -11,175 +22,163 @@ from agent.nodes import (
     diseaseNormalizeForFinalNode, HPOwebSearchNode
 )
 
+# reflectionループで入力が変わらなければ再実行しないノードと、その入力フィールド
+MEMOIZED_NODE_INPUTS = {
+    "PCFnode": ("hpoList",),
+    "createHPODictNode": ("hpoList",),
+    "createAbsentHPODictNode": ("absentHpoList",),
+}
+
+# ログにテンプレートとして（本文は1回だけ）記録するノードごとのプロンプト
+NODE_PROMPT_TEMPLATES = {
+    "diseaseSearchNode": {"Summarize Prompt for DiseaseSearch": prompt_dict["summarize_prompt"]},
+}
+
 class RareDiseaseDiagnosisPipeline:
-    def __init__(self, enable_log=False, log_filename=None):
-        self.graph = self._build_graph()
+    def __init__(self, enable_log=False, log_filename=None, render_log=False):
+        # グラフ（langgraph）は初回利用時に構築する（arun用の非同期グラフは別に持つ）
+        self._graph = None
+        self._async_graph = None
+        self._graph_lock = threading.Lock()
         self.enable_log = enable_log
         self.logfile_path = None
         self.log_filename = log_filename
+        self.run_logger = None
         if self.enable_log:
+            # ノードの結果はJSONLに書く。render_log=Trueならclose時（またはプロセス終了時）に同名の .log も出力する
             self.logfile_path = self._get_logfile_path()
+            render_path = os.path.splitext(self.logfile_path)[0] + ".log" if render_log else None
+            self.run_logger = RunLogger(self.logfile_path, render_path)
             self._write_graph_ascii_to_log()
             
+    @property
+    def graph(self):
+        if self._graph is None:
+            with self._graph_lock:
+                if self._graph is None:
+                    self._graph = self._build_graph()
+        return self._graph
+
+    @property
+    def async_graph(self):
+        if self._async_graph is None:
+            with self._graph_lock:
+                if self._async_graph is None:
+                    self._async_graph = self._build_graph(use_async=True)
+        return self._async_graph
+
     def _get_logfile_path(self):
         log_dir = os.path.join(os.getcwd(), "log")
         os.makedirs(log_dir, exist_ok=True)
         if self.log_filename:
-            return os.path.join(log_dir, self.log_filename)
+            return os.path.join(log_dir, os.path.splitext(self.log_filename)[0] + ".jsonl")
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        return os.path.join(log_dir, f"agent_log_{timestamp}.log")
-    
+        return os.path.join(log_dir, f"agent_log_{timestamp}.jsonl")
+
     def _write_graph_ascii_to_log(self):
-        # エージェントフロー図をASCIIでlogファイルの先頭に出力
+        # エージェントフロー図をASCIIでログの先頭に記録
         try:
             ascii_graph = self.graph.get_graph().draw_ascii()
         except Exception as e:
             ascii_graph = f"[Failed to draw graph: {e}]"
-        with open(self.logfile_path, "w", encoding="utf-8") as f:
-            f.write("=== Agent Flow Graph ===\n")
-            f.write(ascii_graph)
-            f.write("\n\n")
+        self.run_logger.graph(ascii_graph)
 
     def _log(self, node_name, result):
-        if not self.enable_log or not self.logfile_path:
+        if self.run_logger is None:
             return
-        with open(self.logfile_path, "a", encoding="utf-8") as f:
-            f.write(f"\n=== {node_name} ===\n")
-            # diseaseSearchNodeの直後にSummarize Prompt for DiseaseSearchを表示
-            if node_name == "diseaseSearchNode":
-                f.write("\n----- Summarize Prompt for DiseaseSearch -----\n")
-                f.write("""
-You are an expert clinical geneticist and a diagnostician. Your critical task is to analyze a medical text and convert it into a high-yield, structured summary designed specifically for differential diagnosis. Your output must not only list symptoms but also highlight features that distinguish the condition from its clinical mimics.
-
-Instructions:
-
-From the text I provide, generate a summary strictly following these rules:
-
-1. Information to Extract (Include ONLY these):
-
-Disease: The name of the syndrome or disorder.
-
-Genetics: The causative gene(s) and inheritance pattern. If not specified, state "Not specified".
-
-Key Phenotypes: A concise, bulleted list of the core clinical features and symptoms.
-
-Differentiating Features: This is the most critical section. Extract features that are particularly useful for distinguishing this syndrome from others. This includes:
-
-Hallmark signs: Features that are highly characteristic or pathognomonic.
-
-Key negative findings: Symptoms typically ABSENT in this condition but present in similar ones (e.g., "Absence of hyperphagia").
-
-Unique constellations: A specific combination of symptoms that points strongly to this diagnosis.
-
-2. Information to Exclude (Strictly Omit):
-
-Patient case histories, family origins, or demographic details.
-
-Treatment, management, or therapeutic strategies.
-
-Research methodology, study populations, or author details.
-
-Prognosis, mortality, or prevalence statistics.
-
-General background information that isn't a clinical feature.
-
-3. Output Format (Use this exact structure):
+        self.run_logger.node(node_name, result, NODE_PROMPT_TEMPLATES.get(node_name))
 
-Disease: [Name of the disease]
-Genetics: [Gene(s), Inheritance pattern]
-Key Phenotypes:
-
-[Bulleted list of core clinical features]
-
-[Example: Intellectual disability]
-
-[Example: Craniofacial dysmorphism]
-Differentiating Features:
-
-Hallmark(s): [List highly specific or unique signs.]
+    def _log_run(self, hpo_list, image_path, absent_hpo_list):
+        if self.run_logger is None:
+            return contextlib.nullcontext()
+        return self.run_logger.run(
+            uuid.uuid4().hex[:12], hpo_list=hpo_list, image_path=image_path, absent_hpo_list=absent_hpo_list
+        )
 
-Key Negative Finding(s): [List what is typically absent, e.g., "Absence of..."]
+    def close(self):
+        """
+        ログの書き込みを終える（render_log=Trueなら人が読む形式のログもここで出力する）
+        """
+        if self.run_logger is not None:
+            self.run_logger.close()
+
+    def _node_functions(self, use_async=False):
+        # グラフのノード名 -> ノード関数。use_asyncなら入出力を伴うノードを非同期版に差し替える
+        node_funcs = {
+            "BeginningOfFlowNode": BeginningOfFlowNode,
+            "createZeroShotNode": createZeroShotNode,
+            "PCFnode": PCFnode,
+            "GestaltMatcherNode": GestaltMatcherNode,
+            "createHPODictNode": createHPODictNode,
+            "createAbsentHPODictNode": createAbsentHPODictNode,
+            "HPOwebSearchNode": HPOwebSearchNode,
+            "createDiagnosisNode": createDiagnosisNode,
+            "diseaseNormalizeNode": diseaseNormalizeNode,
+            "diseaseSearchNode": dieaseSearchNode,
+            "reflectionNode": reflectionNode,
+            "finalDiagnosisNode": finalDiagnosisNode,
+            "diseaseNormalizeForFinalNode": diseaseNormalizeForFinalNode,
+        }
+        if use_async:
+            from agent.async_nodes import ASYNC_NODES
+            node_funcs.update(ASYNC_NODES)
+        return node_funcs
 
-Unique Constellation: [Describe a diagnostically powerful combination of symptoms.]
+    def _build_graph(self, use_async=False):
+        from langgraph.graph import StateGraph, START, END
+        graph_builder = StateGraph(State)
 
-Now, process the following text:
-"""
-)
-                f.write("----- End Summarize Prompt for DiseaseSearch -----\n\n")
-            try:
-                # プロンプト付きのdictの場合はプロンプトも出力
-                if isinstance(result, dict) and "prompt" in result:
-                    prompt = result["prompt"]
-                    if node_name == "reflectionNode" and prompt.strip():
-                        prompts = prompt.split("\n---\n") if "\n---\n" in prompt else prompt.split("\n\n")
-                        ans_list = result.get("result", result)
-                        ans_list = getattr(ans_list, "ans", None) or []
-                        for i, p in enumerate(prompts):
-                            disease_name = ""
-                            if i < len(ans_list):
-                                disease_name = getattr(ans_list[i], "disease_name", f"#{i+1}")
-                            f.write(f"\n----- Reflection Prompt for: {disease_name} -----\n")
-                            f.write(p.strip() + "\n")
-                            f.write("----- End Reflection Prompt -----\n")
-                    else:
-                        f.write("\n----- Prompt Start -----\n")
-                        f.write(prompt.strip() + "\n")
-                        f.write("----- Prompt End -----\n")
-                    f.write("Result:\n")
-                    result = result.get("result", result)
-                # ZeroShotOutput, DiagnosisOutput, ReflectionOutputはpydanticモデル
-                if isinstance(result, ZeroShotOutput) or isinstance(result, DiagnosisOutput) or isinstance(result, ReflectionOutput):
-                    f.write(result.model_dump_json(indent=2, ensure_ascii=False))
-                elif hasattr(result, "dict"):
-                    f.write(json.dumps(result.dict(), ensure_ascii=False, indent=2))
-                elif isinstance(result, dict):
-                    def default(o):
-                        if hasattr(o, "model_dump"):
-                            return o.model_dump()
-                        if hasattr(o, "dict"):
-                            return o.dict()
-                        return str(o)
-                    f.write(json.dumps(result, ensure_ascii=False, indent=2, default=default))
-                elif isinstance(result, list):
-                    for item in result:
-                        if hasattr(item, "model_dump_json"):
-                            f.write(item.model_dump_json(indent=2, ensure_ascii=False) + "\n")
-                        elif hasattr(item, "dict"):
-                            f.write(json.dumps(item.dict(), ensure_ascii=False, indent=2) + "\n")
-                        else:
-                            f.write(str(item) + "\n")
-                else:
-                    f.write(str(result))
-            except Exception as e:
-                f.write(f"ログ整形エラー: {e}\n")
-            f.write("\n")
+        def memo_key(node_name, state):
+            inputs = MEMOIZED_NODE_INPUTS.get(node_name)
+            if not inputs:
+                return None
+            return content_hash(*(json.dumps(state.get(field), sort_keys=True, default=str) for field in inputs))
+
+        def before_node(node_name, state, key):
+            # 入力が前回と同じならTrue（実行せずstateに残っている前回の結果をそのまま使う）
+            if key is not None and (state.get("nodeMemo") or {}).get(node_name) == key:
+                print(f"{node_name} skipped (inputs unchanged)")
+                record_node_skipped(node_name)
+                self._log(node_name, "skipped (inputs unchanged)")
+                return True
+            return False
+
+        def after_node(node_name, state, key, result):
+            self._log(node_name, result)
+            # プロンプト付きdictの場合はresult["result"]を返す
+            if isinstance(result, dict) and "result" in result:
+                result = result["result"]
+            # 入力があるのに結果が空（API失敗など）の場合は記録せず、次のループで再実行する
+            inputs = MEMOIZED_NODE_INPUTS.get(node_name)
+            if key is not None and isinstance(result, dict) and (all(result.values()) or not any(state.get(field) for field in inputs)):
+                result = {**result, "nodeMemo": {node_name: key}}
+            return result
 
-    def _build_graph(self):
-        graph_builder = StateGraph(State)
         # ラップして各ノードの結果をログに記録
+        # MEMOIZED_NODE_INPUTSのノードは入力フィールドのハッシュをnodeMemoに記録し、
+        # 同じ入力で再び呼ばれた場合は実行せずstateに残っている前回の結果をそのまま使う
         def wrap_node(node_func, node_name):
+            if inspect.iscoroutinefunction(node_func):
+                async def awrapped(state):
+                    key = memo_key(node_name, state)
+                    if before_node(node_name, state, key):
+                        return {}
+                    with timed_node(node_name):
+                        result = await node_func(state)
+                    return after_node(node_name, state, key, result)
+                return awrapped
+
             def wrapped(state):
-                result = node_func(state)
-                self._log(node_name, result)
-                # プロンプト付きdictの場合はresult["result"]を返す
-                if isinstance(result, dict) and "result" in result:
-                    return result["result"]
-                return result
+                key = memo_key(node_name, state)
+                if before_node(node_name, state, key):
+                    return {}
+                with timed_node(node_name):
+                    result = node_func(state)
+                return after_node(node_name, state, key, result)
             return wrapped
 
-        graph_builder.add_node("BeginningOfFlowNode", wrap_node(BeginningOfFlowNode, "BeginningOfFlowNode"))
-        graph_builder.add_node("createZeroShotNode", wrap_node(createZeroShotNode, "createZeroShotNode"))
-        graph_builder.add_node("PCFnode", wrap_node(PCFnode, "PCFnode"))
-        graph_builder.add_node("GestaltMatcherNode", wrap_node(GestaltMatcherNode, "GestaltMatcherNode"))
-        graph_builder.add_node("createHPODictNode", wrap_node(createHPODictNode, "createHPODictNode"))
-        graph_builder.add_node("createAbsentHPODictNode", wrap_node(createAbsentHPODictNode, "createAbsentHPODictNode"))
-        graph_builder.add_node("HPOwebSearchNode", wrap_node(HPOwebSearchNode, "HPOwebSearchNode"))
-        graph_builder.add_node("createDiagnosisNode", wrap_node(createDiagnosisNode, "createDiagnosisNode"))
-        graph_builder.add_node("diseaseNormalizeNode", wrap_node(diseaseNormalizeNode, "diseaseNormalizeNode"))
-        graph_builder.add_node("diseaseSearchNode", wrap_node(dieaseSearchNode, "diseaseSearchNode"))
-        graph_builder.add_node("reflectionNode", wrap_node(reflectionNode, "reflectionNode"))
-        graph_builder.add_node("finalDiagnosisNode", wrap_node(finalDiagnosisNode, "finalDiagnosisNode"))
-        graph_builder.add_node("diseaseNormalizeForFinalNode", wrap_node(diseaseNormalizeForFinalNode, "diseaseNormalizeForFinalNode"))
+        for node_name, node_func in self._node_functions(use_async).items():
+            graph_builder.add_node(node_name, wrap_node(node_func, node_name))
 
         def after_reflection_edge(state: State):
             if state.get("depth", 0) > 2:
@@ -214,8 +213,8 @@ Now, process the following text:
         graph_builder.add_edge("diseaseNormalizeForFinalNode", END)
         return graph_builder.compile()
 
-    def run(self, hpo_list, image_path=None, verbose=True, absent_hpo_list=None):
-        initial_state = {
+    def _initial_state(self, hpo_list, image_path=None, absent_hpo_list=None):
+        return {
             "depth": 0,
             "clinicalText": None,
             "hpoList": hpo_list,
@@ -223,17 +222,103 @@ Now, process the following text:
             "imagePath": image_path,
             "pubCaseFinder": [],
             "GestaltMatcher": None,
+            "gestaltMatcherFull": None,
+            "nodeMemo": {},
             "hpoDict": {},
             "zeroShotResult": None,
             "memory": [],
+            "retrievalCursors": {},
             "tentativeDiagnosis": None,
             "reflection": None
         }
-        result = self.graph.invoke(initial_state)
+
+    def run(self, hpo_list, image_path=None, verbose=True, absent_hpo_list=None):
+        """
+        結果のstateに加えて、result["metrics"] にこの症例のノード・外部呼び出しごとの時間、
+        トークン数、キャッシュのヒット数を返す（プロセス全体の集計は agent.metrics を参照）
+        """
+        initial_state = self._initial_state(hpo_list, image_path, absent_hpo_list)
+        start = time.perf_counter()
+        with collect_case() as case_metrics, self._log_run(hpo_list, image_path, absent_hpo_list):
+            result = self.graph.invoke(initial_state)
+        result["metrics"] = {"wall_seconds": round(time.perf_counter() - start, 3), **case_metrics.summary()}
+        if verbose:
+            self.pretty_print(result)
+        return result
+
+    async def arun(self, hpo_list, image_path=None, verbose=True, absent_hpo_list=None):
+        """
+        runの非同期版。LLM・外部APIの呼び出しを非同期に行うため、
+        1つのイベントループで複数の症例を asyncio.gather 等で同時に実行できる
+        """
+        initial_state = self._initial_state(hpo_list, image_path, absent_hpo_list)
+        start = time.perf_counter()
+        with collect_case() as case_metrics, self._log_run(hpo_list, image_path, absent_hpo_list):
+            result = await self.async_graph.ainvoke(initial_state)
+        result["metrics"] = {"wall_seconds": round(time.perf_counter() - start, 3), **case_metrics.summary()}
         if verbose:
             self.pretty_print(result)
         return result
 
+    def _done_event(self, converter, start, case_metrics):
+        result = dict(converter.state or {})
+        result["metrics"] = {"wall_seconds": round(time.perf_counter() - start, 3), **case_metrics.summary()}
+        return PipelineEvent(EVENT_DONE, None, converter.depth, result)
+
+    def _stream_events(self, hpo_list, image_path, absent_hpo_list, stream_tokens):
+        converter = EventConverter()
+        start = time.perf_counter()
+        initial_state = self._initial_state(hpo_list, image_path, absent_hpo_list)
+        with collect_case() as case_metrics, self._log_run(hpo_list, image_path, absent_hpo_list):
+            for mode, chunk in self.graph.stream(initial_state, stream_mode=stream_modes(stream_tokens)):
+                yield from converter.convert(mode, chunk)
+        yield self._done_event(converter, start, case_metrics)
+
+    async def _astream_events(self, hpo_list, image_path, absent_hpo_list, stream_tokens):
+        converter = EventConverter()
+        start = time.perf_counter()
+        initial_state = self._initial_state(hpo_list, image_path, absent_hpo_list)
+        with collect_case() as case_metrics, self._log_run(hpo_list, image_path, absent_hpo_list):
+            async for mode, chunk in self.async_graph.astream(initial_state, stream_mode=stream_modes(stream_tokens)):
+                for event in converter.convert(mode, chunk):
+                    yield event
+        yield self._done_event(converter, start, case_metrics)
+
+    def stream(self, hpo_list, image_path=None, absent_hpo_list=None, stream_tokens=False):
+        """
+        runと同じフローを実行し、ノードが終わるたびにイベント（agent.pipelineEvents.PipelineEvent）を返す。
+        PCF・GestaltMatcher・zero-shot・暫定診断は最初のループの途中で、reflectionは候補ごとに届く。
+        stream_tokens=Trueなら最終診断のLLM出力もトークンごとに返す。最後のEVENT_DONEのdataはrun()の戻り値と同じ
+        """
+        events = self._stream_events(hpo_list, image_path, absent_hpo_list, stream_tokens)
+        # 症例のメトリクス・ログのrun id（contextvars）が呼び出し元に漏れないように、この症例専用のcontextで進める
+        ctx = contextvars.copy_context()
+        try:
+            while True:
+                try:
+                    event = ctx.run(next, events)
+                except StopIteration:
+                    return
+                yield event
+        finally:
+            ctx.run(events.close)
+
+    async def astream(self, hpo_list, image_path=None, absent_hpo_list=None, stream_tokens=False):
+        """
+        streamの非同期版（arunと同じ非同期グラフを使う）。streamと同様に、この症例専用のcontextで進める
+        """
+        events = self._astream_events(hpo_list, image_path, absent_hpo_list, stream_tokens)
+        ctx = contextvars.copy_context()
+        try:
+            while True:
+                try:
+                    event = await asyncio.create_task(events.__anext__(), context=ctx)
+                except StopAsyncIteration:
+                    return
+                yield event
+        finally:
+            await asyncio.create_task(events.aclose(), context=ctx)
+
     def pretty_print(self, result):
         print("=== result of reflection ===")
         reflection = result.get("reflection", None)
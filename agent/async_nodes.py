@@ -0,0 +1,138 @@
+import asyncio
+from .state.state_types import State, ReflectionOutput
+from .nodes import REFLECTION_MAX_WORKERS, reuse_gestalt_matcher_result, gestalt_matcher_update
+from .tools.pcf_api import acallingPCF
+from .tools.diagnosis import acreateDiagnosis
+from .tools.ZeroShot import acreateZeroshot
+from .tools.reflection import acreate_reflection
+from .tools.diseaseSearch import adiseaseSearchForDiagnosis
+from .tools.diseaseNormalize import adiseaseNormalizeForDiagnosis
+from .tools.finalDiagnosis import acreateFinalDiagnosis
+from .tools.gestaltMathcher import acall_gestalt_matcher_api
+from .tools.HPOwebReserch import asearch_hpo_terms
+from .tools.evidenceStore import EvidenceStore
+from .pipelineEvents import emit_event, EVENT_REFLECTION
+
+# nodes.py の各ノードの非同期版（ネットワーク・LLM呼び出しを伴うノードのみ）。
+# 入出力は同期版と同じで、RareDiseaseDiagnosisPipeline.arun から使われる
+
+async def HPOwebSearchNode(state: State):
+    print("HPOwebSearchNode called")
+    try:
+        webresources = await asearch_hpo_terms(state)
+        return {"webresources": state.get("webresources", []) + webresources}
+    except Exception as e:
+        print(f"Error in HPOwebSearchNode: {e}")
+        return {"webresources": state.get("webresources", [])}
+
+async def PCFnode(state: State):
+    print("PCFnode called")
+    depth = state.get("depth", 0)
+    hpo_list = state["hpoList"]
+    if not hpo_list:
+        return {"pubCaseFinder": []}
+    return {"pubCaseFinder": await acallingPCF(hpo_list, depth)}
+
+async def GestaltMatcherNode(state: State):
+    print("GestaltMatcherNode called")
+    image_path = state.get("imagePath", None)
+    depth = state.get("depth", 0)
+    if not image_path:
+        print("No image path provided.")
+        return {"GestaltMatcher": []}
+    reused = reuse_gestalt_matcher_result(state)
+    if reused is not None:
+        return reused
+    try:
+        return gestalt_matcher_update(await acall_gestalt_matcher_api(image_path), image_path, depth)
+    except Exception as e:
+        print(f"Error calling GestaltMatcher API: {e}")
+        return {"GestaltMatcher": []}
+
+async def createZeroShotNode(state: State):
+    print("createZeroShotNode called")
+    hpo_dict = state.get("hpoDict", {})
+    absent_hpo_dict = state.get("absentHpoDict", {})
+    if state.get("zeroShotResult") is not None:
+        return {"zeroShotResult": state["zeroShotResult"]}
+    if hpo_dict:
+        result, prompt = await acreateZeroshot(hpo_dict, absent_hpo_dict=absent_hpo_dict)
+        if result:
+            return {"result": {"zeroShotResult": result}, "prompt": prompt}
+    return {"result": {"zeroShotResult": None}}
+
+async def createDiagnosisNode(state: State):
+    print("DiagnosisNode called")
+    hpo_dict = state.get("hpoDict", {})
+    absent_hpo_dict = state.get("absentHpoDict", {})
+    pubCaseFinder = state.get("pubCaseFinder", [])
+    zeroShotResult = state.get("zeroShotResult", None)
+    gestaltMatcherResult = state.get("GestaltMatcher", None)
+    webresources = state.get("webresources", [])
+
+    if hpo_dict and pubCaseFinder:
+        result, prompt = await acreateDiagnosis(hpo_dict, pubCaseFinder, zeroShotResult, gestaltMatcherResult, webresources, absent_hpo_dict=absent_hpo_dict)
+        return {"result": {"tentativeDiagnosis": result}, "prompt": prompt}
+    return {"result": {"tentativeDiagnosis": None}}
+
+async def diseaseNormalizeNode(state: State):
+    print("diseaseNormalizeNode called")
+    tentativeDiagnosis = state.get("tentativeDiagnosis", None)
+    if tentativeDiagnosis is not None:
+        return {"tentativeDiagnosis": await adiseaseNormalizeForDiagnosis(tentativeDiagnosis)}
+    return {"tentativeDiagnosis": None}
+
+async def diseaseSearchNode(state: State):
+    print("diseaseSearchNode called")
+    return await adiseaseSearchForDiagnosis(state)
+
+async def reflectionNode(state: State):
+    print("reflectionNode called")
+    tentativeDiagnosis = state.get("tentativeDiagnosis", None)
+    hpo_dict = state.get("hpoDict", {})
+    absent_hpo_dict = state.get("absentHpoDict", {})
+    # 索引は全候補で共有する
+    disease_knowledge = EvidenceStore.of(state.get("memory", []))
+
+    if tentativeDiagnosis and hpo_dict:
+        # 各候補のreflectionを同時に実行する（同時実行数はREFLECTION_MAX_WORKERS、結果は順位順のまま）
+        slots = asyncio.Semaphore(REFLECTION_MAX_WORKERS)
+
+        async def reflect(index, diagnosis_to_judge):
+            async with slots:
+                result = await acreate_reflection(hpo_dict, diagnosis_to_judge, disease_knowledge, absent_hpo_dict=absent_hpo_dict)
+            # stream() には終わった候補から順に送る
+            emit_event(EVENT_REFLECTION, index=index, disease_name=diagnosis_to_judge.disease_name, reflection=result[0])
+            return result
+
+        results = await asyncio.gather(*(reflect(i, diagnosis) for i, diagnosis in enumerate(tentativeDiagnosis.ans)))
+        reflection_result_list = [reflection_result for reflection_result, _ in results]
+        prompts = [prompt for _, prompt in results]
+        return {"result": {"reflection": ReflectionOutput(ans=reflection_result_list)}, "prompt": "\n---\n".join(prompts)}
+    return {"result": {"reflection": None}}
+
+async def finalDiagnosisNode(state: State):
+    print("finalDiagnosisNode called")
+    finalDiagnosis, prompt = await acreateFinalDiagnosis(state)
+    return {"result": {"finalDiagnosis": finalDiagnosis}, "prompt": prompt}
+
+async def diseaseNormalizeForFinalNode(state: State):
+    print("diseaseNormalizeForFinalNode called")
+    finalDiagnosis = state.get("finalDiagnosis", None)
+    if finalDiagnosis is not None:
+        return {"finalDiagnosis": await adiseaseNormalizeForDiagnosis(finalDiagnosis)}
+    return {"finalDiagnosis": None}
+
+# グラフのノード名 -> 非同期ノード
+ASYNC_NODES = {
+    "HPOwebSearchNode": HPOwebSearchNode,
+    "PCFnode": PCFnode,
+    "GestaltMatcherNode": GestaltMatcherNode,
+    "createZeroShotNode": createZeroShotNode,
+    "createDiagnosisNode": createDiagnosisNode,
+    "diseaseNormalizeNode": diseaseNormalizeNode,
+    "diseaseSearchNode": diseaseSearchNode,
+    "reflectionNode": reflectionNode,
+    "finalDiagnosisNode": finalDiagnosisNode,
+    "diseaseNormalizeForFinalNode": diseaseNormalizeForFinalNode,
+}
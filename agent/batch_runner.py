@@ -0,0 +1,367 @@
+#run the pipeline over a cohort manifest (JSONL/CSV) with a process pool, writing one record per case to JSONL/Parquet.
+import os
+import io
+import csv
+import sys
+import json
+import glob
+import time
+import uuid
+import hashlib
+import argparse
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# ワーカープロセスごとに1つ作るパイプライン（_init_workerで作成）
+_worker_pipeline = None
+_worker_quiet = False
+_worker_in_process = True
+
+
+def split_terms(value):
+    """
+    "HP:1,HP:2" / "HP:1;HP:2" / ["HP:1", "HP:2"] をリストにする
+    """
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [str(v).strip() for v in value if str(v).strip()]
+    return [v.strip() for v in str(value).replace(";", ",").split(",") if v.strip()]
+
+
+def normalize_case(row: dict, line_no: int) -> dict:
+    case_id = row.get("case_id") or row.get("id")
+    if not case_id:
+        raise ValueError(f"manifest line {line_no}: case_id (or id) is required")
+    return {
+        "case_id": str(case_id),
+        "hpo_list": split_terms(row.get("hpo_list")),
+        "absent_hpo_list": split_terms(row.get("absent_hpo_list")),
+        "image_path": row.get("image_path") or None,
+    }
+
+
+def load_manifest(path: str) -> list:
+    """
+    症例マニフェストを読み込む。
+    JSONL: 1行1症例 {"case_id", "hpo_list", "absent_hpo_list", "image_path"}
+    CSV: 同じ列名のヘッダ付き（HPOは "," または ";" 区切り）
+    """
+    cases = []
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if path.endswith(".csv"):
+            for line_no, row in enumerate(csv.DictReader(f), 2):
+                cases.append(normalize_case(row, line_no))
+        else:
+            for line_no, line in enumerate(f, 1):
+                if line.strip():
+                    cases.append(normalize_case(json.loads(line), line_no))
+    seen = set()
+    for case in cases:
+        if case["case_id"] in seen:
+            raise ValueError(f"duplicate case_id in manifest: {case['case_id']}")
+        seen.add(case["case_id"])
+    return cases
+
+
+def shard_of(case_id: str, num_shards: int) -> int:
+    """
+    case_idのSHA-1で決まるシャード番号（マシンや実行順に依存しない）
+    """
+    return int(hashlib.sha1(case_id.encode("utf-8")).hexdigest(), 16) % num_shards
+
+
+def _jsonable(obj):
+    if obj is None:
+        return None
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump()
+    return obj
+
+
+def result_record(case: dict, result: dict, elapsed: float) -> dict:
+    final = result.get("finalDiagnosis")
+    return {
+        "case_id": case["case_id"],
+        "status": "ok",
+        "error": None,
+        "elapsed_seconds": round(elapsed, 3),
+        "depth": result.get("depth"),
+        "final_diagnosis": _jsonable(final).get("ans") if final is not None else None,
+        "final_reference": getattr(final, "reference", None),
+        "tentative_diagnosis": _jsonable(result.get("tentativeDiagnosis")),
+        "reflection": _jsonable(result.get("reflection")),
+        "memory_urls": [item["url"] for item in result.get("memory") or []],
+        "metrics": result.get("metrics"),
+    }
+
+
+def error_record(case: dict, error: Exception, elapsed: float) -> dict:
+    return {
+        "case_id": case["case_id"],
+        "status": "error",
+        "error": f"{error.__class__.__name__}: {error}",
+        "elapsed_seconds": round(elapsed, 3),
+        "depth": None,
+        "final_diagnosis": None,
+        "final_reference": None,
+        "tentative_diagnosis": None,
+        "reflection": None,
+        "memory_urls": None,
+        "metrics": None,
+    }
+
+
+def warm_resources():
+    """
+    プロセス起動時に重いリソース（LLMクライアント、OMIMインデックス、HPOストア）を読み込んでおく。
+    失敗しても症例の実行時に改めてエラーになるので、ここでは表示するだけ
+    """
+    from agent.llm.azure_llm_instance import get_azure_llm
+    from agent.tools import diseaseNormalize
+    from agent.tools.hpoTermStore import get_hpo_term_store
+
+    for getter in (
+        get_azure_llm, get_hpo_term_store, diseaseNormalize.get_client, diseaseNormalize.get_label_store,
+        diseaseNormalize.get_faiss_index, diseaseNormalize.get_lexical_index,
+    ):
+        try:
+            getter()
+        except Exception as e:
+            print(f"[batch_runner] warm-up of {getter.__name__} failed: {e}", file=sys.stderr)
+
+
+def _init_worker(warm: bool, quiet: bool, processes: int = 0):
+    """
+    processes: ワーカープロセスの数（0ならこのプロセスで順に実行する）
+    """
+    global _worker_pipeline, _worker_quiet, _worker_in_process
+    from agent.agent_pipeline import RareDiseaseDiagnosisPipeline
+    from agent.llm.scheduler import set_process_share
+
+    _worker_quiet = quiet
+    _worker_in_process = not processes
+    if processes:
+        # LLMのクォータ（LLM_TPM/LLM_RPM/LLM_MAX_IN_FLIGHT）をワーカーで分け合う
+        set_process_share(processes)
+    _worker_pipeline = RareDiseaseDiagnosisPipeline()
+    _worker_pipeline.graph  # グラフも最初に構築しておく
+    if warm:
+        warm_resources()
+
+
+def run_case(case: dict) -> dict:
+    """
+    1症例を実行して結果レコードを返す（例外はレコードのerrorに記録する）
+    """
+    from agent.llm.scheduler import llm_priority, PRIORITY_BATCH
+
+    start = time.perf_counter()
+    try:
+        # このプロセスで実行する場合は、同じプロセスで対話的な症例を実行していればそちらのLLM呼び出しを優先させる
+        # （ワーカープロセスには対話的な呼び出しがないので優先度は付けない）
+        with llm_priority(PRIORITY_BATCH) if _worker_in_process else contextlib.nullcontext(), \
+                contextlib.redirect_stdout(io.StringIO()) if _worker_quiet else contextlib.nullcontext():
+            result = _worker_pipeline.run(
+                case["hpo_list"], case["image_path"], verbose=False, absent_hpo_list=case["absent_hpo_list"]
+            )
+        return result_record(case, result, time.perf_counter() - start)
+    except Exception as e:
+        return error_record(case, e, time.perf_counter() - start)
+
+
+class JsonlSink:
+    """
+    1症例1行のJSONLに追記する（書くたびにflushするので途中で止まっても完了分は残る）
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._f = open(path, "a", encoding="utf-8")
+        # 前回が書き込み途中で止まっていたら改行してから追記する
+        if self._f.tell() > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self._f.write("\n")
+
+    def completed_ids(self) -> set:
+        ids = set()
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # 書き込み途中で止まった行
+                if record.get("status") == "ok":
+                    ids.add(record["case_id"])
+        return ids
+
+    def write(self, record: dict):
+        self._f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+
+# Parquetの列（result_record/error_recordの項目）。入れ子の項目はJSON文字列
+PARQUET_COLUMNS = {
+    "case_id": "string",
+    "status": "string",
+    "error": "string",
+    "elapsed_seconds": "float64",
+    "depth": "int64",
+    "final_diagnosis": "string",
+    "final_reference": "string",
+    "tentative_diagnosis": "string",
+    "reflection": "string",
+    "memory_urls": "string",
+    "metrics": "string",
+}
+
+
+class ParquetSink:
+    """
+    出力ディレクトリに part-*.parquet として書く（batch_size件ごとに1ファイル、既定は1症例1ファイル）。
+    batch_sizeを大きくするとファイル数は減るが、途中で止まるとバッファ中の完了済み症例（最大batch_size-1件）は
+    書かれず、再実行時にもう一度実行される。
+    すべてのファイルを同じスキーマ（PARQUET_COLUMNS）で書くので、ディレクトリをまとめてデータセットとして読める。pyarrowが必要
+    """
+
+    def __init__(self, directory: str, batch_size: int = 1):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("Parquet output requires pyarrow. Please install it with `pip install pyarrow`.")
+        self.directory = directory
+        self.batch_size = max(batch_size, 1)
+        self.schema = pyarrow.schema([(name, type_name) for name, type_name in PARQUET_COLUMNS.items()])
+        self._buffer = []
+        # 同じプロセスで同じ秒に開いたsink同士でもファイル名が重ならないようにランダムな部分を入れる
+        self._run_id = f"{time.strftime('%Y%m%d_%H%M%S')}-{os.getpid()}-{uuid.uuid4().hex[:12]}"
+        self._part = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def completed_ids(self) -> set:
+        import pyarrow.parquet as pq
+
+        ids = set()
+        for path in glob.glob(os.path.join(self.directory, "part-*.parquet")):
+            table = pq.read_table(path, columns=["case_id", "status"]).to_pydict()
+            ids.update(case_id for case_id, status in zip(table["case_id"], table["status"]) if status == "ok")
+        return ids
+
+    def write(self, record: dict):
+        self._buffer.append({
+            key: json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list)) else value
+            for key, value in record.items()
+        })
+        if len(self._buffer) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        path = os.path.join(self.directory, f"part-{self._run_id}-{self._part:05d}.parquet")
+        # 既存のpartは決して置き換えない
+        while os.path.exists(path):
+            self._part += 1
+            path = os.path.join(self.directory, f"part-{self._run_id}-{self._part:05d}.parquet")
+        # 書き終えてからrenameし、読み手が書きかけのファイルを見ないようにする
+        pq.write_table(pa.Table.from_pylist(self._buffer, schema=self.schema), path + ".tmp")
+        os.replace(path + ".tmp", path)
+        self._part += 1
+        self._buffer = []
+
+    def close(self):
+        self._flush()
+
+
+def open_sink(output: str, output_format: str = None, parquet_batch_size: int = 1):
+    output_format = output_format or ("parquet" if output.endswith(".parquet") or os.path.isdir(output) else "jsonl")
+    if output_format == "parquet":
+        return ParquetSink(output, parquet_batch_size)
+    return JsonlSink(output)
+
+
+def run_cohort(manifest: str, output: str, workers: int = 4, shard_index: int = 0, num_shards: int = 1,
+               output_format: str = None, warm: bool = True, quiet: bool = False, start_method: str = None,
+               parquet_batch_size: int = 1) -> dict:
+    """
+    マニフェストの症例のうち shard_index 番目のシャードに属し、まだ完了していないものを実行する。
+    workers=0 の場合はプロセスを分けずにこのプロセスで順に実行する
+    """
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"shard_index must be in [0, {num_shards})")
+    cases = [case for case in load_manifest(manifest) if shard_of(case["case_id"], num_shards) == shard_index]
+    sink = open_sink(output, output_format, parquet_batch_size)
+    done = sink.completed_ids()
+    pending = [case for case in cases if case["case_id"] not in done]
+    print(f"[batch_runner] shard {shard_index}/{num_shards}: {len(cases)} cases, {len(cases) - len(pending)} already completed, {len(pending)} to run")
+
+    summary = {"total": len(cases), "skipped": len(cases) - len(pending), "ok": 0, "error": 0}
+    start = time.perf_counter()
+
+    def record_done(record):
+        sink.write(record)
+        summary[record["status"]] += 1
+        finished = summary["ok"] + summary["error"]
+        status = "ok" if record["status"] == "ok" else f"error ({record['error']})"
+        print(f"[batch_runner] {finished}/{len(pending)} {record['case_id']}: {status} in {record['elapsed_seconds']:.1f}s")
+
+    try:
+        if workers <= 0:
+            _init_worker(warm, quiet)
+            for case in pending:
+                record_done(run_case(case))
+        elif pending:
+            context = multiprocessing.get_context(start_method) if start_method else None
+            processes = min(workers, len(pending))
+            with ProcessPoolExecutor(max_workers=processes, mp_context=context,
+                                     initializer=_init_worker, initargs=(warm, quiet, processes)) as pool:
+                futures = {pool.submit(run_case, case): case for case in pending}
+                for future in as_completed(futures):
+                    try:
+                        record = future.result()
+                    except Exception as e:
+                        # ワーカープロセス自体が落ちた場合
+                        record = error_record(futures[future], e, 0.0)
+                    record_done(record)
+    finally:
+        sink.close()
+
+    summary["elapsed_seconds"] = round(time.perf_counter() - start, 3)
+    print(f"[batch_runner] done: {summary}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the diagnosis pipeline over a cohort manifest")
+    parser.add_argument('-m', '--manifest', required=True, help='Manifest of cases (.jsonl or .csv)')
+    parser.add_argument('-o', '--output', required=True, help='Output .jsonl file, or a directory for Parquet part files')
+    parser.add_argument('--format', choices=["jsonl", "parquet"], default=None, help='Output format (default: by output extension)')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='Number of worker processes (0 runs in this process)')
+    parser.add_argument('--shard-index', type=int, default=0, help='Shard to run on this machine')
+    parser.add_argument('--num-shards', type=int, default=1, help='Total number of shards')
+    parser.add_argument('--no-warm', action='store_true', help='Do not preload LLM clients and indexes in each worker')
+    parser.add_argument('--quiet', action='store_true', help='Suppress pipeline output from workers')
+    parser.add_argument('--start-method', choices=["spawn", "fork", "forkserver"], default=None, help='multiprocessing start method')
+    parser.add_argument('--parquet-batch-size', type=int, default=1,
+                        help='Records per Parquet part file (a crash loses up to N-1 finished cases, which are rerun on resume)')
+    args = parser.parse_args()
+
+    summary = run_cohort(
+        args.manifest, args.output, workers=args.workers, shard_index=args.shard_index, num_shards=args.num_shards,
+        output_format=args.format, warm=not args.no_warm, quiet=args.quiet, start_method=args.start_method,
+        parquet_batch_size=args.parquet_batch_size,
+    )
+    sys.exit(1 if summary["error"] else 0)
+
+if __name__ == "__main__":
+    main()
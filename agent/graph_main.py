@@ -78,6 +78,7 @@ if __name__ == "__main__":
         "hpoDict": {},
         "zeroShotResult": None,
         "memory": [],
+        "retrievalCursors": {},
         "tentativeDiagnosis": None,
         "reflection": None
     }
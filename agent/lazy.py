@@ -0,0 +1,30 @@
+import threading
+import functools
+
+
+def lazy_singleton(factory):
+    """
+    factoryを初回呼び出し時に1回だけ実行し、以降は同じインスタンスを返す関数に変換する（スレッドセーフ）。
+    重いクライアントやインデックスをimport時ではなく初回利用時に作るために使う
+    """
+    lock = threading.Lock()
+    instance = []
+
+    @functools.wraps(factory)
+    def get():
+        if not instance:
+            with lock:
+                if not instance:
+                    instance.append(factory())
+        return instance[0]
+
+    def is_initialized():
+        return bool(instance)
+
+    def reset():
+        with lock:
+            instance.clear()
+
+    get.is_initialized = is_initialized
+    get.reset = reset
+    return get
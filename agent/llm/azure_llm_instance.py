@@ -1,9 +1,23 @@
 import os
-from .llm_wrapper import AzureOpenAIWrapper
-
-azure_llm = AzureOpenAIWrapper(
-    azure_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
-    api_key=os.environ["AZURE_OPENAI_API_KEY"],
-    deployment_name=os.environ["AZURE_OPENAI_DEPLOYMENT_NAME"],
-    api_version=os.environ["AZURE_OPENAI_API_VERSION"]
-)
\ No newline at end of file
+from ..lazy import lazy_singleton
+
+
+@lazy_singleton
+def get_azure_llm():
+    """
+    AzureOpenAIWrapperを初回利用時に作成して返す（環境変数もこの時点で確認する）
+    """
+    from .llm_wrapper import AzureOpenAIWrapper
+    return AzureOpenAIWrapper(
+        azure_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
+        api_key=os.environ["AZURE_OPENAI_API_KEY"],
+        deployment_name=os.environ["AZURE_OPENAI_DEPLOYMENT_NAME"],
+        api_version=os.environ["AZURE_OPENAI_API_VERSION"]
+    )
+
+
+def __getattr__(name):
+    # 旧来の `from agent.llm.azure_llm_instance import azure_llm` 用（アクセス時に初期化される）
+    if name == "azure_llm":
+        return get_azure_llm()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,20 +1,120 @@
-from langchain_openai import AzureChatOpenAI
+from .scheduler import get_scheduler
+from ..metrics import timed_call, record_tokens
+from .responseCache import (
+    LLM_RESPONSE_CACHE, get_response_cache, response_key, dump_response, load_response
+)
+
+
+class ScheduledLLM:
+    """
+    with_structured_output などで作ったRunnableの invoke/ainvoke を
+    応答キャッシュ・スケジューラ経由で実行するラッパー
+    """
+
+    def __init__(self, runnable, wrapper, output_schema=None):
+        self.runnable = runnable
+        self.wrapper = wrapper
+        self.output_schema = output_schema
+
+    def invoke(self, llm_input, **kwargs):
+        return self.wrapper._call(lambda: self.runnable.invoke(llm_input, **kwargs), llm_input, self.output_schema)
+
+    async def ainvoke(self, llm_input, **kwargs):
+        return await self.wrapper._acall(lambda: self.runnable.ainvoke(llm_input, **kwargs), llm_input, self.output_schema)
+
 
 class AzureOpenAIWrapper:
-    def __init__(self, azure_endpoint, api_key, deployment_name, api_version):
+    def __init__(self, azure_endpoint, api_key, deployment_name, api_version, response_cache: bool = None):
+        # langchain_openai は import が重いため、インスタンス作成時に読み込む
+        from langchain_openai import AzureChatOpenAI
+        self.deployment_name = deployment_name
+        self.temperature = 0.2
+        # Noneなら環境変数 LLM_RESPONSE_CACHE=1 のときだけ有効
+        self.response_cache = LLM_RESPONSE_CACHE if response_cache is None else response_cache
         self.llm = AzureChatOpenAI(
             azure_endpoint=azure_endpoint,
             api_key=api_key,
             deployment_name=deployment_name,
             api_version=api_version,
-            temperature=0.2,
+            temperature=self.temperature,
+            # 429などの再試行は同時実行数・優先度と合わせてスケジューラで行う
+            max_retries=0,
         )
 
+    def _cache_key(self, llm_input, output_schema):
+        return response_key(self.deployment_name, self.temperature, output_schema, llm_input)
+
+    def _unpack(self, response, output_schema):
+        # 構造化出力は include_raw=True で呼び、元のメッセージからトークン使用量を記録する
+        structured = output_schema is not None and isinstance(response, dict)
+        raw = response.get("raw") if structured else response
+        usage = getattr(raw, "usage_metadata", None) or {}
+        record_tokens("azure_chat", usage.get("input_tokens", 0), usage.get("output_tokens", 0))
+        if not structured:
+            return response
+        if response.get("parsing_error") is not None:
+            raise response["parsing_error"]
+        return response["parsed"]
+
+    def _measured(self, call, output_schema):
+        with timed_call("azure_chat"):
+            response = call()
+        return self._unpack(response, output_schema)
+
+    async def _ameasured(self, acall, output_schema):
+        with timed_call("azure_chat"):
+            response = await acall()
+        return self._unpack(response, output_schema)
+
+    def _call(self, call, llm_input, output_schema=None):
+        """
+        応答キャッシュにあればネットワークを使わずに返し、なければスケジューラ経由で call() を実行する
+        """
+        def measured():
+            return self._measured(call, output_schema)
+
+        if not self.response_cache:
+            return get_scheduler().run(measured, llm_input)
+        cache = get_response_cache()
+        key = self._cache_key(llm_input, output_schema)
+        value = cache.get(key)
+        if value is not None:
+            return load_response(value, output_schema)
+        response = get_scheduler().run(measured, llm_input)
+        if response is not None:
+            cache.put(key, dump_response(response, output_schema))
+        return response
+
+    async def _acall(self, acall, llm_input, output_schema=None):
+        """
+        _call の非同期版（acall はコルーチン関数）
+        """
+        def measured():
+            return self._ameasured(acall, output_schema)
+
+        if not self.response_cache:
+            return await get_scheduler().arun(measured, llm_input)
+        cache = get_response_cache()
+        key = self._cache_key(llm_input, output_schema)
+        value = cache.get(key)
+        if value is not None:
+            return load_response(value, output_schema)
+        response = await get_scheduler().arun(measured, llm_input)
+        if response is not None:
+            cache.put(key, dump_response(response, output_schema))
+        return response
+
     def get_structured_llm(self, output_schema):
-        return self.llm.with_structured_output(output_schema)
-    
+        return ScheduledLLM(self.llm.with_structured_output(output_schema, include_raw=True), self, output_schema)
+
     def generate(self, prompt: str) -> str:
         """
         通常のテキスト生成（要約など）用のメソッド
         """
-        return self.llm.invoke(prompt)
\ No newline at end of file
+        return self._call(lambda: self.llm.invoke(prompt), prompt)
+
+    async def agenerate(self, prompt: str):
+        """
+        generate の非同期版（イベントループをブロックしない）
+        """
+        return await self._acall(lambda: self.llm.ainvoke(prompt), prompt)
@@ -0,0 +1,69 @@
+import os
+import json
+from ..lazy import lazy_singleton
+from ..tools.diskCache import DiskCache, CACHE_DIR, content_hash
+
+# LLM応答キャッシュ（オプトイン）。同じプロンプトを再送信せずにディスクから返す
+LLM_RESPONSE_CACHE = os.environ.get("LLM_RESPONSE_CACHE", "0") == "1"
+# 有効期間（時間、0以下なら期限なし）と上限サイズ（MB）
+LLM_RESPONSE_CACHE_TTL_HOURS = float(os.environ.get("LLM_RESPONSE_CACHE_TTL_HOURS", "168"))
+LLM_RESPONSE_CACHE_MAX_MB = float(os.environ.get("LLM_RESPONSE_CACHE_MAX_MB", "256"))
+
+
+@lazy_singleton
+def get_response_cache():
+    return DiskCache(
+        os.environ.get("LLM_RESPONSE_CACHE_DB", os.path.join(CACHE_DIR, "llm_response_cache.sqlite3")),
+        max_bytes=int(LLM_RESPONSE_CACHE_MAX_MB * 2**20),
+        ttl=LLM_RESPONSE_CACHE_TTL_HOURS * 3600 if LLM_RESPONSE_CACHE_TTL_HOURS > 0 else None
+    )
+
+
+def prompt_hash(llm_input) -> str:
+    """
+    プロンプト（文字列 or メッセージのリスト）のハッシュ。メッセージは種類と本文で区別する
+    """
+    if isinstance(llm_input, str):
+        return content_hash("text", llm_input)
+    messages = [[getattr(message, "type", ""), str(getattr(message, "content", message))] for message in llm_input]
+    return content_hash("messages", json.dumps(messages, ensure_ascii=False))
+
+
+def schema_key(output_schema) -> str:
+    """
+    出力スキーマの名前とJSON Schemaのハッシュ（フィールドを変更すると古い応答は使われない）。
+    通常のテキスト生成は "text"
+    """
+    if output_schema is None:
+        return "text"
+    return content_hash(output_schema.__name__, json.dumps(output_schema.model_json_schema(), sort_keys=True))
+
+
+def response_key(deployment: str, temperature, output_schema, llm_input) -> str:
+    return content_hash(deployment, str(temperature), schema_key(output_schema), prompt_hash(llm_input))
+
+
+def dump_response(response, output_schema):
+    """
+    構造化出力は検証済みのJSON（model_dump）、テキスト生成は本文を保存する
+    """
+    if output_schema is not None:
+        return response.model_dump(mode="json")
+    return response.content if hasattr(response, "content") else str(response)
+
+
+def load_response(value, output_schema):
+    """
+    dump_response で保存した値を応答に戻す（構造化出力はスキーマで再検証する）
+    """
+    if output_schema is not None:
+        return output_schema.model_validate(value)
+    from langchain_core.messages import AIMessage
+    return AIMessage(content=value)
+
+
+def get_response_cache_stats() -> dict:
+    """
+    ヒット数 = 省略できたLLM呼び出しの数
+    """
+    return get_response_cache().get_stats()
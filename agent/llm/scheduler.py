@@ -0,0 +1,320 @@
+import os
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import threading
+import contextlib
+import contextvars
+from ..lazy import lazy_singleton
+from ..metrics import record_queue_wait
+
+# 優先度（小さいほど先に実行）。対話的な症例はバッチ処理より先にLLMを使える
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+# プロセス全体でのLLM呼び出しの上限
+LLM_MAX_IN_FLIGHT = int(os.environ.get("LLM_MAX_IN_FLIGHT", "8"))
+# Azureのクォータ（0なら制限しない）
+LLM_TPM = int(os.environ.get("LLM_TPM", "0"))
+LLM_RPM = int(os.environ.get("LLM_RPM", "0"))
+# 1リクエストあたりの出力トークンの見積もり（入力は文字数/4で見積もる）
+LLM_EXPECTED_OUTPUT_TOKENS = int(os.environ.get("LLM_EXPECTED_OUTPUT_TOKENS", "1000"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "5"))
+LLM_BACKOFF_BASE = float(os.environ.get("LLM_BACKOFF_BASE", "1.0"))
+LLM_BACKOFF_MAX = float(os.environ.get("LLM_BACKOFF_MAX", "60"))
+
+_priority = contextvars.ContextVar("llm_priority", default=PRIORITY_INTERACTIVE)
+
+
+@contextlib.contextmanager
+def llm_priority(priority: int):
+    """
+    with llm_priority(PRIORITY_BATCH): の中で行うLLM呼び出しの優先度を設定する
+    （contextvarなので submit_with_context や asyncio のタスクにも引き継がれる）
+    """
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> int:
+    return _priority.get()
+
+
+def estimate_tokens(llm_input) -> int:
+    """
+    プロンプト（文字列 or メッセージのリスト）のトークン数の概算（4文字=1トークン）+ 出力の見積もり
+    """
+    if isinstance(llm_input, str):
+        chars = len(llm_input)
+    else:
+        chars = sum(len(str(getattr(message, "content", message))) for message in llm_input)
+    return chars // 4 + LLM_EXPECTED_OUTPUT_TOKENS
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    429（レート制限）・5xx・接続エラーなど再試行すべきエラーか
+    """
+    if getattr(error, "status_code", None) in (408, 409, 429, 500, 502, 503, 504):
+        return True
+    return type(error).__name__ in ("RateLimitError", "APIConnectionError", "APITimeoutError", "InternalServerError")
+
+
+def retry_after(error: Exception):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    1分あたりrate_per_minuteまで補充されるバケツ（rate_per_minute <= 0 なら無制限）
+    """
+
+    def __init__(self, rate_per_minute: float):
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        if self.capacity <= 0:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) * 60.0 / self.capacity
+
+    def take(self, amount: float):
+        if self.capacity > 0:
+            self.tokens -= min(amount, self.capacity)
+
+
+class _Waiter:
+    def __init__(self, priority, tokens, loop=None):
+        self.priority = priority
+        self.tokens = tokens
+        self.granted = False
+        self.cancelled = False
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def grant(self):
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._set_future)
+
+    def _set_future(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class LLMScheduler:
+    """
+    プロセス全体で共有するLLM呼び出しのスケジューラ。
+    同時実行数・TPM/RPMの範囲で、優先度の高い（値の小さい）要求から順に実行を許可する。
+    同じ優先度なら到着順。スレッドからもasyncioからも使える
+    """
+
+    def __init__(self, max_in_flight=LLM_MAX_IN_FLIGHT, tpm=LLM_TPM, rpm=LLM_RPM):
+        self.max_in_flight = max(1, max_in_flight)
+        self.token_bucket = TokenBucket(tpm)
+        self.request_bucket = TokenBucket(rpm)
+        self._lock = threading.Lock()
+        self._queue = []
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self.stats = {"requests": 0, "retries": 0, "rate_limited": 0, "wait_seconds": 0.0}
+
+    def _dispatch(self) -> float:
+        """
+        許可できる要求に実行を許可し、次に再確認すべきまでの秒数を返す（ロックを取って呼ぶ）
+        """
+        now = time.monotonic()
+        while self._queue:
+            waiter = self._queue[0][2]
+            if waiter.cancelled:
+                heapq.heappop(self._queue)
+                continue
+            if self._in_flight >= self.max_in_flight:
+                return 1.0
+            # 先頭（最優先）の要求が待つ間は後ろの要求も待たせる（大きな要求が飢餓状態にならないように）
+            delay = max(
+                self._paused_until - now,
+                self.token_bucket.wait_time(waiter.tokens, now),
+                self.request_bucket.wait_time(1, now),
+            )
+            if delay > 0:
+                return delay
+            heapq.heappop(self._queue)
+            self.token_bucket.take(waiter.tokens)
+            self.request_bucket.take(1)
+            self._in_flight += 1
+            waiter.grant()
+        return 1.0
+
+    def _enqueue(self, waiter):
+        with self._lock:
+            heapq.heappush(self._queue, (waiter.priority, next(self._seq), waiter))
+            return self._dispatch()
+
+    def _poll(self):
+        with self._lock:
+            return self._dispatch()
+
+    def _cancel(self, waiter):
+        with self._lock:
+            if waiter.granted:
+                self._in_flight -= 1
+            waiter.cancelled = True
+            self._dispatch()
+
+    def acquire(self, tokens: int, priority: int = None):
+        start = time.monotonic()
+        waiter = _Waiter(current_priority() if priority is None else priority, tokens)
+        delay = self._enqueue(waiter)
+        try:
+            while not waiter.event.wait(timeout=delay):
+                delay = self._poll()
+        except BaseException:
+            self._cancel(waiter)
+            raise
+        self._record_wait(start)
+
+    async def aacquire(self, tokens: int, priority: int = None):
+        start = time.monotonic()
+        waiter = _Waiter(current_priority() if priority is None else priority, tokens, asyncio.get_running_loop())
+        delay = self._enqueue(waiter)
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter.future), timeout=delay)
+                    break
+                except asyncio.TimeoutError:
+                    delay = self._poll()
+        except BaseException:
+            self._cancel(waiter)
+            raise
+        self._record_wait(start)
+
+    def _record_wait(self, start):
+        waited = time.monotonic() - start
+        record_queue_wait(waited)
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["wait_seconds"] += waited
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+            self._dispatch()
+
+    def pause(self, seconds: float):
+        """
+        429を受けたときに、全体の新規リクエストをしばらく止める
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self.stats["rate_limited"] += 1
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+        hinted = retry_after(error)
+        if hinted is not None:
+            delay = max(delay, min(hinted, LLM_BACKOFF_MAX))
+        if getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError":
+            self.pause(delay)
+        with self._lock:
+            self.stats["retries"] += 1
+        return delay
+
+    def run(self, call, llm_input):
+        """
+        実行枠を待ってからcall()を実行する。再試行すべきエラーはバックオフして再実行する
+        """
+        tokens = estimate_tokens(llm_input)
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            self.acquire(tokens)
+            try:
+                return call()
+            except Exception as e:
+                if attempt >= LLM_MAX_RETRIES or not is_retryable(e):
+                    raise
+                delay = self.backoff(attempt, e)
+                print(f"[LLMScheduler] {type(e).__name__}, retrying in {delay:.1f}s...")
+            finally:
+                self.release()
+            time.sleep(delay)
+
+    async def arun(self, acall, llm_input):
+        """
+        run の非同期版（acall はコルーチン関数）
+        """
+        tokens = estimate_tokens(llm_input)
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            await self.aacquire(tokens)
+            try:
+                return await acall()
+            except Exception as e:
+                if attempt >= LLM_MAX_RETRIES or not is_retryable(e):
+                    raise
+                delay = self.backoff(attempt, e)
+                print(f"[LLMScheduler] {type(e).__name__}, retrying in {delay:.1f}s...")
+            finally:
+                self.release()
+            await asyncio.sleep(delay)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["in_flight"] = self._in_flight
+            stats["queued"] = sum(1 for _, _, waiter in self._queue if not waiter.cancelled)
+        return stats
+
+
+# 同じクォータを分け合うプロセスの数（set_process_share で設定する）
+_process_share = [1]
+
+
+def _divide(limit: int, processes: int) -> int:
+    # 0（制限しない）は0のまま、それ以外は1以上にする
+    return max(1, limit // processes) if limit else 0
+
+
+def set_process_share(processes: int):
+    """
+    LLM_TPM/LLM_RPM/LLM_MAX_IN_FLIGHT は1プロセスあたりの上限なので、
+    同じクォータを複数のプロセスで使う場合（batch_runnerのワーカー）は各プロセスでこの数を設定して上限を分け合う。
+    作成済みのスケジューラは作り直す
+    """
+    _process_share[0] = max(1, processes)
+    get_scheduler.reset()
+
+
+@lazy_singleton
+def get_scheduler() -> LLMScheduler:
+    """
+    プロセス全体で共有するスケジューラ（AzureOpenAIWrapperのすべての呼び出しがこれを通る）
+    """
+    processes = _process_share[0]
+    return LLMScheduler(
+        max_in_flight=_divide(LLM_MAX_IN_FLIGHT, processes),
+        tpm=_divide(LLM_TPM, processes),
+        rpm=_divide(LLM_RPM, processes),
+    )
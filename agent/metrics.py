@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import threading
+import contextlib
+import contextvars
+
+# LLMのコスト（USD / 1000トークン）。デプロイの価格を設定すると llm_cost_usd に集計される（0なら集計しない）
+TOKEN_COST_PER_1K = {
+    "azure_chat": (
+        float(os.environ.get("LLM_PROMPT_COST_PER_1K", "0")),
+        float(os.environ.get("LLM_COMPLETION_COST_PER_1K", "0")),
+    ),
+    "embeddings": (float(os.environ.get("EMBEDDING_COST_PER_1K", "0")), 0.0),
+}
+
+# メトリクス名 -> (種類, 説明, ラベル名)。summaryは _count と _sum の2系列を持つ
+METRICS = {
+    "zebraseek_node_seconds": ("summary", "Wall time of pipeline graph nodes", ("node",)),
+    "zebraseek_node_errors_total": ("counter", "Pipeline graph nodes that raised", ("node",)),
+    "zebraseek_node_skipped_total": ("counter", "Node runs skipped because their inputs were unchanged", ("node",)),
+    "zebraseek_call_seconds": ("summary", "Wall time of outbound calls (LLM, embeddings and external APIs)", ("service",)),
+    "zebraseek_call_errors_total": ("counter", "Outbound calls that raised", ("service",)),
+    "zebraseek_llm_tokens_total": ("counter", "Tokens used by LLM and embedding calls", ("service", "kind")),
+    "zebraseek_llm_cost_usd_total": ("counter", "Estimated cost of LLM and embedding calls", ("service",)),
+    "zebraseek_llm_queue_seconds": ("summary", "Time LLM calls waited in the rate-limit scheduler", ()),
+    "zebraseek_cache_requests_total": ("counter", "Disk cache lookups", ("cache", "result")),
+    "zebraseek_context_dropped_total": ("counter", "Evidence items dropped to fit prompt token budgets", ("prompt",)),
+}
+
+
+class MetricsRegistry:
+    """
+    プロセス内のメトリクス（カウンタと合計時間）。スレッドセーフ。
+    プロセス全体用の REGISTRY と、症例ごとの集計（collect_case）に同じクラスを使う
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1.0):
+        with self._lock:
+            self._values[(name, labels)] = self._values.get((name, labels), 0.0) + value
+
+    def observe(self, name: str, labels: tuple, seconds: float):
+        with self._lock:
+            self._values[(name + "_count", labels)] = self._values.get((name + "_count", labels), 0.0) + 1
+            self._values[(name + "_sum", labels)] = self._values.get((name + "_sum", labels), 0.0) + seconds
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def get(self, name: str, *labels) -> float:
+        with self._lock:
+            return self._values.get((name, labels), 0.0)
+
+    def to_prometheus(self) -> str:
+        """
+        Prometheusのテキスト形式（/metrics のレスポンスにそのまま使える）
+        """
+        values = self.snapshot()
+        lines = []
+        for name, (kind, help_text, label_names) in METRICS.items():
+            series = [name + "_count", name + "_sum"] if kind == "summary" else [name]
+            samples = sorted((key, value) for key, value in values.items() if key[0] in series)
+            if not samples:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (series_name, labels), value in samples:
+                label_text = ",".join(f'{label}="{_escape(v)}"' for label, v in zip(label_names, labels))
+                lines.append(f"{series_name}{{{label_text}}} {value:g}" if label_text else f"{series_name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> str:
+        return json.dumps(self.summary(), ensure_ascii=False, indent=2)
+
+    def summary(self) -> dict:
+        """
+        ノード・外部呼び出しごとの回数/秒数/エラー数、トークン数、コスト、キャッシュのヒット数、
+        トークン予算のためにプロンプトから落とした根拠の数
+        """
+        values = self.snapshot()
+
+        def get(name, *labels):
+            return values.get((name, labels), 0.0)
+
+        def labels_of(name):
+            return sorted({labels for series, labels in values if series == name})
+
+        summary = {"nodes": {}, "calls": {}, "tokens": {}, "cost_usd": 0.0, "cache": {}, "llm_queue_seconds": 0.0}
+        for (node,) in labels_of("zebraseek_node_seconds_count"):
+            summary["nodes"][node] = {
+                "count": int(get("zebraseek_node_seconds_count", node)),
+                "seconds": round(get("zebraseek_node_seconds_sum", node), 3),
+                "errors": int(get("zebraseek_node_errors_total", node)),
+            }
+        for (node,) in labels_of("zebraseek_node_skipped_total"):
+            summary["nodes"].setdefault(node, {"count": 0, "seconds": 0.0, "errors": 0})
+            summary["nodes"][node]["skipped"] = int(get("zebraseek_node_skipped_total", node))
+        for (service,) in labels_of("zebraseek_call_seconds_count"):
+            summary["calls"][service] = {
+                "count": int(get("zebraseek_call_seconds_count", service)),
+                "seconds": round(get("zebraseek_call_seconds_sum", service), 3),
+                "errors": int(get("zebraseek_call_errors_total", service)),
+            }
+        for service, kind in labels_of("zebraseek_llm_tokens_total"):
+            summary["tokens"].setdefault(service, {})[kind] = int(get("zebraseek_llm_tokens_total", service, kind))
+        summary["cost_usd"] = round(sum(get("zebraseek_llm_cost_usd_total", *labels) for labels in labels_of("zebraseek_llm_cost_usd_total")), 6)
+        for cache, result in labels_of("zebraseek_cache_requests_total"):
+            summary["cache"].setdefault(cache, {"hit": 0, "miss": 0})[result] = int(get("zebraseek_cache_requests_total", cache, result))
+        summary["llm_queue_seconds"] = round(get("zebraseek_llm_queue_seconds_sum"), 3)
+        summary["context_dropped"] = {
+            prompt: int(get("zebraseek_context_dropped_total", prompt)) for (prompt,) in labels_of("zebraseek_context_dropped_total")
+        }
+        return summary
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# プロセス全体のメトリクス
+REGISTRY = MetricsRegistry()
+# 実行中の症例のメトリクス（collect_case の中でのみ設定される。スレッド・タスクにも引き継がれる）
+_case_registry = contextvars.ContextVar("case_metrics", default=None)
+
+
+def _registries():
+    case_registry = _case_registry.get()
+    return (REGISTRY, case_registry) if case_registry is not None else (REGISTRY,)
+
+
+def inc(name: str, labels: tuple = (), value: float = 1.0):
+    for registry in _registries():
+        registry.inc(name, labels, value)
+
+
+def observe(name: str, labels: tuple, seconds: float):
+    for registry in _registries():
+        registry.observe(name, labels, seconds)
+
+
+@contextlib.contextmanager
+def _timed(seconds_metric: str, errors_metric: str, label: str):
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        inc(errors_metric, (label,))
+        raise
+    finally:
+        observe(seconds_metric, (label,), time.perf_counter() - start)
+
+
+def timed_call(service: str):
+    """
+    with timed_call("pubmed"): の中の外部呼び出しの時間とエラーを記録する
+    """
+    return _timed("zebraseek_call_seconds", "zebraseek_call_errors_total", service)
+
+
+def timed_node(node: str):
+    return _timed("zebraseek_node_seconds", "zebraseek_node_errors_total", node)
+
+
+def record_node_skipped(node: str):
+    inc("zebraseek_node_skipped_total", (node,))
+
+
+def record_tokens(service: str, prompt_tokens: int = 0, completion_tokens: int = 0):
+    inc("zebraseek_llm_tokens_total", (service, "prompt"), prompt_tokens)
+    inc("zebraseek_llm_tokens_total", (service, "completion"), completion_tokens)
+    prompt_cost, completion_cost = TOKEN_COST_PER_1K.get(service, (0.0, 0.0))
+    cost = (prompt_tokens * prompt_cost + completion_tokens * completion_cost) / 1000
+    if cost:
+        inc("zebraseek_llm_cost_usd_total", (service,), cost)
+
+
+def record_cache(cache: str, hit: bool):
+    inc("zebraseek_cache_requests_total", (cache, "hit" if hit else "miss"))
+
+
+def record_queue_wait(seconds: float):
+    observe("zebraseek_llm_queue_seconds", (), seconds)
+
+
+@contextlib.contextmanager
+def collect_case():
+    """
+    with collect_case() as case_metrics: の中で記録されたメトリクスを症例単位でも集計する
+    """
+    registry = MetricsRegistry()
+    token = _case_registry.set(registry)
+    try:
+        yield registry
+    finally:
+        _case_registry.reset(token)
+
+
+def export_prometheus() -> str:
+    return REGISTRY.to_prometheus()
+
+
+def export_json() -> str:
+    return REGISTRY.to_json()
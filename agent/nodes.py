@@ -1,4 +1,6 @@
+import os
 from typing_extensions import List, Optional
+from .parallel import ordered_map
 from .state.state_types import State, PCFres, DiagnosisOutput, ReflectionOutput
 from .tools.pcf_api import callingPCF
 from .tools.diagnosis import createDiagnosis
@@ -8,11 +10,16 @@ from .tools.reflection import create_reflection
 from .tools.diseaseSearch import diseaseSearchForDiagnosis
 from .tools.diseaseNormalize import diseaseNormalizeForDiagnosis
 from .tools.finalDiagnosis import createFinalDiagnosis
-from .tools.gestaltMathcher import call_gestalt_matcher_api
+from .tools.gestaltMathcher import call_gestalt_matcher_api, top_syndromes
 from .tools.HPOwebReserch import search_hpo_terms
+from .tools.evidenceStore import EvidenceStore
+from .pipelineEvents import emit_event, EVENT_REFLECTION
 
 from agent.llm.prompt import prompt_dict
 
+# reflectionNodeで同時に評価する診断候補の最大数
+REFLECTION_MAX_WORKERS = int(os.environ.get("REFLECTION_MAX_WORKERS", "5"))
+
 def HPOwebSearchNode(state: State):
     print("HPOwebSearchNode called")
     try:
@@ -48,22 +55,41 @@ def GestaltMatcherNode(state: State):
     if not image_path:
         print("No image path provided.")
         return {"GestaltMatcher": []}
+    # 画像は最初のループで1回だけ送信し、全候補をstateに保持して深度に応じて切り出す
+    reused = reuse_gestalt_matcher_result(state)
+    if reused is not None:
+        return reused
     try:
-        gestalt_results = call_gestalt_matcher_api(image_path, depth)
-        syndrome_list = []
-        for res in gestalt_results:
-            syndrome_list.append({
-                "subject_id": res.get("subject_id", ""),
-                "syndrome_name": res.get("syndrome_name", ""),
-                "omim_id": res.get("omim_id", ""),
-                "image_id": res.get("image_id", ""),
-                "score": res.get("score")
-            })
-        return {"GestaltMatcher": syndrome_list}
+        return gestalt_matcher_update(call_gestalt_matcher_api(image_path), image_path, depth)
     except Exception as e:
         print(f"Error calling GestaltMatcher API: {e}")
         return {"GestaltMatcher": []}
 
+def reuse_gestalt_matcher_result(state: State):
+    """
+    同じ画像の全候補がstateにあれば、深度に応じて切り出した更新を返す（なければNone）
+    """
+    full = state.get("gestaltMatcherFull")
+    if full and full.get("imagePath") == state.get("imagePath"):
+        print("Reusing GestaltMatcher result for the same image.")
+        return {"GestaltMatcher": top_syndromes(full["syndromes"], state.get("depth", 0))}
+    return None
+
+def gestalt_matcher_update(gestalt_results, image_path, depth):
+    syndrome_list = []
+    for res in gestalt_results:
+        syndrome_list.append({
+            "subject_id": res.get("subject_id", ""),
+            "syndrome_name": res.get("syndrome_name", ""),
+            "omim_id": res.get("omim_id", ""),
+            "image_id": res.get("image_id", ""),
+            "score": res.get("score")
+        })
+    return {
+        "GestaltMatcher": top_syndromes(syndrome_list, depth),
+        "gestaltMatcherFull": {"imagePath": image_path, "syndromes": syndrome_list}
+    }
+
 def createHPODictNode(state: State):
     print("createHPODictNode called")
     hpo_list = state.get("hpoList", [])
@@ -128,16 +154,23 @@ def reflectionNode(state: State):
     tentativeDiagnosis = state.get("tentativeDiagnosis", None)
     hpo_dict = state.get("hpoDict", {})
     absent_hpo_dict = state.get("absentHpoDict", {})
-    disease_knowledge = state.get("memory", [])
+    # 索引は全候補で共有する
+    disease_knowledge = EvidenceStore.of(state.get("memory", []))
 
     if tentativeDiagnosis and hpo_dict:
         diagnosis_to_judge_lis = tentativeDiagnosis.ans
-        reflection_result_list = []
-        prompts = []
-        for diagnosis_to_judge in diagnosis_to_judge_lis:
-            reflection_result, prompt = create_reflection(hpo_dict, diagnosis_to_judge, disease_knowledge, absent_hpo_dict=absent_hpo_dict)
-            reflection_result_list.append(reflection_result)
-            prompts.append(prompt)
+
+        def reflect(indexed):
+            index, diagnosis_to_judge = indexed
+            result = create_reflection(hpo_dict, diagnosis_to_judge, disease_knowledge, absent_hpo_dict=absent_hpo_dict)
+            # stream() には終わった候補から順に送る
+            emit_event(EVENT_REFLECTION, index=index, disease_name=diagnosis_to_judge.disease_name, reflection=result[0])
+            return result
+
+        # 各候補のreflectionは独立したLLM呼び出しなので並列に実行する（結果は順位順のまま）
+        results = ordered_map(reflect, enumerate(diagnosis_to_judge_lis), REFLECTION_MAX_WORKERS)
+        reflection_result_list = [reflection_result for reflection_result, _ in results]
+        prompts = [prompt for _, prompt in results]
         print(type(reflection_result_list[0]))
         return {"result": {"reflection": ReflectionOutput(ans=reflection_result_list)}, "prompt": "\n---\n".join(prompts)}
     return {"result": {"reflection": None}}
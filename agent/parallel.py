@@ -0,0 +1,25 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+
+def submit_with_context(executor, func, *args, **kwargs):
+    """
+    呼び出し元スレッドのcontextvars（LangChainのコールバックなど）を引き継いでexecutorに投入する
+    """
+    ctx = contextvars.copy_context()
+    return executor.submit(ctx.run, func, *args, **kwargs)
+
+
+def ordered_map(func, items, max_workers):
+    """
+    itemsの各要素にfuncを最大max_workers並列で適用し、入力と同じ順序で結果を返す。
+    例外は入力順で最初に失敗した要素のものを送出する
+    """
+    items = list(items)
+    if not items:
+        return []
+    if max_workers <= 1 or len(items) == 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        futures = [submit_with_context(executor, func, item) for item in items]
+        return [future.result() for future in futures]
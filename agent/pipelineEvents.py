@@ -0,0 +1,91 @@
+from typing import NamedTuple, Any
+
+# RareDiseaseDiagnosisPipeline.stream()/astream() が返すイベントの種類
+EVENT_PCF = "pcf"                                  # PubCaseFinderの順位（list[PCFres]）
+EVENT_GESTALT_MATCHER = "gestalt_matcher"          # GestaltMatcherの上位の症候群
+EVENT_ZERO_SHOT = "zero_shot"                      # zero-shotの診断リスト（ZeroShotOutput）
+EVENT_TENTATIVE_DIAGNOSIS = "tentative_diagnosis"  # 暫定診断（DiagnosisOutput。diseaseNormalizeNodeでOMIM IDが付いたものが再度届く）
+EVENT_REFLECTION = "reflection"                    # 候補1件のreflection（{"index", "disease_name", "reflection": ReflectionFormat}）
+EVENT_FINAL_TOKEN = "final_token"                  # 最終診断のLLM出力の断片（stream_tokens=Trueのときだけ）
+EVENT_FINAL_DIAGNOSIS = "final_diagnosis"          # 最終診断（DiagnosisOutput。diseaseNormalizeForFinalNodeで正規化したものが再度届く）
+EVENT_DONE = "done"                                # run()と同じ結果（最終のstateとmetrics）
+
+# ノードが更新したstateのフィールド -> イベントの種類
+UPDATE_EVENTS = {
+    "pubCaseFinder": EVENT_PCF,
+    "GestaltMatcher": EVENT_GESTALT_MATCHER,
+    "zeroShotResult": EVENT_ZERO_SHOT,
+    "tentativeDiagnosis": EVENT_TENTATIVE_DIAGNOSIS,
+    "finalDiagnosis": EVENT_FINAL_DIAGNOSIS,
+}
+
+# トークンを流すノード
+TOKEN_STREAM_NODES = ("finalDiagnosisNode",)
+
+
+class PipelineEvent(NamedTuple):
+    type: str   # EVENT_*
+    node: str   # イベントを出したノード（doneはNone）
+    depth: int  # reflectionループの回数（1始まり）
+    data: Any
+
+
+def stream_modes(stream_tokens: bool = False) -> list:
+    # "values" は最後のstate（EVENT_DONE）のため、"messages" はLLMのトークンのため
+    return ["updates", "custom", "values"] + (["messages"] if stream_tokens else [])
+
+
+def emit_event(event_type: str, **data):
+    """
+    ノードの中から "custom" モードでイベントを送る（stream()以外の実行・グラフ外の呼び出しでは何もしない）
+    """
+    from langgraph.config import get_config, get_stream_writer
+    try:
+        writer = get_stream_writer()
+        node = get_config().get("metadata", {}).get("langgraph_node")
+    except RuntimeError:
+        return
+    writer({"type": event_type, "node": node, "data": data})
+
+
+class EventConverter:
+    """
+    graph.stream(..., stream_mode=stream_modes()) の (mode, chunk) を PipelineEvent に変換する。
+    最後のstateとreflectionループの回数を保持する
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.state = None
+
+    def convert(self, mode: str, chunk) -> list:
+        if mode == "values":
+            self.state = chunk
+            return []
+        if mode == "updates":
+            events = []
+            for node, update in chunk.items():
+                # メモ化でスキップしたノード等は更新がない
+                if not isinstance(update, dict):
+                    continue
+                self.depth = update.get("depth") or self.depth
+                events.extend(PipelineEvent(event_type, node, self.depth, update[field])
+                              for field, event_type in UPDATE_EVENTS.items() if update.get(field))
+            return events
+        if mode == "custom":
+            return [PipelineEvent(chunk["type"], chunk.get("node"), self.depth, chunk.get("data"))]
+        if mode == "messages":
+            message, metadata = chunk
+            node = metadata.get("langgraph_node")
+            text = token_text(message) if node in TOKEN_STREAM_NODES else ""
+            return [PipelineEvent(EVENT_FINAL_TOKEN, node, self.depth, text)] if text else []
+        return []
+
+
+def token_text(chunk) -> str:
+    """
+    "messages" モードのメッセージ断片の文字列（構造化出力はtool callの引数のJSONの断片）
+    """
+    if isinstance(chunk.content, str) and chunk.content:
+        return chunk.content
+    return "".join(tool_call.get("args") or "" for tool_call in getattr(chunk, "tool_call_chunks", None) or [])
@@ -0,0 +1,233 @@
+#structured JSONL run log written by a background thread, with a renderer for the human-readable view.
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import hashlib
+import argparse
+import threading
+import contextlib
+import contextvars
+
+# 書き込み待ちの上限件数。満杯のときはLOG_QUEUE_PUT_TIMEOUT秒待って、それでも空かなければ破棄する
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "1000"))
+LOG_QUEUE_PUT_TIMEOUT = float(os.environ.get("LOG_QUEUE_PUT_TIMEOUT", "1.0"))
+
+# 実行中の症例のrun id（同じロガーに複数の症例を同時に書く arun 用）
+_current_run = contextvars.ContextVar("log_run_id", default=None)
+_stop = object()
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def _snapshot(o):
+    """
+    キューに積む時点の値のコピー（ノードの結果のpydanticオブジェクトは後続のノードが書き換えることがあるため）
+    """
+    if hasattr(o, "model_dump"):
+        return o.model_dump(mode="json")
+    if isinstance(o, dict):
+        return {k: _snapshot(v) for k, v in o.items()}
+    if isinstance(o, (list, tuple)):
+        return [_snapshot(v) for v in o]
+    return o
+
+
+def _default(o):
+    if hasattr(o, "model_dump"):
+        return o.model_dump(mode="json")
+    if hasattr(o, "dict"):
+        return o.dict()
+    return str(o)
+
+
+class RunLogger:
+    """
+    ノードの結果とプロンプトを1行1イベントのJSONLに書くロガー。
+    書き込み（JSONの文字列への変換を含む）はバックグラウンドスレッドで行うため、グラフのスレッドは結果のコピーをキューに積むだけ。
+    プロンプト（テンプレート・実際に送ったプロンプト）は初回だけ本文を書き、以降はハッシュで参照する
+    """
+
+    def __init__(self, path: str, render_path: str = None):
+        self.path = path
+        # 指定するとclose時に人が読む形式のログも出力する
+        self.render_path = render_path
+        self.dropped = 0
+        self._interned = set()
+        self._intern_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self._closed = False
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._thread = threading.Thread(target=self._writer, name="RunLogger", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _writer(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                record = self._queue.get()
+                if record is _stop:
+                    break
+                try:
+                    line = json.dumps(record, ensure_ascii=False, default=_default)
+                except Exception as e:
+                    line = json.dumps({**{k: record[k] for k in ("ts", "type", "run", "node") if k in record},
+                                       "error": f"ログ整形エラー: {e}"}, ensure_ascii=False)
+                f.write(line + "\n")
+                # キューが空になったらまとめて書き出す
+                if self._queue.empty():
+                    f.flush()
+
+    def _put(self, record: dict):
+        if self._closed:
+            return
+        record = {"ts": time.time(), "run": _current_run.get(), **record}
+        try:
+            self._queue.put(record, timeout=LOG_QUEUE_PUT_TIMEOUT)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1:
+                print(f"[RunLogger] log queue is full, dropping records ({self.path})", file=sys.stderr)
+
+    def intern(self, text: str, kind: str = "prompt", name: str = None) -> str:
+        """
+        プロンプト本文を初回だけ書き、ハッシュを返す
+        """
+        digest = text_hash(text)
+        with self._intern_lock:
+            if digest in self._interned:
+                return digest
+            self._interned.add(digest)
+        self._put({"type": kind, "hash": digest, "name": name, "text": text})
+        return digest
+
+    def graph(self, ascii_graph: str):
+        self._put({"type": "graph", "ascii": ascii_graph})
+
+    @contextlib.contextmanager
+    def run(self, run_id: str, **inputs):
+        """
+        with logger.run(run_id, hpo_list=...): の中で書いたイベントにrun idを付ける
+        """
+        token = _current_run.set(run_id)
+        self._put({"type": "run_start", "inputs": inputs})
+        try:
+            yield
+        finally:
+            self._put({"type": "run_end"})
+            _current_run.reset(token)
+
+    def node(self, node_name: str, result, templates: dict = None):
+        """
+        ノードの結果を記録する。resultがプロンプト付きdict（{"result", "prompt"}）ならプロンプトはハッシュで参照する。
+        templates: このノードが使うプロンプトテンプレート {名前: 本文}
+        """
+        record = {"type": "node", "node": node_name}
+        if templates:
+            record["templates"] = [self.intern(text, "template", name) for name, text in templates.items()]
+        if isinstance(result, dict) and "prompt" in result:
+            record["prompt"] = self.intern(result["prompt"] or "")
+            result = result.get("result", result)
+        record["result"] = _snapshot(result)
+        self._put(record)
+
+    def flush(self):
+        """
+        キューに積まれたイベントがすべて書かれるまで待つ
+        """
+        while not self._queue.empty() and self._thread.is_alive():
+            time.sleep(0.01)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_stop)
+        self._thread.join()
+        atexit.unregister(self.close)
+        if self.render_path:
+            render_log(self.path, self.render_path)
+
+
+def _write_result(f, result):
+    if isinstance(result, str):
+        f.write(result)
+    elif isinstance(result, list):
+        for item in result:
+            f.write((json.dumps(item, ensure_ascii=False, indent=2) if isinstance(item, (dict, list)) else str(item)) + "\n")
+    else:
+        f.write(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+def _write_node(f, record, texts):
+    f.write(f"\n=== {record['node']} ===\n")
+    for digest in record.get("templates", []):
+        name = texts.get(digest, {}).get("name") or digest
+        f.write(f"\n----- {name} (template {digest}) -----\n")
+        f.write(texts.get(digest, {}).get("text", ""))
+        f.write(f"----- End {name} -----\n\n")
+    result = record.get("result")
+    if "error" in record:
+        f.write(record["error"] + "\n")
+    if "prompt" in record:
+        prompt = texts.get(record["prompt"], {}).get("text", "")
+        if record["node"] == "reflectionNode" and prompt.strip():
+            prompts = prompt.split("\n---\n") if "\n---\n" in prompt else prompt.split("\n\n")
+            reflection = (result or {}).get("reflection") if isinstance(result, dict) else None
+            ans_list = (reflection or {}).get("ans") or []
+            for i, p in enumerate(prompts):
+                disease_name = ans_list[i].get("disease_name", f"#{i+1}") if i < len(ans_list) else ""
+                f.write(f"\n----- Reflection Prompt for: {disease_name} -----\n")
+                f.write(p.strip() + "\n")
+                f.write("----- End Reflection Prompt -----\n")
+        else:
+            f.write("\n----- Prompt Start -----\n")
+            f.write(prompt.strip() + "\n")
+            f.write("----- Prompt End -----\n")
+        f.write("Result:\n")
+    _write_result(f, result)
+    f.write("\n")
+
+
+def render_log(jsonl_path: str, out_path: str = None):
+    """
+    JSONLのログを従来の人が読む形式に変換する（out_pathがNoneなら標準出力）。
+    同時に実行された症例はrun idごとにまとめて出力する
+    """
+    with open(jsonl_path, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    texts = {r["hash"]: r for r in records if r["type"] in ("template", "prompt")}
+    runs = {}
+    for record in records:
+        if record["type"] in ("node", "run_start", "run_end"):
+            runs.setdefault(record.get("run"), []).append(record)
+
+    with (open(out_path, "w", encoding="utf-8") if out_path else contextlib.nullcontext(sys.stdout)) as out:
+        for record in records:
+            if record["type"] == "graph":
+                out.write("=== Agent Flow Graph ===\n")
+                out.write(record["ascii"])
+                out.write("\n\n")
+        for run_id, run_records in runs.items():
+            if run_id is not None:
+                out.write(f"\n##### Run {run_id} #####\n")
+            for record in run_records:
+                if record["type"] == "run_start":
+                    out.write(f"Inputs: {json.dumps(record.get('inputs'), ensure_ascii=False)}\n")
+                elif record["type"] == "node":
+                    _write_node(out, record, texts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a JSONL run log as the human-readable log")
+    parser.add_argument('log', help='Run log (.jsonl)')
+    parser.add_argument('-o', '--output', default=None, help='Output file (default: stdout)')
+    args = parser.parse_args()
+    render_log(args.log, args.output)
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from typing_extensions import List, TypedDict, Optional
+from typing_extensions import List, TypedDict, Optional, Annotated, NotRequired
 from pydantic import BaseModel, Field
 
 class PCFres(TypedDict):
@@ -11,6 +11,12 @@ class HistoryItem(TypedDict):
     role: str  # "user" or "agent" or "tool"
     content: str
 
+def merge_dicts(left: Optional[dict], right: Optional[dict]) -> dict:
+    """
+    並列ノードからの更新をまとめるreducer（同じキーは後の値で上書き）
+    """
+    return {**(left or {}), **(right or {})}
+
 class State(TypedDict):
     depth: int
     imagePath: Optional[str]
@@ -21,13 +27,19 @@ class State(TypedDict):
     absentHpoDict: dict[str, str] 
     pubCaseFinder: List[PCFres]
     GestaltMatcher: List['GestaltMatcherFormat']
+    # GestaltMatcherの全候補 {"imagePath": ..., "syndromes": [...]}（深度ごとに切り出して使う）
+    gestaltMatcherFull: Optional[dict]
     webresources: List['webresource']
     # evidence are stored in memory
     memory: List['InformationItem']
+    # diseaseSearch の (情報源:疾患名) ごとの取得済み件数
+    retrievalCursors: dict[str, int]
     zeroShotResult: Optional['ZeroShotOutput']
     tentativeDiagnosis: Optional['DiagnosisOutput']
     reflection: Optional['ReflectionOutput']
     finalDiagnosis: Optional['DiagnosisOutput']
+    # メモ化したノードの名前 -> 前回実行時の入力のハッシュ
+    nodeMemo: Annotated[dict[str, str], merge_dicts]
     
 # --- Pydantic Model for Zero-Shot Diagnosis Output ---
 class ZeroShotFormat(BaseModel):
@@ -79,6 +91,9 @@ class InformationItem(TypedDict):
     url: str
     content: str
     disease_name: str
+    # 候補のOMIM ID（わかる場合）と、要約前の本文のSimHash（16進文字列、近似重複の検出用）
+    omim_id: NotRequired[Optional[str]]
+    simhash: NotRequired[str]
 
 class webresource(TypedDict):
     title: str
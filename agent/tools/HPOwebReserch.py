@@ -1,7 +1,9 @@
+import asyncio
 from ..state.state_types import State, webresource
 from typing import List
-from ddgs import DDGS
-from ..llm.azure_llm_instance import azure_llm
+from ..llm.azure_llm_instance import get_azure_llm
+from .summaryCache import cached_summary, acached_summary
+from ..metrics import timed_call
 
 webresearch_prompt_dict = {
    "generate_query_prompt": """You are a medical research assistant specializing in clinical genetics and bioinformatics. Your task is to generate effective DDGS(DuckDuckGo Search) queries to identify potential syndromes or genetic disorders based on a provided list of Human Phenotype Ontology (HPO) terms.
@@ -48,7 +50,15 @@ def extract_hpo_labels(hpo_dict: dict) -> List[str]:
 def generate_queries(hpo_labels: List[str]) -> List[str]:
     prompt = webresearch_prompt_dict["generate_query_prompt"].format(hpo_terms=', '.join(hpo_labels))
     # Azure OpenAI でクエリ生成
-    queries_msg = azure_llm.generate(prompt)
+    queries_msg = get_azure_llm().generate(prompt)
+    return parse_queries(queries_msg)
+
+async def agenerate_queries(hpo_labels: List[str]) -> List[str]:
+    prompt = webresearch_prompt_dict["generate_query_prompt"].format(hpo_terms=', '.join(hpo_labels))
+    queries_msg = await get_azure_llm().agenerate(prompt)
+    return parse_queries(queries_msg)
+
+def parse_queries(queries_msg) -> List[str]:
     # 返り値が文字列の場合は分割、リストの場合はそのまま
     if isinstance(queries_msg, str):
         # 1. ... 2. ... の形式を想定して分割
@@ -65,19 +75,40 @@ def generate_queries(hpo_labels: List[str]) -> List[str]:
         return list(queries_msg)[:2]
 
 def summarize_content(article_text: str) -> str:
-    prompt = webresearch_prompt_dict["summarize_results_prompt"].format(article_text=article_text)
-    summary_msg = azure_llm.generate(prompt)
-    summary = summary_msg.content if hasattr(summary_msg, "content") else str(summary_msg)
-    return summary.strip()
+    prompt_template = webresearch_prompt_dict["summarize_results_prompt"]
+    llm = get_azure_llm()
+
+    def summarize():
+        prompt = prompt_template.format(article_text=article_text)
+        summary_msg = llm.generate(prompt)
+        summary = summary_msg.content if hasattr(summary_msg, "content") else str(summary_msg)
+        return summary.strip()
+
+    # 同じスニペット・同じプロンプト・同じデプロイの要約はディスクキャッシュから返す
+    return cached_summary(prompt_template, article_text, llm.deployment_name, summarize)
+
+async def asummarize_content(article_text: str) -> str:
+    prompt_template = webresearch_prompt_dict["summarize_results_prompt"]
+    llm = get_azure_llm()
+
+    async def summarize():
+        prompt = prompt_template.format(article_text=article_text)
+        summary_msg = await llm.agenerate(prompt)
+        summary = summary_msg.content if hasattr(summary_msg, "content") else str(summary_msg)
+        return summary.strip()
+
+    return await acached_summary(prompt_template, article_text, llm.deployment_name, summarize)
 
 def search_hpo_terms(state: State) -> List[webresource]:
+    from ddgs import DDGS
     hpo_labels = extract_hpo_labels(state["hpoDict"])
     queries = generate_queries(hpo_labels)
     new_webresources = []
     existing_urls = {w["url"] for w in state.get("webresources", [])}
     with DDGS() as ddgs:
         for query in queries:
-            results = list(ddgs.text(query, max_results=2))
+            with timed_call("ddgs"):
+                results = list(ddgs.text(query, max_results=2))
             for result in results:
                 url = result.get("href") or result.get("url")
                 title = result.get("title") or ""
@@ -93,4 +124,35 @@ def search_hpo_terms(state: State) -> List[webresource]:
                     snippet=summary
                 ))
                 existing_urls.add(url)
-    return new_webresources
\ No newline at end of file
+    return new_webresources
+
+def _ddgs_text(query: str, max_results: int):
+    from ddgs import DDGS
+    with timed_call("ddgs"), DDGS() as ddgs:
+        return list(ddgs.text(query, max_results=max_results))
+
+async def asearch_hpo_terms(state: State) -> List[webresource]:
+    """
+    search_hpo_terms の非同期版。DDGSは同期APIのみのためスレッドで実行し、
+    クエリごとの検索とスニペットの要約は同時に行う（結果の順序は同期版と同じ）
+    """
+    hpo_labels = extract_hpo_labels(state["hpoDict"])
+    queries = await agenerate_queries(hpo_labels)
+    search_results = await asyncio.gather(*(asyncio.to_thread(_ddgs_text, query, 2) for query in queries))
+
+    candidates = []
+    existing_urls = {w["url"] for w in state.get("webresources", [])}
+    for results in search_results:
+        for result in results:
+            url = result.get("href") or result.get("url")
+            if not url or url in existing_urls:
+                continue
+            existing_urls.add(url)
+            candidates.append((url, result.get("title") or "", result.get("body") or result.get("snippet") or ""))
+
+    summaries = await asyncio.gather(*(asummarize_content(snippet) for _, _, snippet in candidates))
+    return [
+        webresource(title=title, url=url, snippet=summary)
+        for (url, title, _), summary in zip(candidates, summaries)
+        if not summary.lower().startswith("not a medical-related page")
+    ]
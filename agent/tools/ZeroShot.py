@@ -1,20 +1,13 @@
-from langchain.schema import HumanMessage
 from ..state.state_types import ZeroShotOutput
 from ..llm.prompt import prompt_dict, build_prompt
-from ..llm.azure_llm_instance import azure_llm
+from ..llm.azure_llm_instance import get_azure_llm
 
 
-def createZeroshot(hpo_dict, absent_hpo_dict=None):
-    """
-    hpo_dictとabsent_hpo_dictを使ってZero-Shot診断プロンプトを作成し、LLMに投げる
-    """
-    if not hpo_dict:
-        return None, None
-
+def build_zeroshot_prompt(hpo_dict, absent_hpo_dict=None):
     present_hpo = ", ".join([v for k, v in hpo_dict.items() if v])
     absent_hpo = ", ".join([v for k, v in (absent_hpo_dict or {}).items()]) if absent_hpo_dict else ""
 
-    prompt = build_prompt(
+    return build_prompt(
         prompt_dict["zero-shot-diagnosis-prompt"],
         {
             "present_hpo": present_hpo,
@@ -22,8 +15,34 @@ def createZeroshot(hpo_dict, absent_hpo_dict=None):
         }
     )
 
+
+def createZeroshot(hpo_dict, absent_hpo_dict=None):
+    """
+    hpo_dictとabsent_hpo_dictを使ってZero-Shot診断プロンプトを作成し、LLMに投げる
+    """
+    if not hpo_dict:
+        return None, None
+
+    prompt = build_zeroshot_prompt(hpo_dict, absent_hpo_dict)
+
     # structured_llmを使う場合
-    structured_llm = azure_llm.get_structured_llm(ZeroShotOutput)
+    structured_llm = get_azure_llm().get_structured_llm(ZeroShotOutput)
+    from langchain.schema import HumanMessage
     messages = [HumanMessage(content=prompt)]
     result = structured_llm.invoke(messages)
-    return result, prompt
\ No newline at end of file
+    return result, prompt
+
+
+async def acreateZeroshot(hpo_dict, absent_hpo_dict=None):
+    """
+    createZeroshot の非同期版
+    """
+    if not hpo_dict:
+        return None, None
+
+    prompt = build_zeroshot_prompt(hpo_dict, absent_hpo_dict)
+    structured_llm = get_azure_llm().get_structured_llm(ZeroShotOutput)
+    from langchain.schema import HumanMessage
+    messages = [HumanMessage(content=prompt)]
+    result = await structured_llm.ainvoke(messages)
+    return result, prompt
@@ -0,0 +1,117 @@
+import os
+import re
+import threading
+from typing import NamedTuple, List, Any, Optional
+from ..metrics import inc
+
+# プロンプトごとの根拠（文献・Web検索結果・reflection）のトークン予算（0ならNone = 制限しない）
+REFLECTION_EVIDENCE_TOKENS = int(os.environ.get("REFLECTION_EVIDENCE_TOKENS", "6000")) or None
+FINAL_EVIDENCE_TOKENS = int(os.environ.get("FINAL_EVIDENCE_TOKENS", "8000")) or None
+DIAGNOSIS_EVIDENCE_TOKENS = int(os.environ.get("DIAGNOSIS_EVIDENCE_TOKENS", "3000")) or None
+# 予算に入りきらない項目も、残りがこのトークン数以上あれば切り詰めて入れる
+MIN_TRUNCATED_TOKENS = int(os.environ.get("MIN_TRUNCATED_TOKENS", "200"))
+TRUNCATION_MARK = "\n[...truncated]\n"
+# トークン数を数えるtiktokenのモデル名（デプロイのモデルに合わせる）
+LLM_TOKENIZER_MODEL = os.environ.get("LLM_TOKENIZER_MODEL", "gpt-4o")
+
+_WORD = re.compile(r"[a-z0-9]+")
+_encoding_lock = threading.Lock()
+_encoding = []
+
+
+def _get_encoding():
+    """
+    tiktokenのエンコーディング。インストールされていない・語彙ファイルを取得できない場合はNone（文字数/4で数える）
+    """
+    if not _encoding:
+        with _encoding_lock:
+            if not _encoding:
+                try:
+                    import tiktoken
+                    try:
+                        encoding = tiktoken.encoding_for_model(LLM_TOKENIZER_MODEL)
+                    except KeyError:
+                        encoding = tiktoken.get_encoding("o200k_base")
+                except Exception as e:
+                    print(f"[contextPacking] tiktoken is not available, estimating tokens as characters/4: {e.__class__.__name__}")
+                    encoding = None
+                _encoding.append(encoding)
+    return _encoding[0]
+
+
+def count_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    encoding = _get_encoding()
+    if encoding is None:
+        return text[:max_tokens * 4]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+
+def _words(text: str) -> set:
+    return {w for w in _WORD.findall(text.lower()) if len(w) > 2}
+
+
+def relevance(text: str, candidate: str = "", hpo_terms=()) -> float:
+    """
+    候補の疾患名（重み2）と患者のHPO用語（重み1）の単語が根拠の本文に含まれる割合
+    """
+    words = _words(text)
+    score = 0.0
+    candidate_words = _words(candidate)
+    if candidate_words:
+        score += 2.0 * len(candidate_words & words) / len(candidate_words)
+    hpo_words = set().union(*(_words(term) for term in hpo_terms)) if hpo_terms else set()
+    if hpo_words:
+        score += len(hpo_words & words) / len(hpo_words)
+    return score
+
+
+class PackedEvidence(NamedTuple):
+    kept: List[Any]      # 予算内に入った項目（元の順序）
+    texts: List[str]     # keptのプロンプト用文字列（切り詰めた項目は末尾に TRUNCATION_MARK）
+    dropped: List[Any]   # 入らなかった項目
+    tokens: int          # textsの合計トークン数
+    budget: Optional[int]
+
+
+def pack_evidence(items, render, budget: Optional[int], prompt: str, candidate: str = "", hpo_terms=(), score=None) -> PackedEvidence:
+    """
+    itemsを関連度の高い順にトークン予算まで詰め、元の順序で返す（budget=Noneなら全件）。
+    入りきらない項目は、残りがMIN_TRUNCATED_TOKENS以上なら切り詰めて入れ、そうでなければ飛ばして次を試す。
+    render(item) はプロンプトに入れる文字列、score(item, text) は関連度（省略時は relevance）。
+    落とした項目があれば（promptの名前と各項目の1行目を）表示し、メトリクス zebraseek_context_dropped_total に記録する
+    """
+    items = list(items)
+    texts = [render(item) for item in items]
+    if budget is None:
+        return PackedEvidence(items, texts, [], sum(count_tokens(text) for text in texts), budget)
+    if score is None:
+        scores = [relevance(text, candidate, hpo_terms) for text in texts]
+    else:
+        scores = [score(item, text) for item, text in zip(items, texts)]
+    order = sorted(range(len(items)), key=lambda i: -scores[i])
+    kept, used = {}, 0
+    mark_tokens = count_tokens(TRUNCATION_MARK)
+    for i in order:
+        tokens = count_tokens(texts[i])
+        if used + tokens <= budget:
+            kept[i] = texts[i]
+            used += tokens
+        elif budget - used - mark_tokens >= MIN_TRUNCATED_TOKENS:
+            kept[i] = truncate_tokens(texts[i], budget - used - mark_tokens) + TRUNCATION_MARK
+            used += count_tokens(kept[i])
+    dropped = [i for i in range(len(items)) if i not in kept]
+    if dropped:
+        inc("zebraseek_context_dropped_total", (prompt,), len(dropped))
+        target = f"{prompt} ({candidate})" if candidate else prompt
+        print(f"[contextPacking] {target}: kept {len(kept)}/{len(items)} items ({used}/{budget} tokens), dropped:")
+        for i in dropped:
+            print(f"  - {texts[i].strip().splitlines()[0][:100] if texts[i].strip() else ''}")
+    order = sorted(kept)
+    return PackedEvidence([items[i] for i in order], [kept[i] for i in order], [items[i] for i in dropped], used, budget)
@@ -1,25 +1,26 @@
-from langchain.schema import HumanMessage
 from typing_extensions import List, Optional
 from ..state.state_types import PCFres, DiagnosisOutput
 from ..llm.prompt import prompt_dict, build_prompt
-from ..llm.azure_llm_instance import azure_llm
+from ..llm.azure_llm_instance import get_azure_llm
+from .contextPacking import pack_evidence, DIAGNOSIS_EVIDENCE_TOKENS
 
-def format_webresources(webresources: list) -> str:
+def format_webresources(webresources: list, hpo_terms=()) -> str:
     """
     Webリソースリストを診断プロンプト用のテキストに整形
+    HPO用語との関連度が高い順に DIAGNOSIS_EVIDENCE_TOKENS まで詰める（番号は元のリストの位置）
     """
     if not webresources:
         return "No relevant web search results found."
-    lines = []
-    for i, res in enumerate(webresources, 1):
-        title = res.get("title", "")
-        url = res.get("url", "")
-        snippet = res.get("snippet", "")
-        lines.append(f"{i}. {title}\nURL: {url}\nSummary: {snippet}")
-    return "\n".join(lines)
 
+    def render(indexed):
+        i, res = indexed
+        return f"{i}. {res.get('title', '')}\nURL: {res.get('url', '')}\nSummary: {res.get('snippet', '')}"
 
-def createDiagnosis(hpo_dict: dict[str,str], pubCaseFinder: List[PCFres], zeroShotResult, gestaltMatcherResult, webresources=None, absent_hpo_dict=None) -> Optional[DiagnosisOutput]:
+    packed = pack_evidence(list(enumerate(webresources, 1)), render, DIAGNOSIS_EVIDENCE_TOKENS, "diagnosis", hpo_terms=hpo_terms)
+    return "\n".join(packed.texts)
+
+
+def build_diagnosis_prompt(hpo_dict: dict[str,str], pubCaseFinder: List[PCFres], zeroShotResult, gestaltMatcherResult, webresources=None, absent_hpo_dict=None) -> str:
     top_str = "\n".join(
         [f"{i+1}. {item['omim_disease_name_en']} (score: {float(item['score']):.3f}) - {item['description']}" for i, item in enumerate(pubCaseFinder)]
     )
@@ -38,7 +39,7 @@ def createDiagnosis(hpo_dict: dict[str,str], pubCaseFinder: List[PCFres], zeroSh
             for i, item in enumerate(gestaltMatcherResult)
         ])
     # --- Webリソースの整形 ---
-    webresources_str = format_webresources(webresources) if webresources is not None else "No web search results provided."
+    webresources_str = format_webresources(webresources, list(hpo_dict.values())) if webresources is not None else "No web search results provided."
     # ---------------------------------
 
     inputs = {
@@ -54,10 +55,27 @@ def createDiagnosis(hpo_dict: dict[str,str], pubCaseFinder: List[PCFres], zeroSh
         prompt_dict["diagnosis_prompt"] +
         "\n**6. Web Search Results (Literature/Case Reports):**\n{web_search_results}\n"
     )
-    structured_llm = azure_llm.get_structured_llm(DiagnosisOutput)
+    return build_prompt(prompt_template, inputs)
 
-    prompt = build_prompt(prompt_template, inputs)
 
+def createDiagnosis(hpo_dict: dict[str,str], pubCaseFinder: List[PCFres], zeroShotResult, gestaltMatcherResult, webresources=None, absent_hpo_dict=None) -> Optional[DiagnosisOutput]:
+    prompt = build_diagnosis_prompt(hpo_dict, pubCaseFinder, zeroShotResult, gestaltMatcherResult, webresources, absent_hpo_dict=absent_hpo_dict)
+    structured_llm = get_azure_llm().get_structured_llm(DiagnosisOutput)
+
+    from langchain.schema import HumanMessage
     messages = [HumanMessage(content=prompt)]
     result = structured_llm.invoke(messages)
-    return result, prompt
\ No newline at end of file
+    return result, prompt
+
+
+async def acreateDiagnosis(hpo_dict: dict[str,str], pubCaseFinder: List[PCFres], zeroShotResult, gestaltMatcherResult, webresources=None, absent_hpo_dict=None) -> Optional[DiagnosisOutput]:
+    """
+    createDiagnosis の非同期版
+    """
+    prompt = build_diagnosis_prompt(hpo_dict, pubCaseFinder, zeroShotResult, gestaltMatcherResult, webresources, absent_hpo_dict=absent_hpo_dict)
+    structured_llm = get_azure_llm().get_structured_llm(DiagnosisOutput)
+
+    from langchain.schema import HumanMessage
+    messages = [HumanMessage(content=prompt)]
+    result = await structured_llm.ainvoke(messages)
+    return result, prompt
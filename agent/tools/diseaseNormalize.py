@@ -1,9 +1,14 @@
 import os
+import asyncio
 import numpy as np
-import faiss
 import json
-from openai import AzureOpenAI
 from dotenv import load_dotenv
+from ..lazy import lazy_singleton
+from ..metrics import timed_call, record_tokens, record_cache
+from .lexicalIndex import LexicalIndex
+from .omimLabelStore import OmimLabelStore
+from .diskCache import CACHE_DIR
+from .normalizeCache import NormalizationCache, canonical_name, file_fingerprint
 
 load_dotenv()
 
@@ -13,63 +18,206 @@ region = "japaneast"
 model = "text-embedding-3-large"
 deployment_name = f"{region}-{model}"
 endpoint = f"https://{tenant}-{region}.openai.azure.com/"
-api_key = os.getenv(f"AZURE_{tenant.upper()}_{region.upper()}")
-if not api_key:
-    raise RuntimeError(f"AZURE_{tenant.upper()}_{region.upper()} is not set in .env")
-
-client = AzureOpenAI(
-    azure_endpoint=endpoint,
-    api_key=api_key,
-    api_version="2024-05-01-preview"
-)
 
 # インデックスとマッピングファイルのパス
 INDEX_BASE = os.path.join(os.path.dirname(__file__), "../data/DataForOmimMapping/DataForOmimMapping")
 INDEX_BIN = INDEX_BASE + ".bin"
 INDEX_JSON = INDEX_BASE + ".json"
-OMIM_MAPPING_JSON = os.path.join(os.path.dirname(__file__), "../data/DataForOmimMapping/omim_mapping.json")
+# 任意: {omim_id: [同義語, ...]} 形式の同義語辞書
+OMIM_SYNONYMS_JSON = os.path.join(os.path.dirname(__file__), "../data/DataForOmimMapping/omim_synonyms.json")
 
-# インデックスとマッピングのロード
-faiss_index = faiss.read_index(INDEX_BIN)
-with open(INDEX_JSON, encoding="utf-8") as f:
-    index_map = json.load(f)
-with open(OMIM_MAPPING_JSON, encoding="utf-8") as f:
-    omim_mapping = json.load(f)
+# クライアント・インデックス類はimport時ではなく初回の正規化時に作成する
 
 
-def disease_normalize(disease_name: str):
-    # 疾患名をembedding
-    response = client.embeddings.create(
-        model=deployment_name,
-        input=[disease_name]
+@lazy_singleton
+def get_client():
+    from openai import AzureOpenAI
+    api_key = os.getenv(f"AZURE_{tenant.upper()}_{region.upper()}")
+    if not api_key:
+        raise RuntimeError(f"AZURE_{tenant.upper()}_{region.upper()} is not set in .env")
+    return AzureOpenAI(
+        azure_endpoint=endpoint,
+        api_key=api_key,
+        api_version="2024-05-01-preview"
     )
-    query_embedding = np.array(response.data[0].embedding, dtype="float32").reshape(1, -1)
-    faiss.normalize_L2(query_embedding)
-    # 類似度最大のインデックスを取得
-    distance, indices = faiss_index.search(query_embedding, 1)
-    idx = indices[0][0]
-    sim = float(distance[0][0])  # コサイン類似度
-    omim_id = index_map["omim_ids"][idx]
-    label = index_map["labels"][idx]
-    # omim_mapping.jsonから正式病名を取得
-    omim_label = omim_mapping.get(omim_id, label)
-    return omim_id, omim_label, sim
 
-def diseaseNormalizeForDiagnosis(Diagnosis):
+
+@lazy_singleton
+def get_label_store():
+    if OmimLabelStore.exists(INDEX_BASE):
+        return OmimLabelStore.load(INDEX_BASE)
+    # バイナリサイドカーがない旧形式のインデックス（createIndex.py --sidecar-only で変換できる）
+    return OmimLabelStore.from_sidecar_json(INDEX_JSON)
+
+
+@lazy_singleton
+def get_faiss_index():
+    import faiss
+    # インデックスはmmapで開き、複数ワーカー間でページキャッシュを共有する（未対応の形式は通常読み込み）
+    try:
+        faiss_index = faiss.read_index(INDEX_BIN, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+        faiss_index = faiss.read_index(INDEX_BIN)
+    # createIndex.py で近似インデックスを選んだ場合の検索パラメータ（サイドカーに記録されている）
+    search_params = get_label_store().meta.get("search_params")
+    if search_params:
+        faiss.ParameterSpace().set_index_parameters(faiss_index, search_params)
+    return faiss_index
+
+
+@lazy_singleton
+def get_lexical_index():
+    # 字句一致の高速パス（完全一致・同義語・あいまい一致）。ヒットすればembeddingを呼ばない
+    omim_synonyms = {}
+    if os.path.exists(OMIM_SYNONYMS_JSON):
+        with open(OMIM_SYNONYMS_JSON, encoding="utf-8") as f:
+            omim_synonyms = json.load(f)
+    return LexicalIndex.from_mapping(dict(get_label_store().items()), omim_synonyms)
+
+
+def get_embedding_dimensions():
+    # createIndex.py で次元削減を選んだ場合の次元数
+    return get_label_store().meta.get("dimensions")
+
+
+@lazy_singleton
+def get_normalization_cache():
+    # 疾患名 -> OMIM の正規化キャッシュ（LRU + SQLite）。インデックス更新時は結果を自動破棄
+    embedding_dimensions = get_embedding_dimensions()
+    return NormalizationCache(
+        db_path=os.environ.get("NORMALIZE_CACHE_DB", os.path.join(CACHE_DIR, "normalize_cache.sqlite3")),
+        model=f"{deployment_name}:{embedding_dimensions}" if embedding_dimensions else deployment_name,
+        index_fingerprint=file_fingerprint(INDEX_BIN)
+    )
+
+
+# embeddings APIに1リクエストで渡す入力数の上限
+EMBEDDING_BATCH_SIZE = 1000
+# この類似度未満の正規化結果は棄却する
+SIM_THRESHOLD = 0.75
+
+
+def embed_disease_names(disease_names):
     """
-    tentativeDiagnosis: DiagnosisOutput
-    各診断候補にOMIM idと正規化病名を付与し、類似度0.8未満は棄却
+    疾患名のリストをまとめてembeddingし、L2正規化済みの (N, dim) 行列を返す
     """
-    filtered_ans = []
-    for diag in Diagnosis.ans:
-        disease_name_upper = diag.disease_name.upper()
-        omim_id, omim_label, sim = disease_normalize(disease_name_upper)
+    import faiss
+    embedding_dimensions = get_embedding_dimensions()
+    vectors = []
+    for i in range(0, len(disease_names), EMBEDDING_BATCH_SIZE):
+        batch = disease_names[i:i + EMBEDDING_BATCH_SIZE]
+        kwargs = {"dimensions": embedding_dimensions} if embedding_dimensions else {}
+        with timed_call("embeddings"):
+            response = get_client().embeddings.create(
+                model=deployment_name,
+                input=batch,
+                **kwargs
+            )
+        if getattr(response, "usage", None) is not None:
+            record_tokens("embeddings", response.usage.prompt_tokens)
+        # response.dataはindex順に並んでいる保証がないためindexでソート
+        vectors.extend(item.embedding for item in sorted(response.data, key=lambda d: d.index))
+    query_embeddings = np.array(vectors, dtype="float32").reshape(len(disease_names), -1)
+    faiss.normalize_L2(query_embeddings)
+    return query_embeddings
+
 
-        if sim >= 0.75:
+def disease_normalize_batch(disease_names):
+    """
+    複数の疾患名をまとめて正規化する。
+    まずOMIMラベルとの字句一致を試し、ヒットしなかった疾患名のうち
+    キャッシュにないものだけをembedding（1リクエスト/EMBEDDING_BATCH_SIZE件）し、
+    FAISS検索は1回の複数行検索で行う。
+    戻り値: 入力と同じ順序の [(omim_id, omim_label, sim), ...]
+    """
+    if not disease_names:
+        return []
+    lexical_index = get_lexical_index()
+    label_store = get_label_store()
+    normalization_cache = get_normalization_cache()
+    keys = [canonical_name(name) for name in disease_names]
+    resolved = {}
+    misses = []
+    # 同じ疾患名は1回だけ処理する
+    for name in dict.fromkeys(keys):
+        lexical = lexical_index.lookup(name)
+        if lexical is not None:
+            omim_id, score = lexical
+            resolved[name] = (omim_id, label_store.label_for(omim_id), score)
+            continue
+        cached = normalization_cache.get(name)
+        record_cache("normalize_cache", cached is not None)
+        if cached is not None:
+            resolved[name] = cached
+        else:
+            misses.append(name)
+    if misses:
+        # embeddingがキャッシュ済みのものはAPIを呼ばない
+        cached_vectors = {name: normalization_cache.get_embedding(name) for name in misses}
+        to_embed = [name for name in misses if cached_vectors[name] is None]
+        if to_embed:
+            for name, vector in zip(to_embed, embed_disease_names(to_embed)):
+                cached_vectors[name] = vector
+        query_embeddings = np.stack([cached_vectors[name] for name in misses]).astype("float32")
+        # 類似度最大のインデックスを取得
+        distances, indices = get_faiss_index().search(query_embeddings, 1)
+        for name, distance, idx in zip(misses, distances[:, 0], indices[:, 0]):
+            # インデックスの行番号からOMIM IDと正式病名を取得
+            result = (label_store.omim_id(idx), label_store.label(idx), float(distance))  # コサイン類似度
+            normalization_cache.put(name, cached_vectors[name], result)
+            resolved[name] = result
+    return [resolved[key] for key in keys]
+
+
+def get_normalization_cache_stats():
+    stats = get_normalization_cache().get_stats()
+    stats.update({f"lexical_{k}": v for k, v in get_lexical_index().stats.items()})
+    return stats
+
+
+def disease_normalize(disease_name: str):
+    return disease_normalize_batch([disease_name])[0]
+
+
+def _apply_normalization(Diagnosis, normalized):
+    filtered_ans = []
+    for diag, (omim_id, omim_label, sim) in zip(Diagnosis.ans, normalized):
+        if sim >= SIM_THRESHOLD:
             diag.OMIM_id = omim_id
             diag.disease_name = omim_label
             filtered_ans.append(diag)
         else:
             print(f"Filtered out {diag.disease_name} due to low similarity ({sim:.2f})")
     Diagnosis.ans = filtered_ans
-    return Diagnosis
\ No newline at end of file
+    return Diagnosis
+
+
+def diseaseNormalizeForDiagnoses(Diagnoses):
+    """
+    Diagnoses: DiagnosisOutputのリスト（複数症例分）
+    全症例の診断候補をまとめて1回のバッチで正規化する（コホート実行用）
+    """
+    names = [diag.disease_name.upper() for Diagnosis in Diagnoses for diag in Diagnosis.ans]
+    normalized = disease_normalize_batch(names)
+    offset = 0
+    for Diagnosis in Diagnoses:
+        n = len(Diagnosis.ans)
+        _apply_normalization(Diagnosis, normalized[offset:offset + n])
+        offset += n
+    return Diagnoses
+
+
+def diseaseNormalizeForDiagnosis(Diagnosis):
+    """
+    tentativeDiagnosis: DiagnosisOutput
+    各診断候補にOMIM idと正規化病名を付与し、類似度SIM_THRESHOLD未満は棄却
+    """
+    return diseaseNormalizeForDiagnoses([Diagnosis])[0]
+
+
+async def adiseaseNormalizeForDiagnosis(Diagnosis):
+    """
+    diseaseNormalizeForDiagnosis の非同期版。
+    embedding取得（同期クライアント）とFAISS検索はイベントループを止めないようスレッドで実行する
+    """
+    return await asyncio.to_thread(diseaseNormalizeForDiagnosis, Diagnosis)
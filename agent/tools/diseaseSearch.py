@@ -1,149 +1,356 @@
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Dict, Any
-from langchain_community.retrievers import PubMedRetriever, WikipediaRetriever
+from ..parallel import submit_with_context
 from ..state.state_types import State, InformationItem
-from ..llm.azure_llm_instance import azure_llm
+from ..llm.azure_llm_instance import get_azure_llm
+from ..llm.prompt import prompt_dict
+from .summaryCache import cached_summary, acached_summary
+from .retrievalCache import cached_retrieval, acached_retrieval
+from .literatureSources import pubmed_page, wikipedia_page, apubmed_page, awikipedia_page
+from .evidenceStore import EvidenceStore, fingerprint, is_near_duplicate, summary_text
+
+# 検索する情報源（memoryへの追加順もこの順）
+SOURCES = ("Wikipedia", "PubMed")
+# 同時に実行する検索・要約の最大数
+SEARCH_MAX_WORKERS = int(os.environ.get("DISEASE_SEARCH_MAX_WORKERS", "6"))
+SUMMARY_MAX_WORKERS = int(os.environ.get("SUMMARY_MAX_WORKERS", "4"))
+# 情報源ごとの (検索深度あたりの取得件数, 1文書あたりの最大文字数)
+# 深度dのループでは先頭から d*取得件数 件目までを対象とし、前のループで取得済みの分は再取得しない
+RETRIEVAL_PARAMS = {
+    "Wikipedia": (1, 2000),
+    "PubMed": (3, 3000),
+}
 
 
 def summarize_text(text: str) -> str:
     """
     入力テキストを要約する関数（azure_llmを利用）
+    同じ本文・同じプロンプト・同じデプロイの要約はディスクキャッシュから返す
     """
     try:
-        prompt = """
-You are an expert clinical geneticist and a diagnostician. Your critical task is to analyze a medical text and convert it into a high-yield, structured summary designed specifically for differential diagnosis. Your output must not only list symptoms but also highlight features that distinguish the condition from its clinical mimics.
+        prompt_template = prompt_dict["summarize_prompt"]
+        llm = get_azure_llm()
 
-Instructions:
+        def summarize():
+            summary_msg = llm.generate(prompt_template + text)
+            summary = summary_msg.content if hasattr(summary_msg, "content") else str(summary_msg)
+            return summary.strip()
 
-From the text I provide, generate a summary strictly following these rules:
+        return cached_summary(prompt_template, text, llm.deployment_name, summarize)
+    except Exception as e:
+        print(f"要約時にエラー: {e}")
+        return text  
 
-1. Information to Extract (Include ONLY these):
+async def asummarize_text(text: str) -> str:
+    """
+    summarize_text の非同期版
+    """
+    try:
+        prompt_template = prompt_dict["summarize_prompt"]
+        llm = get_azure_llm()
 
-Disease: The name of the syndrome or disorder.
+        async def summarize():
+            summary_msg = await llm.agenerate(prompt_template + text)
+            summary = summary_msg.content if hasattr(summary_msg, "content") else str(summary_msg)
+            return summary.strip()
 
-Genetics: The causative gene(s) and inheritance pattern. If not specified, state "Not specified".
+        return await acached_summary(prompt_template, text, llm.deployment_name, summarize)
+    except Exception as e:
+        print(f"要約時にエラー: {e}")
+        return text
 
-Key Phenotypes: A concise, bulleted list of the core clinical features and symptoms.
+def fetch_documents(source: str, name: str, offset: int, limit: int, chars_max: int) -> List[Dict[str, str]]:
+    """
+    1つの情報源の検索結果の offset 件目から limit 件を取得し、{"url", "title", "page_content"} のリストで返す
+    """
+    if source == "Wikipedia":
+        return wikipedia_page(name, offset, limit, chars_max)
+    if source == "PubMed":
+        return pubmed_page(name, offset, limit, chars_max)
+    raise ValueError(f"unknown source: {source}")
 
-Differentiating Features: This is the most critical section. Extract features that are particularly useful for distinguishing this syndrome from others. This includes:
 
-Hallmark signs: Features that are highly characteristic or pathognomonic.
+async def afetch_documents(source: str, name: str, offset: int, limit: int, chars_max: int) -> List[Dict[str, str]]:
+    """
+    fetch_documents の非同期版
+    """
+    if source == "Wikipedia":
+        return await awikipedia_page(name, offset, limit, chars_max)
+    if source == "PubMed":
+        return await apubmed_page(name, offset, limit, chars_max)
+    raise ValueError(f"unknown source: {source}")
 
-Key negative findings: Symptoms typically ABSENT in this condition but present in similar ones (e.g., "Absence of hyperphagia").
 
-Unique constellations: A specific combination of symptoms that points strongly to this diagnosis.
+def retrieval_window(source: str, search_depth: int, cursor: int = 0):
+    """
+    検索深度に対応する取得範囲 (offset, limit) を返す。cursor件目までは前のループで取得済み
+    """
+    if source not in RETRIEVAL_PARAMS:
+        raise ValueError(f"unknown source: {source}")
+    depth_factor, _ = RETRIEVAL_PARAMS[source]
+    return cursor, max(search_depth * depth_factor - cursor, 0)
 
-2. Information to Exclude (Strictly Omit):
 
-Patient case histories, family origins, or demographic details.
+def retrieve_documents(source: str, name: str, search_depth: int, cursor: int = 0) -> List[Dict[str, str]]:
+    """
+    1つの情報源から1疾患分の文書のうち、cursor件目以降で検索深度に対応する分だけを取得する。
+    同じ (情報源, 疾患名, offset, 件数, 文字数上限) の結果はディスクキャッシュから返し、ネットワークに問い合わせない
+    """
+    offset, limit = retrieval_window(source, search_depth, cursor)
+    if limit == 0:
+        return []
+    _, chars_max = RETRIEVAL_PARAMS[source]
+    return cached_retrieval(
+        source, name, offset, limit, chars_max,
+        lambda: fetch_documents(source, name, offset, limit, chars_max)
+    )
 
-Treatment, management, or therapeutic strategies.
 
-Research methodology, study populations, or author details.
+async def aretrieve_documents(source: str, name: str, search_depth: int, cursor: int = 0) -> List[Dict[str, str]]:
+    """
+    retrieve_documents の非同期版
+    """
+    offset, limit = retrieval_window(source, search_depth, cursor)
+    if limit == 0:
+        return []
+    _, chars_max = RETRIEVAL_PARAMS[source]
+    return await acached_retrieval(
+        source, name, offset, limit, chars_max,
+        lambda: afetch_documents(source, name, offset, limit, chars_max)
+    )
 
-Prognosis, mortality, or prevalence statistics.
 
-General background information that isn't a clinical feature.
+def cursor_key(source: str, name: str) -> str:
+    """
+    State["retrievalCursors"] のキー（疾患名の大文字小文字・空白の違いは同一視する）
+    """
+    return f"{source}:{' '.join(name.lower().split())}"
 
-3. Output Format (Use this exact structure):
 
-Disease: [Name of the disease]
-Genetics: [Gene(s), Inheritance pattern]
-Key Phenotypes:
+def _search_targets(state: State):
+    """
+    Stateから (memory, cursors, 検索深度, {対象疾患名: OMIM ID}) を取り出す（対象がなければ空のdict）
+    """
+    # Stateから必要な情報を取得
+    tentativeDiagnosis = state.get("tentativeDiagnosis")
+    search_depth = state.get("depth", 1)
+    
+    # 既存のmemory（URL・疾患の索引付き）を複製して使う
+    memory = EvidenceStore(state.get("memory") or [])
+    cursors = dict(state.get("retrievalCursors") or {})
 
-[Bulleted list of core clinical features]
+    if not tentativeDiagnosis or not hasattr(tentativeDiagnosis, "ans"):
+        print("暫定診断が見つからないため、検索をスキップします。")
+        return memory, cursors, search_depth, {}
 
-[Example: Intellectual disability]
+    targets = {diag.disease_name: getattr(diag, "OMIM_id", None) for diag in tentativeDiagnosis.ans}
+    if not targets:
+        print("検索対象の疾患名がないため、スキップします。")
+    return memory, cursors, search_depth, targets
 
-[Example: Craniofacial dysmorphism]
-Differentiating Features:
 
-Hallmark(s): [List highly specific or unique signs.]
+def _next_window(cursors, source, name, search_depth):
+    cursor = cursors.get(cursor_key(source, name), 0)
+    offset, limit = retrieval_window(source, search_depth, cursor)
+    if limit:
+        print(f"    - [{source}] 「{name}」を検索中 ({offset + 1}〜{offset + limit}件目)...")
+    return cursor, offset + limit
 
-Key Negative Finding(s): [List what is typically absent, e.g., "Absence of..."]
 
-Unique Constellation: [Describe a diagnostically powerful combination of symptoms.]
+class _SummaryPlan:
+    """
+    取得した文書ごとに、要約するか既存の要約を使うかを決める。
+    タイトル＋本文のSimHashがmemoryの根拠と近似重複なら、その要約を使う（LLMを呼ばない）。
+    今回取得した文書同士の近似重複は、すべての検索が終わってから (情報源, 疾患, 文書) の順で最初の文書（代表）の
+    要約を共有するように決める（memoryの内容が検索の完了順に依存しないように）。
+    要約は取得できた文書から先に始め、近似重複の代表が後から届いた場合だけ代表の要約を追加で行う。
+    本文が短い文書（SimHashがNone）は常に要約する。
+    """
 
-Now, process the following text:
+    def __init__(self, memory: EvidenceStore):
+        self.memory = memory
+        self.fingerprints = {}  # URL -> SimHash（本文が短い文書はNone）
+        self.reused = {}        # URL -> memoryにある要約
+        self.aliases = {}       # URL -> 要約を共有する代表の文書のURL
+        self.started = []       # 要約を始めた文書のURL
+
+    def _similar(self, url, other) -> bool:
+        a, b = self.fingerprints[url], self.fingerprints[other]
+        return a is not None and b is not None and is_near_duplicate(a, b)
+
+    def needs_summary(self, doc) -> bool:
+        """
+        取得できた文書の要約をすぐに始めるか（近似重複の文書をすでに要約中なら、代表が決まるまで待つ）
+        """
+        url = doc["url"]
+        if url in self.memory.urls or url in self.fingerprints:
+            return False
+        doc_fingerprint = fingerprint(doc["title"], doc["page_content"])
+        self.fingerprints[url] = doc_fingerprint
+        if doc_fingerprint is not None:
+            existing = self.memory.near_duplicate(doc_fingerprint)
+            if existing is not None:
+                print(f"      - 近似重複のため既存の要約を使用: {url} ≈ {existing['url']}")
+                self.reused[url] = summary_text(existing)
+                return False
+            if any(self._similar(url, other) for other in self.started):
+                return False
+        self.started.append(url)
+        return True
+
+    def resolve(self, tasks, documents) -> list:
+        """
+        すべての検索が終わってから近似重複の代表を (情報源, 疾患, 文書) の順で決め、まだ要約していない代表の文書を返す
+        """
+        canonical = {}
+        for key in tasks:
+            for doc in documents[key]:
+                url = doc["url"]
+                if url not in self.fingerprints or url in self.reused or url in self.aliases or url in canonical:
+                    continue
+                other = next((c for c in canonical if self._similar(url, c)), None)
+                if other is None:
+                    canonical[url] = doc
+                else:
+                    print(f"      - 近似重複のため要約を共有: {url} ≈ {other}")
+                    self.aliases[url] = other
+        started = set(self.started)
+        return [doc for url, doc in canonical.items() if url not in started]
+
+    def summary_of(self, url, summaries) -> str:
+        if url in self.reused:
+            return self.reused[url]
+        return summaries[self.aliases.get(url, url)].result()
+
+
+def _append_documents(memory, targets, tasks, documents, plan, summaries):
+    # 追加順と重複排除は(情報源, 疾患, 文書)の順で決める
+    # 同じ疾患に近似重複の根拠があれば追加しない（別の疾患の根拠としては要約を共有して追加する）
+    for source, name in tasks:
+        for doc in documents[(source, name)]:
+            url = doc["url"]
+            if url not in plan.fingerprints:
+                continue
+            item = {
+                "title": doc["title"],
+                "url": url,
+                "content": f"[Source: {source}] {plan.summary_of(url, summaries)}",
+                "disease_name": name,
+                "omim_id": targets.get(name),
+            }
+            if plan.fingerprints[url] is not None:
+                item["simhash"] = format(plan.fingerprints[url], "016x")
+            added = memory.add(item)
+            if added:
+                print(f"      - 新規情報を追加: {url}")
 
-""" + text  
-        summary_msg = azure_llm.generate(prompt)
-        summary = summary_msg.content if hasattr(summary_msg, "content") else str(summary_msg)
-        return summary.strip()
-    except Exception as e:
-        print(f"要約時にエラー: {e}")
-        return text  
 
 def diseaseSearchForDiagnosis(state: State) -> Dict[str, List[InformationItem]]:
     """
     暫定診断リストの各疾患について知識検索を実行し、重複を避けながらStateのmemoryに結果を追加する。
+    検索は(情報源, 疾患)ごとに並列に行い、取得できた文書から順に要約を並列実行する。
+    memoryへの追加順・URLの重複排除は従来どおり (Wikipedia→PubMed, 疾患順, 文書順) で決定的に行う。
+    タイトル＋本文のSimHashが既存の根拠・他の文書と近似重複する文書は代表の要約を使い、同じ疾患の根拠としては追加しない。
+    (疾患, 情報源)ごとの取得済み件数を retrievalCursors に記録し、深いループでは次のページだけを取得する。
     """
     print("🔬 知識検索を開始します...")
-    
-    # Stateから必要な情報を取得
-    tentativeDiagnosis = state.get("tentativeDiagnosis")
-    search_depth = state.get("depth", 1)
-    
-    # 既存のmemoryと、そこに含まれるURLのセットを取得
-    memory = state.get("memory", [])
-    retrieved_urls = {item['url'] for item in memory}
-
-    if not tentativeDiagnosis or not hasattr(tentativeDiagnosis, "ans"):
-        print("暫定診断が見つからないため、検索をスキップします。")
+    memory, cursors, search_depth, targets = _search_targets(state)
+    if not targets:
         # 変更がない場合でも、現在のmemoryを返すのが安全
-        return {"memory": memory}
-
-    disease_names = [diag.disease_name for diag in tentativeDiagnosis.ans]
-    if not disease_names:
-        print("検索対象の疾患名がないため、スキップします。")
-        return {"memory": memory}
+        return {"memory": memory, "retrievalCursors": cursors}
+
+    print(f"  - 検索深度: {search_depth}, 対象疾患: {list(targets)}")
+
+    tasks = [(source, name) for source in SOURCES for name in targets]
+    plan = _SummaryPlan(memory)
+
+    def retrieve(source, name):
+        # 情報源・疾患ごとにエラーを切り離す（1件の失敗で他の検索を止めない）
+        # 失敗した場合はcursorを進めず、次のループで同じページを取り直す
+        cursor, next_cursor = _next_window(cursors, source, name, search_depth)
+        if next_cursor == cursor:
+            return [], cursor
+        try:
+            return retrieve_documents(source, name, search_depth, cursor), next_cursor
+        except Exception as e:
+            print(f"    - [{source}] 「{name}」の検索でエラーが発生しました: {e}")
+            return [], cursor
+
+    documents = {}
+    summaries = {}
+    with ThreadPoolExecutor(max_workers=SEARCH_MAX_WORKERS) as search_pool, \
+            ThreadPoolExecutor(max_workers=SUMMARY_MAX_WORKERS) as summary_pool:
+        futures = {submit_with_context(search_pool, retrieve, source, name): (source, name) for source, name in tasks}
+        # 取得できた文書から順に要約を開始する（同じURL・近似重複の本文は1回だけ要約）
+        for future in as_completed(futures):
+            docs, next_cursor = future.result()
+            source, name = futures[future]
+            documents[(source, name)] = docs
+            cursors[cursor_key(source, name)] = next_cursor
+            for doc in docs:
+                if plan.needs_summary(doc):
+                    summaries[doc["url"]] = submit_with_context(summary_pool, summarize_text, doc["page_content"])
+        for doc in plan.resolve(tasks, documents):
+            summaries[doc["url"]] = submit_with_context(summary_pool, summarize_text, doc["page_content"])
+
+        _append_documents(memory, targets, tasks, documents, plan, summaries)
+            
+    print("✅ 知識検索が完了しました。")
+    
+    return {"memory": memory, "retrievalCursors": cursors}
 
-    print(f"  - 検索深度: {search_depth}, 対象疾患: {disease_names}")
 
-    # --- Wikipediaからの情報取得 ---
-    try:
-        wiki_retriever = WikipediaRetriever(top_k_results=search_depth * 1, doc_content_chars_max=2000)
-        for name in disease_names:
-            print(f"    - [Wikipedia] 「{name}」を検索中...")
-            wiki_docs = wiki_retriever.invoke(name)
-            
-            for doc in wiki_docs:
-                url = doc.metadata.get("source", "N/A")
-                if url not in retrieved_urls:
-                    print(f"      - 新規情報を追加: {url}")
-                    summary = summarize_text(doc.page_content)
-                    memory.append({
-                        "title": doc.metadata.get("title", name),
-                        "url": url,
-                        "content": f"[Source: Wikipedia] {summary}",
-                        "disease_name": name
-                    })
-                    retrieved_urls.add(url)
-    except Exception as e:
-        print(f"    - [Wikipedia] 検索でエラーが発生しました: {e}")
+async def adiseaseSearchForDiagnosis(state: State) -> Dict[str, List[InformationItem]]:
+    """
+    diseaseSearchForDiagnosis の非同期版。
+    検索・要約はタスクとして同時に実行し、同時実行数はSEARCH_MAX_WORKERS/SUMMARY_MAX_WORKERSで制限する
+    """
+    print("🔬 知識検索を開始します...")
+    memory, cursors, search_depth, targets = _search_targets(state)
+    if not targets:
+        return {"memory": memory, "retrievalCursors": cursors}
+
+    print(f"  - 検索深度: {search_depth}, 対象疾患: {list(targets)}")
+
+    tasks = [(source, name) for source in SOURCES for name in targets]
+    plan = _SummaryPlan(memory)
+    search_slots = asyncio.Semaphore(SEARCH_MAX_WORKERS)
+    summary_slots = asyncio.Semaphore(SUMMARY_MAX_WORKERS)
+
+    async def retrieve(source, name):
+        cursor, next_cursor = _next_window(cursors, source, name, search_depth)
+        if next_cursor == cursor:
+            return source, name, [], cursor
+        try:
+            async with search_slots:
+                return source, name, await aretrieve_documents(source, name, search_depth, cursor), next_cursor
+        except Exception as e:
+            print(f"    - [{source}] 「{name}」の検索でエラーが発生しました: {e}")
+            return source, name, [], cursor
+
+    async def summarize(text):
+        async with summary_slots:
+            return await asummarize_text(text)
+
+    documents = {}
+    summaries = {}
+    # 取得できた文書から順に要約を開始する（同じURL・近似重複の本文は1回だけ要約）
+    for finished in asyncio.as_completed([retrieve(source, name) for source, name in tasks]):
+        source, name, docs, next_cursor = await finished
+        documents[(source, name)] = docs
+        cursors[cursor_key(source, name)] = next_cursor
+        for doc in docs:
+            if plan.needs_summary(doc):
+                summaries[doc["url"]] = asyncio.ensure_future(summarize(doc["page_content"]))
+    for doc in plan.resolve(tasks, documents):
+        summaries[doc["url"]] = asyncio.ensure_future(summarize(doc["page_content"]))
+    if summaries:
+        await asyncio.gather(*summaries.values())
+
+    _append_documents(memory, targets, tasks, documents, plan, summaries)
 
-    # --- PubMedからの情報取得 ---
-    try:
-        pubmed_retriever = PubMedRetriever(top_k_results=search_depth * 3, doc_content_chars_max=3000)
-        for name in disease_names:
-            print(f"    - [PubMed] 「{name}」を検索中...")
-            pubmed_docs = pubmed_retriever.invoke(name)
-
-            for doc in pubmed_docs:
-                url = f"https://pubmed.ncbi.nlm.nih.gov/{doc.metadata['uid']}/"
-                if url not in retrieved_urls:
-                    print(f"      - 新規情報を追加: {url}")
-                    summary = summarize_text(doc.page_content)
-                    memory.append({
-                        "title": doc.metadata.get("Title", name),
-                        "url": url,
-                        "content": f"[Source: PubMed] {summary}",
-                        "disease_name": name  
-                    })
-                    retrieved_urls.add(url)
-    except Exception as e:
-        print(f"    - [PubMed] 検索でエラーが発生しました: {e}")
-            
     print("✅ 知識検索が完了しました。")
-    
-    return {"memory": memory}
-    
\ No newline at end of file
+
+    return {"memory": memory, "retrievalCursors": cursors}
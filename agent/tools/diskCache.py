@@ -0,0 +1,109 @@
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+from ..metrics import record_cache
+
+# キャッシュの保存先（ログと同様にカレントディレクトリ配下）
+CACHE_DIR = os.environ.get("ZEBRASEEK_CACHE_DIR", os.path.join(os.getcwd(), "cache"))
+
+
+def content_hash(*parts) -> str:
+    """
+    キャッシュキー用のSHA-256（各要素を区切って連結したもののハッシュ）
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        h.update(len(part).to_bytes(8, "little"))
+        h.update(part)
+    return h.hexdigest()
+
+
+class DiskCache:
+    """
+    SQLiteを使ったキー・値キャッシュ。
+    値はJSONで保存し、ttl秒を過ぎたエントリは読み出し時に破棄、
+    合計サイズがmax_bytesを超えたら最終アクセスが古い順に削除する（LRU）
+    """
+
+    def __init__(self, db_path: str, max_bytes: int = None, ttl: float = None):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # メトリクスのラベル（ファイル名）
+        self.name = os.path.splitext(os.path.basename(db_path))[0]
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY, value TEXT, size INTEGER,
+                created REAL, accessed REAL
+            );
+            CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+        """)
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                record_cache(self.name, False)
+                return None
+            if self.ttl is not None and now - row[1] > self.ttl:
+                with self._conn:
+                    self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                record_cache(self.name, False)
+                return None
+            with self._conn:
+                self._conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            self.stats["hits"] += 1
+        record_cache(self.name, True)
+        return json.loads(row[0])
+
+    def put(self, key: str, value):
+        data = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                    (key, data, len(data.encode("utf-8")), now, now)
+                )
+                self._evict()
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._conn.execute("SELECT key, size FROM entries ORDER BY accessed").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM entries")
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            row = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        stats["entries"], stats["bytes"] = row
+        return stats
@@ -0,0 +1,136 @@
+import os
+import re
+import hashlib
+from collections import Counter
+
+# SimHash（64bit）のハミング距離がこれ以下の文書を近似重複とみなす
+EVIDENCE_SIMHASH_DISTANCE = int(os.environ.get("EVIDENCE_SIMHASH_DISTANCE", "3"))
+# SimHashの特徴量にする単語n-gramの長さ
+SIMHASH_SHINGLE = 3
+# 本文の単語n-gramがこれより少ない文書（"No abstract available" などの定型文・短い本文）は近似重複を判定しない
+SIMHASH_MIN_SHINGLES = int(os.environ.get("SIMHASH_MIN_SHINGLES", "20"))
+
+_WORD = re.compile(r"\w+")
+_SOURCE_PREFIX = re.compile(r"^\[Source: [^\]]*\] ")
+
+
+def _shingles(text: str) -> Counter:
+    words = _WORD.findall(text.lower())
+    return Counter(" ".join(words[i:i + SIMHASH_SHINGLE]) for i in range(max(len(words) - SIMHASH_SHINGLE + 1, 1)))
+
+
+def simhash(text: str) -> int:
+    """
+    本文の単語3-gramから64bitのSimHashを計算する（ミラーサイトや転載など、ほぼ同じ本文は近い値になる）
+    """
+    shingles = _shingles(text)
+    weights = [0] * 64
+    for shingle, count in shingles.items():
+        h = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += count if h >> bit & 1 else -count
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+def fingerprint(title: str, text: str):
+    """
+    文書（タイトル＋本文）のSimHash。本文が短すぎて判定できない場合はNone（近似重複として扱わない）
+    """
+    if sum(_shingles(text).values()) < SIMHASH_MIN_SHINGLES:
+        return None
+    return simhash(f"{title}\n{text}")
+
+
+def is_near_duplicate(a: int, b: int) -> bool:
+    return bin(a ^ b).count("1") <= EVIDENCE_SIMHASH_DISTANCE
+
+
+def disease_keys(disease_name: str = None, omim_id: str = None) -> list:
+    """
+    索引のキー（OMIM IDと、大文字小文字・空白を無視した疾患名）
+    """
+    keys = []
+    if omim_id:
+        keys.append(f"omim:{omim_id}")
+    if disease_name:
+        keys.append(f"name:{' '.join(disease_name.lower().split())}")
+    return keys
+
+
+def summary_text(item: dict) -> str:
+    # memoryのcontentは "[Source: 情報源] 要約" の形式
+    return _SOURCE_PREFIX.sub("", item.get("content", ""))
+
+
+class EvidenceStore(list):
+    """
+    State["memory"] の根拠（InformationItem）のリスト。
+    listとしてそのまま使えるが、URL・疾患（OMIM ID / 疾患名）の索引と、
+    元の本文のSimHash（item["simhash"]、16進文字列）による近似重複の検出を持つ
+    """
+
+    def __init__(self, items=()):
+        super().__init__()
+        self.urls = set()
+        self._by_key = {}
+        self._fingerprints = []  # (simhash, 位置)
+        for item in items:
+            self.append(item)
+
+    @classmethod
+    def of(cls, items) -> "EvidenceStore":
+        """
+        EvidenceStoreならそのまま、通常のリスト（旧形式のstate等）なら索引を作って返す
+        """
+        return items if isinstance(items, cls) else cls(items or [])
+
+    def __reduce__(self):
+        # copy/pickle では索引を作り直す（list の既定の方法だと索引が元のオブジェクトと共有される）
+        return (self.__class__, (list(self),))
+
+    def append(self, item):
+        # 重複の判定をせずに追加する（索引は更新する）
+        super().append(item)
+        position = len(self)
+        self.urls.add(item["url"])
+        for key in disease_keys(item.get("disease_name"), item.get("omim_id")):
+            self._by_key.setdefault(key, []).append(position)
+        if item.get("simhash"):
+            self._fingerprints.append((int(item["simhash"], 16), position))
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def near_duplicate(self, fingerprint: int, disease_name: str = None, omim_id: str = None):
+        """
+        近似重複の根拠を返す（疾患を指定した場合はその疾患の根拠だけを見る）。なければNone
+        """
+        positions = set(self._positions(disease_name, omim_id)) if disease_name or omim_id else None
+        for other, position in self._fingerprints:
+            if (positions is None or position in positions) and is_near_duplicate(fingerprint, other):
+                return self[position - 1]
+        return None
+
+    def add(self, item) -> bool:
+        """
+        同じURL、または同じ疾患に近似重複の根拠がある場合は追加せずFalseを返す
+        """
+        if item["url"] in self.urls:
+            return False
+        if item.get("simhash") and self.near_duplicate(int(item["simhash"], 16), item.get("disease_name"), item.get("omim_id")):
+            return False
+        self.append(item)
+        return True
+
+    def _positions(self, disease_name: str = None, omim_id: str = None):
+        positions = set()
+        for key in disease_keys(disease_name, omim_id):
+            positions.update(self._by_key.get(key, ()))
+        return sorted(positions)
+
+    def for_disease(self, disease_name: str, omim_id: str = None) -> list:
+        """
+        疾患の根拠を [(リスト内の位置(1始まり), item), ...] で返す（位置はプロンプトの引用番号になる）
+        """
+        return [(position, self[position - 1]) for position in self._positions(disease_name, omim_id)]
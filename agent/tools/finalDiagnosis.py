@@ -1,13 +1,13 @@
-from langchain.schema import HumanMessage
 from typing_extensions import Optional
 from ..state.state_types import State, DiagnosisOutput
 from ..llm.prompt import prompt_dict, build_prompt
-from ..llm.azure_llm_instance import azure_llm
+from ..llm.azure_llm_instance import get_azure_llm
+from .contextPacking import pack_evidence, relevance, FINAL_EVIDENCE_TOKENS
 
 
-def createFinalDiagnosis(state: State) -> Optional[DiagnosisOutput]:
+def build_final_diagnosis_prompt(state: State) -> str:
     """
-    Generate FinalDiagnosis using State, prompt, and DiagnosisOutput
+    Build the FinalDiagnosis prompt from State
     """
    
     hpo_dict = state.get("hpoDict", {})
@@ -28,13 +28,24 @@ def createFinalDiagnosis(state: State) -> Optional[DiagnosisOutput]:
     else:
         tentative_result_str = ""
 
+    hpo_terms = list(hpo_dict.values()) if hpo_dict else []
+    budget = FINAL_EVIDENCE_TOKENS
+
     # Format reflection (ReflectionOutput type or None) as string, including reference
+    # Judgements and similar cases share the FINAL_EVIDENCE_TOKENS budget; judgements marked correct are packed first
     if judgements is not None and hasattr(judgements, "ans"):
-        judgements_str = "\n".join([
-            f"{i+1}. {getattr(item, 'disease_name', '')}\nCorrectness: {getattr(item, 'Correctness', '')}\nPatientSummary: {getattr(item, 'PatientSummary', '')}\nDiagnosisAnalysis: {getattr(item, 'DiagnosisAnalysis', '')}\nReference: {getattr(item, 'reference', '')}"
-            for i, item in enumerate(judgements.ans)
-        ])
-       
+        def render_judgement(indexed):
+            i, item = indexed
+            return f"{i}. {getattr(item, 'disease_name', '')}\nCorrectness: {getattr(item, 'Correctness', '')}\nPatientSummary: {getattr(item, 'PatientSummary', '')}\nDiagnosisAnalysis: {getattr(item, 'DiagnosisAnalysis', '')}\nReference: {getattr(item, 'reference', '')}"
+
+        packed = pack_evidence(
+            list(enumerate(judgements.ans, 1)), render_judgement, budget, "final_diagnosis",
+            score=lambda indexed, text: (2.0 if getattr(indexed[1], "Correctness", False) else 0.0) + relevance(text, hpo_terms=hpo_terms)
+        )
+        judgements_str = "\n".join(packed.texts)
+        if budget is not None:
+            budget = max(budget - packed.tokens, 0)
+
         if hasattr(judgements, "reference") and judgements.reference:
             judgements_str += f"\n[ReflectionOutput Reference]: {judgements.reference}"
     else:
@@ -43,9 +54,10 @@ def createFinalDiagnosis(state: State) -> Optional[DiagnosisOutput]:
     present_hpo = ", ".join([v for k, v in hpo_dict.items()]) if hpo_dict else ""
     absent_hpo = ", ".join([v for k, v in (absent_hpo_dict or {}).items()]) if absent_hpo_dict else ""
 
-    # If memory (similar_case_detailed) is a list, join as string
+    # If memory (similar_case_detailed) is a list, join as string (within the remaining budget)
     if isinstance(similar_case_detailed, list):
-        similar_case_detailed_str = "\n".join([str(item) for item in similar_case_detailed])
+        packed = pack_evidence(similar_case_detailed, str, budget, "final_diagnosis", hpo_terms=hpo_terms)
+        similar_case_detailed_str = "\n".join(packed.texts)
     else:
         similar_case_detailed_str = str(similar_case_detailed)
 
@@ -57,10 +69,30 @@ def createFinalDiagnosis(state: State) -> Optional[DiagnosisOutput]:
         "tentative_result": tentative_result_str,
         "judgements": judgements_str
     }
-    prompt = build_prompt(prompt_template, inputs)
-    
-    
+    return build_prompt(prompt_template, inputs)
+
+
+def createFinalDiagnosis(state: State) -> Optional[DiagnosisOutput]:
+    """
+    Generate FinalDiagnosis using State, prompt, and DiagnosisOutput
+    """
+    prompt = build_final_diagnosis_prompt(state)
+
+    from langchain.schema import HumanMessage
     messages = [HumanMessage(content=prompt)]
-    structured_llm = azure_llm.get_structured_llm(DiagnosisOutput)
+    structured_llm = get_azure_llm().get_structured_llm(DiagnosisOutput)
     result = structured_llm.invoke(messages)
-    return result, prompt
\ No newline at end of file
+    return result, prompt
+
+
+async def acreateFinalDiagnosis(state: State) -> Optional[DiagnosisOutput]:
+    """
+    Async version of createFinalDiagnosis
+    """
+    prompt = build_final_diagnosis_prompt(state)
+
+    from langchain.schema import HumanMessage
+    messages = [HumanMessage(content=prompt)]
+    structured_llm = get_azure_llm().get_structured_llm(DiagnosisOutput)
+    result = await structured_llm.ainvoke(messages)
+    return result, prompt
@@ -1,49 +1,178 @@
+import io
+import asyncio
 import base64
-import requests
+import hashlib
 import json
 import os
+import time
+import threading
 from dotenv import load_dotenv
+from ..lazy import lazy_singleton
+from .diskCache import DiskCache, CACHE_DIR, content_hash
+from . import httpClient
+from ..metrics import timed_call
 
 MAX_DISTANCE = 1.3
 
-def call_gestalt_matcher_api(image_path: str, depth: int):
+GM_API_URL = os.environ.get("GM_API_URL", "https://dev-pubcasefinder.dbcls.jp/gm_endpoint/predict")
+# アップロード前に長辺をこのピクセル数まで縮小する（0以下なら縮小しない）。顔の検出・整列には十分な解像度
+GM_MAX_IMAGE_SIDE = int(os.environ.get("GM_MAX_IMAGE_SIDE", "1024"))
+GM_JPEG_QUALITY = int(os.environ.get("GM_JPEG_QUALITY", "90"))
+# (接続, 読み込み) タイムアウト[秒]。推論に時間がかかるため読み込みは共通設定より長くする
+GM_CONNECT_TIMEOUT = float(os.environ.get("GM_CONNECT_TIMEOUT", "10"))
+GM_READ_TIMEOUT = float(os.environ.get("GM_READ_TIMEOUT", "120"))
+# JSON本体を組み立てずにchunkedで送る（サーバーがchunked転送に対応している場合のみ有効にする）
+GM_STREAM_UPLOAD = os.environ.get("GM_STREAM_UPLOAD", "0") == "1"
+# 結果キャッシュの有効期間（時間）。0以下なら期限なし
+GM_CACHE_TTL_HOURS = float(os.environ.get("GM_CACHE_TTL_HOURS", "720"))
+STREAM_CHUNK_SIZE = 3 * 2**16  # base64で区切れが出ないよう3の倍数
+
+_stats_lock = threading.Lock()
+_stats = {
+    "calls": 0, "cache_hits": 0, "uploads": 0,
+    "original_bytes": 0, "payload_bytes": 0, "upload_seconds": 0.0,
+}
+
+
+@lazy_singleton
+def get_gestalt_matcher_cache():
+    return DiskCache(
+        os.environ.get("GM_CACHE_DB", os.path.join(CACHE_DIR, "gestalt_matcher_cache.sqlite3")),
+        ttl=GM_CACHE_TTL_HOURS * 3600 if GM_CACHE_TTL_HOURS > 0 else None
+    )
+
+
+def _count(**values):
+    with _stats_lock:
+        for name, value in values.items():
+            _stats[name] += value
+
+
+def get_gestalt_matcher_stats() -> dict:
     """
-    画像ファイルのパスを受け取り、GestaltMatcher APIを叩いて
-    suggested_genes_listの上位(depth+2)件だけをリストで返す関数。
-    認証情報は環境変数 GESTALT_API_USER, GESTALT_API_PASS から取得
+    キャッシュのヒット率、アップロードしたペイロードのサイズ（縮小前後）と平均レイテンシ
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["hit_rate"] = stats["cache_hits"] / stats["calls"] if stats["calls"] else 0.0
+    stats["mean_payload_bytes"] = stats["payload_bytes"] / stats["uploads"] if stats["uploads"] else 0.0
+    stats["mean_upload_seconds"] = stats["upload_seconds"] / stats["uploads"] if stats["uploads"] else 0.0
+    return stats
 
-    Args:
-        image_path (str): 画像ファイルのパス
-        depth (int): 返す件数を決めるための基準
 
-    Returns:
-        list: suggested_genes_listの上位(depth+2)件
+def prepare_image(image_bytes: bytes) -> bytes:
+    """
+    長辺がGM_MAX_IMAGE_SIDEを超える画像を縮小してJPEGで再圧縮する。
+    Pillowがインストールされていない場合や、縮小しても小さくならない場合は元の画像をそのまま返す
+    """
+    if GM_MAX_IMAGE_SIDE <= 0:
+        return image_bytes
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return image_bytes
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            if max(image.size) <= GM_MAX_IMAGE_SIDE:
+                return image_bytes
+            # EXIFの回転情報を画素に反映してから縮小する（再圧縮でEXIFが失われるため）
+            image = ImageOps.exif_transpose(image).convert("RGB")
+            image.thumbnail((GM_MAX_IMAGE_SIDE, GM_MAX_IMAGE_SIDE), Image.LANCZOS)
+            out = io.BytesIO()
+            image.save(out, format="JPEG", quality=GM_JPEG_QUALITY, optimize=True)
+    except OSError as e:
+        print(f"[GestaltMatcher] Could not downscale image, uploading original: {e}")
+        return image_bytes
+    resized = out.getvalue()
+    return resized if len(resized) < len(image_bytes) else image_bytes
+
+
+def _stream_body(image_bytes: bytes):
+    # {"img": "<base64>"} を少しずつ生成する（巨大なJSON文字列をメモリ上に作らない）
+    yield b'{"img": "'
+    for start in range(0, len(image_bytes), STREAM_CHUNK_SIZE):
+        yield base64.b64encode(image_bytes[start:start + STREAM_CHUNK_SIZE])
+    yield b'"}'
+
+
+def _request_body(image_bytes: bytes):
+    if GM_STREAM_UPLOAD:
+        return _stream_body(image_bytes)
+    return json.dumps({"img": base64.b64encode(image_bytes).decode("utf-8")})
+
+
+def _post_image(image_bytes: bytes, username: str, password: str) -> dict:
+    headers = {"Content-Type": "application/json"}
+    # ストリーミング送信の場合は本体を再送できないため、httpClientは再試行しない
+    response = httpClient.post(
+        GM_API_URL,
+        headers=headers,
+        data=_request_body(image_bytes),
+        auth=(username, password),
+        timeout=(GM_CONNECT_TIMEOUT, GM_READ_TIMEOUT)
+    )
+
+    response.raise_for_status()
+    return response.json()
+
+
+async def _achunks(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+async def _apost_image(image_bytes: bytes, username: str, password: str) -> dict:
+    body = _request_body(image_bytes)
+    if not isinstance(body, str):
+        # httpx.AsyncClient には非同期イテレータで渡す
+        body = _achunks(body)
+    response = await httpClient.apost(
+        GM_API_URL,
+        headers={"Content-Type": "application/json"},
+        content=body,
+        auth=(username, password),
+        timeout=(GM_CONNECT_TIMEOUT, GM_READ_TIMEOUT)
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def top_syndromes(syndromes: list, depth: int):
+    """
+    候補リストのうち検索深度に応じた上位(depth+4)件を返す
     """
+    return syndromes[:depth + 4]
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _credentials():
     load_dotenv()
-    api_url = "https://dev-pubcasefinder.dbcls.jp/gm_endpoint/predict"
     username = os.environ.get("GESTALT_API_USER")
     password = os.environ.get("GESTALT_API_PASS")
     if not username or not password:
         raise ValueError("環境変数 GESTALT_API_USER または GESTALT_API_PASS が設定されていません。")
+    return username, password
 
-    with open(image_path, "rb") as f:
-        img_b64 = base64.b64encode(f.read()).decode("utf-8")
-
-    headers = {"Content-Type": "application/json"}
-    payload = {"img": img_b64}
 
-    response = requests.post(
-        api_url,
-        headers=headers,
-        data=json.dumps(payload),
-        auth=(username, password)
+def _cache_key(image_bytes: bytes) -> str:
+    return content_hash(
+        hashlib.sha256(image_bytes).hexdigest(), GM_API_URL, str(GM_MAX_IMAGE_SIDE), str(GM_JPEG_QUALITY)
     )
 
-    response.raise_for_status()
-    result = response.json()
-    syndromes = result.get("suggested_syndromes_list", [])
+
+def _record_upload(image_bytes: bytes, payload: bytes, elapsed: float):
+    _count(uploads=1, original_bytes=len(image_bytes), payload_bytes=len(payload), upload_seconds=elapsed)
+    print(f"[GestaltMatcher] uploaded {len(payload) / 1024:.0f} KiB (original {len(image_bytes) / 1024:.0f} KiB) in {elapsed:.2f}s")
+
+
+def _scored(syndromes: list, depth: int = None):
     # Return only the top depth + 4 items
-    syndromes = syndromes[:depth + 4]
+    if depth is not None:
+        syndromes = top_syndromes(syndromes, depth)
     # Remove distance and gestalt_score and replace with a single score value
     # New score is normalized to 0-1 range rather than 0-1.3 distance
 
@@ -55,6 +184,66 @@ def call_gestalt_matcher_api(image_path: str, depth: int):
         else:
             score = 0.0
         syndrome["score"] = score
-        
+
 
     return syndromes
+
+
+def call_gestalt_matcher_api(image_path: str, depth: int = None):
+    """
+    画像ファイルのパスを受け取り、GestaltMatcher APIを叩いて
+    suggested_genes_listの上位(depth+4)件だけをリストで返す関数。
+    depthがNoneの場合は全件を返す（ループごとの再送信を避けるため、呼び出し側でtop_syndromesで切り出す）。
+    結果は (画像のSHA-256, エンドポイント, 縮小設定) をキーにディスクキャッシュし、同じ写真は再送信しない。
+    認証情報は環境変数 GESTALT_API_USER, GESTALT_API_PASS から取得
+
+    Args:
+        image_path (str): 画像ファイルのパス
+        depth (int): 返す件数を決めるための基準（Noneなら全件）
+
+    Returns:
+        list: suggested_genes_listの上位(depth+4)件
+    """
+    username, password = _credentials()
+    image_bytes = _read_file(image_path)
+
+    _count(calls=1)
+    cache = get_gestalt_matcher_cache()
+    key = _cache_key(image_bytes)
+    syndromes = cache.get(key)
+    if syndromes is not None:
+        _count(cache_hits=1)
+    else:
+        payload = prepare_image(image_bytes)
+        start = time.perf_counter()
+        with timed_call("gestalt_matcher"):
+            result = _post_image(payload, username, password)
+        _record_upload(image_bytes, payload, time.perf_counter() - start)
+        syndromes = result.get("suggested_syndromes_list", [])
+        cache.put(key, syndromes)
+    return _scored(syndromes, depth)
+
+
+async def acall_gestalt_matcher_api(image_path: str, depth: int = None):
+    """
+    call_gestalt_matcher_api の非同期版（画像の読み込み・縮小はスレッドで実行する）
+    """
+    username, password = _credentials()
+
+    image_bytes = await asyncio.to_thread(_read_file, image_path)
+
+    _count(calls=1)
+    cache = get_gestalt_matcher_cache()
+    key = _cache_key(image_bytes)
+    syndromes = cache.get(key)
+    if syndromes is not None:
+        _count(cache_hits=1)
+    else:
+        payload = await asyncio.to_thread(prepare_image, image_bytes)
+        start = time.perf_counter()
+        with timed_call("gestalt_matcher"):
+            result = await _apost_image(payload, username, password)
+        _record_upload(image_bytes, payload, time.perf_counter() - start)
+        syndromes = result.get("suggested_syndromes_list", [])
+        cache.put(key, syndromes)
+    return _scored(syndromes, depth)
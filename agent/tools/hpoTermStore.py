@@ -0,0 +1,139 @@
+import os
+import json
+import shutil
+import numpy as np
+from ..lazy import lazy_singleton
+from .diskCache import CACHE_DIR
+from .normalizeCache import file_fingerprint
+
+PHENOTYPE_MAPPING_JSON = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "phenotype_mapping.json")
+HPO_PREFIX = "HP:"
+
+
+def parse_hpo_id(hpo_id: str):
+    """
+    "HP:0001263" -> 1263（形式が不正ならNone）
+    """
+    if not isinstance(hpo_id, str) or not hpo_id.startswith(HPO_PREFIX):
+        return None
+    try:
+        return int(hpo_id[len(HPO_PREFIX):])
+    except ValueError:
+        return None
+
+
+class HPOTermStore:
+    """
+    HPO ID -> ターム名 の読み取り専用ストア。
+    昇順に並べた整数IDの配列と、UTF-8ラベルを連結したblob（+オフセット）で保持し、
+    np.searchsorted でまとめて引く。バイナリとして保存すればmmapで複数プロセスから共有できる
+    """
+
+    FILES = ("ids.npy", "offsets.npy", "labels.bin")
+
+    def __init__(self, ids, offsets, blob):
+        self.ids = ids
+        self.offsets = offsets
+        self.blob = blob
+
+    @classmethod
+    def from_mapping(cls, mapping: dict):
+        entries = sorted(
+            (number, label) for number, label in
+            ((parse_hpo_id(hpo_id), label) for hpo_id, label in mapping.items())
+            if number is not None
+        )
+        encoded = [label.encode("utf-8") for _, label in entries]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+        ids = np.array([number for number, _ in entries], dtype=np.int64)
+        return cls(ids, offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+    @classmethod
+    def from_json(cls, path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls.from_mapping(json.load(f))
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "ids.npy"), self.ids)
+        np.save(os.path.join(directory, "offsets.npy"), self.offsets)
+        # labels.bin を最後に書く（存在すれば一式が揃っているとみなす）
+        with open(os.path.join(directory, "labels.bin"), "wb") as f:
+            f.write(self.blob.tobytes())
+
+    @classmethod
+    def load(cls, directory: str, mmap=True):
+        mode = "r" if mmap else None
+        labels_path = os.path.join(directory, "labels.bin")
+        if mmap and os.path.getsize(labels_path):
+            blob = np.memmap(labels_path, dtype=np.uint8, mode="r")
+        else:
+            blob = np.fromfile(labels_path, dtype=np.uint8)
+        return cls(
+            np.load(os.path.join(directory, "ids.npy"), mmap_mode=mode),
+            np.load(os.path.join(directory, "offsets.npy"), mmap_mode=mode),
+            blob,
+        )
+
+    @classmethod
+    def exists(cls, directory: str):
+        return all(os.path.exists(os.path.join(directory, name)) for name in cls.FILES)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _positions(self, hpo_ids):
+        numbers = np.array([parse_hpo_id(hpo_id) or -1 for hpo_id in hpo_ids], dtype=np.int64)
+        pos = np.searchsorted(self.ids, numbers)
+        pos = np.minimum(pos, max(len(self.ids) - 1, 0))
+        found = (self.ids[pos] == numbers) if len(self.ids) else np.zeros(len(numbers), dtype=bool)
+        return pos, found
+
+    def lookup_many(self, hpo_ids, default=""):
+        """
+        HPO IDのリストに対応するターム名のリストを返す（見つからないものはdefault）
+        """
+        if not hpo_ids:
+            return []
+        pos, found = self._positions(hpo_ids)
+        return [
+            bytes(self.blob[self.offsets[p]:self.offsets[p + 1]]).decode("utf-8") if ok else default
+            for p, ok in zip(pos, found)
+        ]
+
+    def label(self, hpo_id, default=""):
+        return self.lookup_many([hpo_id], default)[0]
+
+    def __contains__(self, hpo_id):
+        return bool(self._positions([hpo_id])[1][0])
+
+    def to_dict(self, hpo_ids):
+        return dict(zip(hpo_ids, self.lookup_many(list(hpo_ids))))
+
+
+@lazy_singleton
+def get_hpo_term_store():
+    """
+    プロセス全体で共有するHPOタームストア。
+    phenotype_mapping.json から作ったバイナリをキャッシュディレクトリに保存しておき、
+    以降のプロセスはそれをmmapで開く（JSONが更新されたら作り直す）
+    """
+    fingerprint = file_fingerprint(PHENOTYPE_MAPPING_JSON).replace(":", "_")
+    directory = os.path.join(CACHE_DIR, "hpo_terms", fingerprint)
+    if HPOTermStore.exists(directory):
+        try:
+            return HPOTermStore.load(directory)
+        except (OSError, ValueError) as e:
+            print(f"[HPOTermStore] Failed to load cached store, rebuilding: {e}")
+    store = HPOTermStore.from_json(PHENOTYPE_MAPPING_JSON)
+    # 一時ディレクトリに書いてからrenameし、他プロセスが書きかけのファイルを読まないようにする
+    tmp_directory = f"{directory}.tmp-{os.getpid()}"
+    try:
+        store.save(tmp_directory)
+        os.rename(tmp_directory, directory)
+    except OSError as e:
+        if not HPOTermStore.exists(directory):
+            print(f"[HPOTermStore] Could not write cache: {e}")
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+    return store
@@ -0,0 +1,159 @@
+import os
+import time
+import random
+import asyncio
+import threading
+import weakref
+import requests
+from requests.adapters import HTTPAdapter
+from ..lazy import lazy_singleton
+
+# 外部API（PubCaseFinder, GestaltMatcher, NCBI E-utilities）共通のHTTP設定
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "60"))
+HTTP_MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", "3"))
+HTTP_BACKOFF_BASE = float(os.environ.get("HTTP_BACKOFF_BASE", "0.5"))
+HTTP_BACKOFF_MAX = float(os.environ.get("HTTP_BACKOFF_MAX", "30"))
+# ホストごとに保持するkeep-alive接続数（並列検索のワーカー数以上にする）
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "16"))
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+def default_timeout():
+    return (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+
+def backoff_delay(attempt: int, retry_after=None) -> float:
+    """
+    attempt回目の再試行までの待ち時間（指数バックオフ + full jitter）。
+    サーバーがRetry-After（秒）を返した場合はそれ以上待つ
+    """
+    delay = random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt))
+    try:
+        return max(delay, min(float(retry_after), HTTP_BACKOFF_MAX))
+    except (TypeError, ValueError):
+        return delay
+
+
+def _replayable(kwargs) -> bool:
+    # ジェネレータ等で渡した本体は一度送ると再送できない
+    data = kwargs.get("data", kwargs.get("content"))
+    return data is None or isinstance(data, (str, bytes, dict, list, tuple))
+
+
+@lazy_singleton
+def get_session():
+    """
+    プロセス全体で共有する requests.Session（接続プールとkeep-aliveでTCP/TLSの確立を省く）
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def request(method: str, url: str, timeout=None, max_retries: int = None, **kwargs) -> requests.Response:
+    """
+    共有セッションでリクエストを送る。接続エラー・タイムアウト・429/5xxはジッター付きで再試行し、
+    再試行しきれなかった場合は最後のレスポンスを返す（raise_for_statusは呼び出し側で行う）
+    """
+    timeout = timeout or default_timeout()
+    max_retries = HTTP_MAX_RETRIES if max_retries is None else max_retries
+    if not _replayable(kwargs):
+        max_retries = 0
+    for attempt in range(max_retries + 1):
+        try:
+            response = get_session().request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= max_retries:
+                raise
+            delay = backoff_delay(attempt)
+            print(f"[HTTP] {method} {url.split('?')[0]} failed ({e.__class__.__name__}), retrying in {delay:.2f}s...")
+        else:
+            if response.status_code not in RETRY_STATUS or attempt >= max_retries:
+                return response
+            delay = backoff_delay(attempt, response.headers.get("Retry-After"))
+            print(f"[HTTP] {method} {url.split('?')[0]} returned {response.status_code}, retrying in {delay:.2f}s...")
+            response.close()
+        time.sleep(delay)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+
+# httpx.AsyncClient はイベントループに紐づくため、ループごとに1つ作る
+_async_clients = weakref.WeakKeyDictionary()
+_async_clients_lock = threading.Lock()
+
+
+def get_async_client():
+    """
+    実行中のイベントループで共有する httpx.AsyncClient
+    """
+    import httpx
+
+    loop = asyncio.get_running_loop()
+    with _async_clients_lock:
+        client = _async_clients.get(loop)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE),
+            )
+            _async_clients[loop] = client
+    return client
+
+
+async def arequest(method: str, url: str, timeout=None, max_retries: int = None, **kwargs):
+    """
+    request() の非同期版（httpx）。引数は httpx.AsyncClient.request に渡す
+    """
+    import httpx
+
+    if timeout is not None and isinstance(timeout, tuple):
+        timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+    if timeout is not None:
+        kwargs["timeout"] = timeout
+    max_retries = HTTP_MAX_RETRIES if max_retries is None else max_retries
+    if not _replayable(kwargs):
+        max_retries = 0
+    client = get_async_client()
+    for attempt in range(max_retries + 1):
+        try:
+            response = await client.request(method, url, **kwargs)
+        except (httpx.ConnectError, httpx.TimeoutException, httpx.RemoteProtocolError) as e:
+            if attempt >= max_retries:
+                raise
+            delay = backoff_delay(attempt)
+            print(f"[HTTP] {method} {url.split('?')[0]} failed ({e.__class__.__name__}), retrying in {delay:.2f}s...")
+        else:
+            if response.status_code not in RETRY_STATUS or attempt >= max_retries:
+                return response
+            delay = backoff_delay(attempt, response.headers.get("Retry-After"))
+            print(f"[HTTP] {method} {url.split('?')[0]} returned {response.status_code}, retrying in {delay:.2f}s...")
+            await response.aclose()
+        await asyncio.sleep(delay)
+
+
+async def aget(url: str, **kwargs):
+    return await arequest("GET", url, **kwargs)
+
+
+async def apost(url: str, **kwargs):
+    return await arequest("POST", url, **kwargs)
+
+
+async def aclose_async_client():
+    """
+    実行中のイベントループのクライアントを閉じる（ループを終了する前に呼ぶ）
+    """
+    with _async_clients_lock:
+        client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
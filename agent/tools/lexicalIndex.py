@@ -0,0 +1,148 @@
+import re
+import math
+from collections import defaultdict
+
+# ローマ数字 -> アラビア数字（疾患の型番号用）
+ROMAN_NUMERALS = {
+    "i": "1", "ii": "2", "iii": "3", "iv": "4", "v": "5", "vi": "6", "vii": "7",
+    "viii": "8", "ix": "9", "x": "10", "xi": "11", "xii": "12", "xiii": "13",
+    "xiv": "14", "xv": "15", "xvi": "16", "xvii": "17", "xviii": "18", "xix": "19", "xx": "20",
+}
+# 1文字のローマ数字は "type" の直後か末尾の場合のみ変換する（"X-linked" などを誤変換しないため）
+AMBIGUOUS_ROMAN = {"i", "v", "x"}
+# 照合時に無視するトークン
+STOP_TOKENS = {"type", "the", "of", "and", "with", "or", "to"}
+# あいまい一致で採用する最低スコア
+FUZZY_THRESHOLD = 0.9
+
+_NON_ALNUM = re.compile(r"[^0-9a-z]+")
+
+
+def tokenize(text: str):
+    """
+    疾患名を照合用トークン列に変換する
+    （小文字化・記号除去・ローマ数字のアラビア数字化・"type"等の除去）
+    """
+    raw = _NON_ALNUM.sub(" ", text.casefold()).split()
+    tokens = []
+    for i, tok in enumerate(raw):
+        if tok in ROMAN_NUMERALS:
+            if tok not in AMBIGUOUS_ROMAN or (i > 0 and raw[i - 1] == "type") or i == len(raw) - 1:
+                tok = ROMAN_NUMERALS[tok]
+        if tok in STOP_TOKENS:
+            continue
+        tokens.append(tok)
+    return tokens
+
+
+def canonicalize(text: str) -> str:
+    return " ".join(tokenize(text))
+
+
+def label_variants(label: str):
+    """
+    OMIMラベルから照合用の表記を列挙する。
+    "SPASTIC PARAPLEGIA 25, AUTOSOMAL RECESSIVE; SPG25" のように ';' 以降は略称として扱う
+    """
+    parts = [p.strip() for p in label.split(";") if p.strip()]
+    return parts or [label]
+
+
+class LexicalIndex:
+    """
+    OMIMラベル・同義語の字句インデックス。
+    正規化文字列のハッシュ（完全一致）、トークン集合のハッシュ（語順違い）、
+    トークンの転置インデックス（IDF重み付きあいまい一致）の3段で照合する。
+    """
+
+    def __init__(self):
+        self.exact = defaultdict(set)
+        self.token_sets = defaultdict(set)
+        self.postings = defaultdict(set)
+        self.entry_tokens = []
+        self.entry_ids = []
+        self.idf = {}
+        self.max_idf = 1.0
+        self.stats = {"exact_hits": 0, "fuzzy_hits": 0, "misses": 0}
+
+    @classmethod
+    def from_mapping(cls, omim_mapping: dict, synonyms: dict = None):
+        """
+        omim_mapping: {omim_id: label}
+        synonyms: {omim_id: [synonym, ...]}（任意）
+        """
+        index = cls()
+        for omim_id, label in omim_mapping.items():
+            for variant in label_variants(label):
+                index.add(omim_id, variant)
+        for omim_id, names in (synonyms or {}).items():
+            for name in names:
+                index.add(omim_id, name)
+        index._compute_idf()
+        return index
+
+    def add(self, omim_id: str, name: str):
+        tokens = tokenize(name)
+        if not tokens:
+            return
+        self.exact[" ".join(tokens)].add(omim_id)
+        self.token_sets[" ".join(sorted(set(tokens)))].add(omim_id)
+        entry = len(self.entry_ids)
+        self.entry_ids.append(omim_id)
+        self.entry_tokens.append(frozenset(tokens))
+        for tok in set(tokens):
+            self.postings[tok].add(entry)
+
+    def _compute_idf(self):
+        n = len(self.entry_ids) or 1
+        self.idf = {tok: math.log(1 + n / len(entries)) for tok, entries in self.postings.items()}
+        self.max_idf = max(self.idf.values(), default=1.0)
+
+    def _weight(self, tokens):
+        # 未知トークンは最も珍しい語と同じ重みとして扱う
+        return sum(self.idf.get(tok, self.max_idf) for tok in tokens)
+
+    def _unique(self, ids):
+        # 複数のOMIM IDに対応する表記（曖昧な略称など）は採用しない
+        return next(iter(ids)) if len(ids) == 1 else None
+
+    def lookup(self, disease_name: str):
+        """
+        戻り値: (omim_id, score) または None
+        完全一致・語順違いは score=1.0、あいまい一致は IDF重み付きJaccard係数
+        """
+        tokens = tokenize(disease_name)
+        if not tokens:
+            self.stats["misses"] += 1
+            return None
+        for table, key in ((self.exact, " ".join(tokens)), (self.token_sets, " ".join(sorted(set(tokens))))):
+            omim_id = self._unique(table.get(key, ()))
+            if omim_id is not None:
+                self.stats["exact_hits"] += 1
+                return omim_id, 1.0
+
+        query = frozenset(tokens)
+        # 閾値以上になり得る候補だけを集める（プレフィックスフィルタ）:
+        # 珍しい語から順に、残りの語だけでは閾値に届かなくなるまでの語を共有する項目に限定する
+        query_weight = self._weight(query)
+        candidates = set()
+        covered = 0.0
+        for tok in sorted(query, key=lambda t: -self._weight([t])):
+            if covered > (1 - FUZZY_THRESHOLD) * query_weight:
+                break
+            candidates |= self.postings.get(tok, set())
+            covered += self._weight([tok])
+        best_score, best_ids = 0.0, set()
+        for entry in candidates:
+            entry_tokens = self.entry_tokens[entry]
+            score = self._weight(query & entry_tokens) / self._weight(query | entry_tokens)
+            if score > best_score:
+                best_score, best_ids = score, {self.entry_ids[entry]}
+            elif score == best_score:
+                best_ids.add(self.entry_ids[entry])
+        omim_id = self._unique(best_ids)
+        if omim_id is not None and best_score >= FUZZY_THRESHOLD:
+            self.stats["fuzzy_hits"] += 1
+            return omim_id, best_score
+        self.stats["misses"] += 1
+        return None
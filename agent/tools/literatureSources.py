@@ -0,0 +1,159 @@
+import os
+import json
+import asyncio
+from typing import List, Dict
+from . import httpClient
+from ..metrics import timed_call
+
+EUTILS_BASE_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
+# 設定するとNCBIのレート制限が 3 -> 10 リクエスト/秒 に緩和される
+NCBI_API_KEY = os.environ.get("NCBI_API_KEY", "")
+PUBMED_MAX_QUERY_LENGTH = 300
+WIKIPEDIA_MAX_QUERY_LENGTH = 300
+
+
+def _eutils_request(endpoint: str, params: dict) -> str:
+    """
+    E-utilities を呼び出す（429/5xx の再試行は httpClient が行う）
+    """
+    if NCBI_API_KEY:
+        params = {**params, "api_key": NCBI_API_KEY}
+    with timed_call("pubmed"):
+        response = httpClient.get(EUTILS_BASE_URL + endpoint, params=params)
+        response.raise_for_status()
+    return response.text
+
+
+async def _aeutils_request(endpoint: str, params: dict) -> str:
+    if NCBI_API_KEY:
+        params = {**params, "api_key": NCBI_API_KEY}
+    with timed_call("pubmed"):
+        response = await httpClient.aget(EUTILS_BASE_URL + endpoint, params=params)
+        response.raise_for_status()
+    return response.text
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _text(value) -> str:
+    # xmltodict は属性付き要素を {"@attr": ..., "#text": ...} に変換する
+    if isinstance(value, dict):
+        return str(value.get("#text", ""))
+    return "" if value is None else str(value)
+
+
+def _abstract(article: dict) -> str:
+    abstract_text = _as_list(article.get("Abstract", {}).get("AbstractText"))
+    parts = []
+    for part in abstract_text:
+        if isinstance(part, dict) and "@Label" in part:
+            parts.append(f"{part['@Label']}: {_text(part)}")
+        else:
+            parts.append(_text(part))
+    return "\n".join(p for p in parts if p) or "No abstract available"
+
+
+def _parse_pubmed_articles(xml_text: str) -> Dict[str, Dict[str, str]]:
+    """
+    efetch のXMLを {PMID: {"title", "abstract"}} に変換する
+    """
+    import xmltodict
+
+    article_set = xmltodict.parse(xml_text).get("PubmedArticleSet") or {}
+    articles = {}
+    for entry in _as_list(article_set.get("PubmedArticle")):
+        citation = entry["MedlineCitation"]
+        article = citation["Article"]
+        articles[_text(citation["PMID"])] = {"title": _text(article.get("ArticleTitle")), "abstract": _abstract(article)}
+    for entry in _as_list(article_set.get("PubmedBookArticle")):
+        book = entry["BookDocument"]
+        articles[_text(book["PMID"])] = {"title": _text(book.get("ArticleTitle")), "abstract": _abstract(book)}
+    return articles
+
+
+def _esearch_params(query: str, offset: int, limit: int) -> dict:
+    return {
+        "db": "pubmed",
+        "term": query[:PUBMED_MAX_QUERY_LENGTH],
+        "retmode": "json",
+        "retstart": offset,
+        "retmax": limit,
+    }
+
+
+def _efetch_params(uids) -> dict:
+    return {"db": "pubmed", "retmode": "xml", "id": ",".join(uids)}
+
+
+def _pubmed_documents(query: str, uids, articles: dict, chars_max: int) -> List[Dict[str, str]]:
+    return [{
+        "url": f"https://pubmed.ncbi.nlm.nih.gov/{uid}/",
+        "title": articles[uid]["title"] or query,
+        "page_content": articles[uid]["abstract"][:chars_max],
+    } for uid in uids if uid in articles]
+
+
+def pubmed_page(query: str, offset: int, limit: int, chars_max: int) -> List[Dict[str, str]]:
+    """
+    PubMed検索結果の offset 件目から limit 件を取得する（esearch の retstart を使い、前のページは再取得しない）。
+    アブストラクトは1回の efetch でまとめて取得する
+    """
+    if limit <= 0:
+        return []
+    search = json.loads(_eutils_request("esearch.fcgi", _esearch_params(query, offset, limit)))
+    uids = search["esearchresult"]["idlist"]
+    if not uids:
+        return []
+    articles = _parse_pubmed_articles(_eutils_request("efetch.fcgi", _efetch_params(uids)))
+    return _pubmed_documents(query, uids, articles, chars_max)
+
+
+async def apubmed_page(query: str, offset: int, limit: int, chars_max: int) -> List[Dict[str, str]]:
+    """
+    pubmed_page の非同期版
+    """
+    if limit <= 0:
+        return []
+    search = json.loads(await _aeutils_request("esearch.fcgi", _esearch_params(query, offset, limit)))
+    uids = search["esearchresult"]["idlist"]
+    if not uids:
+        return []
+    articles = _parse_pubmed_articles(await _aeutils_request("efetch.fcgi", _efetch_params(uids)))
+    return _pubmed_documents(query, uids, articles, chars_max)
+
+
+def wikipedia_page(query: str, offset: int, limit: int, chars_max: int) -> List[Dict[str, str]]:
+    """
+    Wikipedia検索結果の offset 件目から limit 件を取得する。
+    タイトル検索は軽いので先頭から行い、本文は offset 以降のページだけ読み込む
+    """
+    import wikipedia
+
+    if limit <= 0:
+        return []
+    with timed_call("wikipedia"):
+        titles = wikipedia.search(query[:WIKIPEDIA_MAX_QUERY_LENGTH], results=offset + limit)
+    documents = []
+    for title in titles[offset:offset + limit]:
+        try:
+            with timed_call("wikipedia"):
+                page = wikipedia.page(title=title, auto_suggest=False)
+        except (wikipedia.exceptions.PageError, wikipedia.exceptions.DisambiguationError):
+            continue
+        documents.append({
+            "url": page.url,
+            "title": title,
+            "page_content": page.content[:chars_max],
+        })
+    return documents
+
+
+async def awikipedia_page(query: str, offset: int, limit: int, chars_max: int) -> List[Dict[str, str]]:
+    """
+    wikipedia_page の非同期版（wikipediaパッケージは同期APIのみのためスレッドで実行する）
+    """
+    return await asyncio.to_thread(wikipedia_page, query, offset, limit, chars_max)
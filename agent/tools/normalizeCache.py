@@ -0,0 +1,141 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+def canonical_name(disease_name: str) -> str:
+    """
+    キャッシュキー用に疾患名を正規化（大文字化・空白の統一）
+    """
+    return " ".join(disease_name.upper().split())
+
+
+def file_fingerprint(path: str) -> str:
+    """
+    インデックスファイルの変更検知用フィンガープリント（サイズと更新時刻）
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return "missing"
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+
+def cached_disease_names(db_path: str) -> list:
+    """
+    キャッシュに保存された（実際にLLMが出力した）疾患名の一覧。読み取り専用で開き、ファイルがなければ空
+    """
+    if not os.path.exists(db_path):
+        return []
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        return [row[0] for row in conn.execute("SELECT DISTINCT name FROM embeddings ORDER BY name")]
+    except sqlite3.DatabaseError:
+        return []
+    finally:
+        conn.close()
+
+
+class NormalizationCache:
+    """
+    疾患名 -> (omim_id, omim_label, sim) の2段キャッシュ。
+    1段目はプロセス内LRU、2段目はSQLite。embeddingベクトルも保存し、
+    インデックス(.bin)が変わった場合は正規化結果のみ破棄してembeddingは再利用する。
+    """
+
+    def __init__(self, db_path: str, model: str, index_fingerprint: str, lru_size: int = 4096):
+        self.model = model
+        self.index_fingerprint = index_fingerprint
+        self.lru_size = lru_size
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "embedding_hits": 0}
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT, name TEXT, vector BLOB,
+                PRIMARY KEY (model, name)
+            );
+            CREATE TABLE IF NOT EXISTS results (
+                model TEXT, name TEXT, omim_id TEXT, omim_label TEXT, sim REAL,
+                PRIMARY KEY (model, name)
+            );
+        """)
+        self._invalidate_if_index_changed()
+
+    def _invalidate_if_index_changed(self):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'index_fingerprint'").fetchone()
+        if row is None or row[0] != self.index_fingerprint:
+            if row is not None:
+                print("[NormalizationCache] OMIM index changed, dropping cached normalization results")
+            with self._conn:
+                self._conn.execute("DELETE FROM results")
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('index_fingerprint', ?)",
+                    (self.index_fingerprint,)
+                )
+
+    def _remember(self, key, value):
+        self._lru[key] = value
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def get(self, disease_name: str):
+        key = canonical_name(disease_name)
+        with self._lock:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return self._lru[key]
+            row = self._conn.execute(
+                "SELECT omim_id, omim_label, sim FROM results WHERE model = ? AND name = ?",
+                (self.model, key)
+            ).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            result = (row[0], row[1], float(row[2]))
+            self._remember(key, result)
+            self.stats["disk_hits"] += 1
+            return result
+
+    def get_embedding(self, disease_name: str):
+        key = canonical_name(disease_name)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector FROM embeddings WHERE model = ? AND name = ?",
+                (self.model, key)
+            ).fetchone()
+            if row is None:
+                return None
+            self.stats["embedding_hits"] += 1
+            return np.frombuffer(row[0], dtype="float32")
+
+    def put(self, disease_name: str, embedding, result):
+        key = canonical_name(disease_name)
+        omim_id, omim_label, sim = result
+        with self._lock:
+            self._remember(key, (omim_id, omim_label, float(sim)))
+            with self._conn:
+                if embedding is not None:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO embeddings (model, name, vector) VALUES (?, ?, ?)",
+                        (self.model, key, np.asarray(embedding, dtype="float32").tobytes())
+                    )
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO results (model, name, omim_id, omim_label, sim) VALUES (?, ?, ?, ?, ?)",
+                    (self.model, key, omim_id, omim_label, float(sim))
+                )
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,120 @@
+import os
+import json
+import numpy as np
+
+# バイナリサイドカーのファイル構成（<base> はインデックスのパスから拡張子を除いたもの）
+#   <base>.ids.npy       : int64[N]   インデックス順のOMIM番号（"OMIM:" を除いた数値）
+#   <base>.order.npy     : int64[N]   ids を昇順に並べる添字（OMIM ID -> 位置の二分探索用）
+#   <base>.offsets.npy   : int64[N+1] ラベルのバイトオフセット
+#   <base>.labels.bin    : uint8      UTF-8ラベルを連結したblob
+#   <base>.meta.json     : モデル名・次元数・検索パラメータなど
+OMIM_PREFIX = "OMIM:"
+
+
+def _paths(base):
+    return {
+        "ids": base + ".ids.npy",
+        "order": base + ".order.npy",
+        "offsets": base + ".offsets.npy",
+        "labels": base + ".labels.bin",
+        "meta": base + ".meta.json",
+    }
+
+
+def write_label_store(base, omim_ids, labels, meta=None):
+    """
+    OMIM IDとラベルをmmap可能なバイナリサイドカーとして書き出す
+    """
+    paths = _paths(base)
+    ids = np.array([int(omim_id[len(OMIM_PREFIX):]) for omim_id in omim_ids], dtype=np.int64)
+    encoded = [label.encode("utf-8") for label in labels]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    np.save(paths["ids"], ids)
+    np.save(paths["order"], np.argsort(ids, kind="stable"))
+    np.save(paths["offsets"], offsets)
+    with open(paths["labels"], "wb") as f:
+        f.write(b"".join(encoded))
+    # meta.json は最後に書く（存在すればサイドカー一式が揃っているとみなす）
+    with open(paths["meta"], "w", encoding="utf-8") as f:
+        json.dump(meta or {}, f, ensure_ascii=False)
+
+
+class OmimLabelStore:
+    """
+    FAISSインデックスの行番号 -> (OMIM ID, ラベル) の対応表。
+    配列はmmapで開くため、複数のワーカープロセスでページキャッシュを共有できる
+    """
+
+    def __init__(self, ids, order, offsets, blob, meta):
+        self.ids = ids
+        self.order = order
+        self.offsets = offsets
+        self.blob = blob
+        self.meta = meta
+
+    @classmethod
+    def load(cls, base, mmap=True):
+        paths = _paths(base)
+        mode = "r" if mmap else None
+        with open(paths["meta"], encoding="utf-8") as f:
+            meta = json.load(f)
+        if os.path.getsize(paths["labels"]):
+            blob = np.memmap(paths["labels"], dtype=np.uint8, mode="r") if mmap else np.fromfile(paths["labels"], dtype=np.uint8)
+        else:
+            blob = np.zeros(0, dtype=np.uint8)
+        return cls(
+            np.load(paths["ids"], mmap_mode=mode),
+            np.load(paths["order"], mmap_mode=mode),
+            np.load(paths["offsets"], mmap_mode=mode),
+            blob,
+            meta,
+        )
+
+    @classmethod
+    def from_sidecar_json(cls, json_path):
+        """
+        旧形式のJSONサイドカー（omim_ids / labels）からメモリ上に構築する
+        """
+        with open(json_path, encoding="utf-8") as f:
+            sidecar = json.load(f)
+        ids = np.array([int(i[len(OMIM_PREFIX):]) for i in sidecar["omim_ids"]], dtype=np.int64)
+        encoded = [label.encode("utf-8") for label in sidecar["labels"]]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+        meta = {k: v for k, v in sidecar.items() if k not in ("omim_ids", "labels")}
+        return cls(ids, np.argsort(ids, kind="stable"), offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8), meta)
+
+    @classmethod
+    def exists(cls, base):
+        return os.path.exists(_paths(base)["meta"])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def omim_id(self, i):
+        return f"{OMIM_PREFIX}{int(self.ids[i])}"
+
+    def label(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+    def find(self, omim_id):
+        """
+        OMIM IDからインデックス上の位置を返す（見つからなければNone）
+        """
+        try:
+            number = int(omim_id[len(OMIM_PREFIX):]) if omim_id.startswith(OMIM_PREFIX) else int(omim_id)
+        except ValueError:
+            return None
+        pos = int(np.searchsorted(self.ids, number, sorter=self.order))
+        if pos < len(self.order) and self.ids[self.order[pos]] == number:
+            return int(self.order[pos])
+        return None
+
+    def label_for(self, omim_id, default=None):
+        i = self.find(omim_id)
+        return self.label(i) if i is not None else default
+
+    def items(self):
+        for i in range(len(self)):
+            yield self.omim_id(i), self.label(i)
@@ -1,22 +1,38 @@
 
-import requests
+from . import httpClient
+from ..metrics import timed_call
+
+PCF_API_URL = "https://pubcasefinder.dbcls.jp/api/pcf_get_ranked_list?target=omim&format=json&hpo_id={hpo_ids}"
+
+def _top_results(data):
+    top = []
+    for item in data[:5]:
+        top.append({
+            "omim_disease_name_en": item.get("omim_disease_name_en", ""),
+            "description": item.get("description", ""),
+            "score": item.get("score", None),
+            "omim_id": item.get("id", "")
+        })
+    return top
 
 def callingPCF(hpo_list , depth):
-    hpo_ids = ",".join(hpo_list)
-    url = f"https://pubcasefinder.dbcls.jp/api/pcf_get_ranked_list?target=omim&format=json&hpo_id={hpo_ids}"
+    url = PCF_API_URL.format(hpo_ids=",".join(hpo_list))
     try:
-        response = requests.get(url, timeout=60)
-        response.raise_for_status()
-        data = response.json()
-        top = []
-        for item in data[:5]:
-            top.append({
-                "omim_disease_name_en": item.get("omim_disease_name_en", ""),
-                "description": item.get("description", ""),
-                "score": item.get("score", None),
-                "omim_id": item.get("id", "")
-            })
-        return top
+        with timed_call("pcf"):
+            response = httpClient.get(url)
+            response.raise_for_status()
+        return _top_results(response.json())
+    except Exception as e:
+        print(f"[PhenotypeAnalyzer] PubCaseFinder API失敗: {e}")
+        return []
+
+async def acallingPCF(hpo_list, depth):
+    url = PCF_API_URL.format(hpo_ids=",".join(hpo_list))
+    try:
+        with timed_call("pcf"):
+            response = await httpClient.aget(url)
+            response.raise_for_status()
+        return _top_results(response.json())
     except Exception as e:
         print(f"[PhenotypeAnalyzer] PubCaseFinder API失敗: {e}")
         return []
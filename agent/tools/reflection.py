@@ -1,32 +1,41 @@
-from langchain.schema import HumanMessage
 from ..state.state_types import ReflectionFormat
 from ..llm.prompt import prompt_dict, build_prompt
-from ..llm.azure_llm_instance import azure_llm
+from ..llm.azure_llm_instance import get_azure_llm
+from .contextPacking import pack_evidence, REFLECTION_EVIDENCE_TOKENS
+from .evidenceStore import EvidenceStore
 
 
-def format_disease_knowledge(info_list, disease_name):
+def format_disease_knowledge(info_list, disease_name, hpo_terms=(), omim_id=None):
     """
-    InformationItemのリストから、rankに該当するものだけをプロンプト用に整形
+    InformationItemのリスト（EvidenceStore）から、候補の疾患（疾患名・OMIM ID）の根拠だけをプロンプト用に整形
+    候補の疾患名・HPO用語との関連度が高い順に REFLECTION_EVIDENCE_TOKENS まで詰める（番号は元のリストの位置）
     """
     if not info_list:
         return "No disease knowledge available."
-    lines = []
-    for i, item in enumerate(info_list, 1):
-        if item.get("disease_name") == disease_name:
-            line = f"[{i}] {item.get('title', '')}\nURL: {item.get('url', '')}\n{item.get('content', '')}\n"
-            lines.append(line)
-    if not lines:
+    candidates = EvidenceStore.of(info_list).for_disease(disease_name, omim_id)
+    if not candidates:
         return "No disease knowledge available for this rank."
-    return "\n".join(lines)
 
-def create_reflection(hpo_dict, diagnosis_to_judge, disease_knowledge_list, absent_hpo_dict=None):
+    def render(candidate):
+        i, item = candidate
+        return f"[{i}] {item.get('title', '')}\nURL: {item.get('url', '')}\n{item.get('content', '')}\n"
+
+    packed = pack_evidence(
+        candidates, render, REFLECTION_EVIDENCE_TOKENS, "reflection", candidate=disease_name, hpo_terms=hpo_terms
+    )
+    return "\n".join(packed.texts)
+
+def build_reflection_prompt(hpo_dict, diagnosis_to_judge, disease_knowledge_list, absent_hpo_dict=None):
     prompt_template = prompt_dict["reflection_prompt"]
     diagnosis_name = diagnosis_to_judge.disease_name
     description = diagnosis_to_judge.description
     rank = diagnosis_to_judge.rank
     disease_name = diagnosis_to_judge.disease_name
 
-    disease_knowledge_str = format_disease_knowledge(disease_knowledge_list, disease_name) if disease_knowledge_list is not None else ""
+    hpo_terms = list(hpo_dict.values()) if hpo_dict else []
+    disease_knowledge_str = format_disease_knowledge(
+        disease_knowledge_list, disease_name, hpo_terms, getattr(diagnosis_to_judge, "OMIM_id", None)
+    ) if disease_knowledge_list is not None else ""
 
     present_hpo = ", ".join([v for k, v in hpo_dict.items()]) if hpo_dict else ""
     absent_hpo = ", ".join([v for k, v in (absent_hpo_dict or {}).items()]) if absent_hpo_dict else ""
@@ -37,15 +46,34 @@ def create_reflection(hpo_dict, diagnosis_to_judge, disease_knowledge_list, abse
         "diagnosis_to_judge": f"{diagnosis_name} (Rank: {rank})\nDescription: {description}",
         "disease_knowledge": disease_knowledge_str
     }
-    structured_llm = azure_llm.get_structured_llm(ReflectionFormat)
     prompt = build_prompt(prompt_template, inputs)
     
     print("reflection prompt\n")
     print(prompt)
     print("\n")
+    return prompt
+
+def create_reflection(hpo_dict, diagnosis_to_judge, disease_knowledge_list, absent_hpo_dict=None):
+    prompt = build_reflection_prompt(hpo_dict, diagnosis_to_judge, disease_knowledge_list, absent_hpo_dict=absent_hpo_dict)
+    structured_llm = get_azure_llm().get_structured_llm(ReflectionFormat)
     
+    from langchain.schema import HumanMessage
     messages = [HumanMessage(content=prompt)]
     result = structured_llm.invoke(messages)
     if isinstance(result, dict):
         return ReflectionFormat(**result), prompt
-    return result, prompt
\ No newline at end of file
+    return result, prompt
+
+async def acreate_reflection(hpo_dict, diagnosis_to_judge, disease_knowledge_list, absent_hpo_dict=None):
+    """
+    create_reflection の非同期版
+    """
+    prompt = build_reflection_prompt(hpo_dict, diagnosis_to_judge, disease_knowledge_list, absent_hpo_dict=absent_hpo_dict)
+    structured_llm = get_azure_llm().get_structured_llm(ReflectionFormat)
+
+    from langchain.schema import HumanMessage
+    messages = [HumanMessage(content=prompt)]
+    result = await structured_llm.ainvoke(messages)
+    if isinstance(result, dict):
+        return ReflectionFormat(**result), prompt
+    return result, prompt
@@ -0,0 +1,56 @@
+import os
+from ..lazy import lazy_singleton
+from .diskCache import DiskCache, CACHE_DIR, content_hash
+
+# 検索結果キャッシュの有効期間（時間）。0以下なら期限なし
+RETRIEVAL_CACHE_TTL_HOURS = float(os.environ.get("RETRIEVAL_CACHE_TTL_HOURS", "168"))
+RETRIEVAL_CACHE_MAX_MB = float(os.environ.get("RETRIEVAL_CACHE_MAX_MB", "512"))
+
+
+@lazy_singleton
+def get_retrieval_cache():
+    return DiskCache(
+        os.environ.get("RETRIEVAL_CACHE_DB", os.path.join(CACHE_DIR, "retrieval_cache.sqlite3")),
+        max_bytes=int(RETRIEVAL_CACHE_MAX_MB * 2**20),
+        ttl=RETRIEVAL_CACHE_TTL_HOURS * 3600 if RETRIEVAL_CACHE_TTL_HOURS > 0 else None
+    )
+
+
+def retrieval_key(source: str, query: str, offset: int, top_k: int, chars_max: int) -> str:
+    return content_hash(source, " ".join(query.lower().split()), str(offset), str(top_k), str(chars_max))
+
+
+def cached_retrieval(source: str, query: str, offset: int, top_k: int, chars_max: int, fetch):
+    """
+    (情報源, 検索語, 開始位置, 件数, 本文の最大文字数) をキーに取得した文書とメタデータをキャッシュする。
+    検索語は前後の空白と大文字小文字を無視する。fetch() が例外を送出した場合はキャッシュしない
+    """
+    cache = get_retrieval_cache()
+    key = retrieval_key(source, query, offset, top_k, chars_max)
+    documents = cache.get(key)
+    if documents is not None:
+        return documents
+    documents = fetch()
+    cache.put(key, documents)
+    return documents
+
+
+async def acached_retrieval(source: str, query: str, offset: int, top_k: int, chars_max: int, afetch):
+    """
+    cached_retrieval の非同期版（afetch はコルーチン関数）
+    """
+    cache = get_retrieval_cache()
+    key = retrieval_key(source, query, offset, top_k, chars_max)
+    documents = cache.get(key)
+    if documents is not None:
+        return documents
+    documents = await afetch()
+    cache.put(key, documents)
+    return documents
+
+
+def get_retrieval_cache_stats() -> dict:
+    """
+    ヒット数 = 省略できたWikipedia/PubMedへの問い合わせの数
+    """
+    return get_retrieval_cache().get_stats()
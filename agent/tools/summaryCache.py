@@ -0,0 +1,55 @@
+import os
+from ..lazy import lazy_singleton
+from .diskCache import DiskCache, CACHE_DIR, content_hash
+
+# 要約キャッシュの上限サイズ（MB）
+SUMMARY_CACHE_MAX_MB = float(os.environ.get("SUMMARY_CACHE_MAX_MB", "256"))
+
+
+@lazy_singleton
+def get_summary_cache():
+    return DiskCache(
+        os.environ.get("SUMMARY_CACHE_DB", os.path.join(CACHE_DIR, "summary_cache.sqlite3")),
+        max_bytes=int(SUMMARY_CACHE_MAX_MB * 2**20)
+    )
+
+
+def summary_key(prompt_template: str, content: str, deployment: str) -> str:
+    return content_hash(content_hash(content), content_hash(prompt_template), deployment)
+
+
+def cached_summary(prompt_template: str, content: str, deployment: str, summarize):
+    """
+    (本文のハッシュ, プロンプトのハッシュ, デプロイ名) をキーに要約をキャッシュする。
+    プロンプトを変更するとキーが変わるため古い要約は使われない。
+    summarize() が例外を送出した場合はキャッシュしない
+    """
+    cache = get_summary_cache()
+    key = summary_key(prompt_template, content, deployment)
+    summary = cache.get(key)
+    if summary is not None:
+        return summary
+    summary = summarize()
+    cache.put(key, summary)
+    return summary
+
+
+async def acached_summary(prompt_template: str, content: str, deployment: str, asummarize):
+    """
+    cached_summary の非同期版（asummarize はコルーチン関数）
+    """
+    cache = get_summary_cache()
+    key = summary_key(prompt_template, content, deployment)
+    summary = cache.get(key)
+    if summary is not None:
+        return summary
+    summary = await asummarize()
+    cache.put(key, summary)
+    return summary
+
+
+def get_summary_cache_stats() -> dict:
+    """
+    ヒット数 = 省略できたLLM要約呼び出しの数
+    """
+    return get_summary_cache().get_stats()
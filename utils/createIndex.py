@@ -1,24 +1,401 @@
- #please create a FAISS index from omim_mapping.json and put agent/data/DataForOmimMapping/.
+#please create a FAISS index from omim_mapping.json and put agent/data/DataForOmimMapping/.
 import os
+import re
 import sys
 import json
+import time
+import random
+import hashlib
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 import faiss
 from openai import AzureOpenAI
 from dotenv import load_dotenv
 
+# プロジェクトのルートディレクトリをパスに追加
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agent.tools.omimLabelStore import write_label_store
+from agent.tools.normalizeCache import canonical_name, cached_disease_names
+from agent.tools.diskCache import CACHE_DIR
+
 load_dotenv()
 
+# diseaseNormalize.py の採用閾値（ベンチマークで判定の一致率を確認する）
+SIM_THRESHOLD = 0.75
+# text-embedding-3-large の次元数
+FULL_DIMENSIONS = 3072
+
+INDEX_TYPES = ["flat", "hnsw", "ivf"]
+STORAGE_TYPES = ["float32", "float16", "sq8", "pq"]
+DEFAULT_BENCHMARK_CONFIGS = "flat/float32/1024,flat/float16/3072,flat/sq8/3072,flat/pq/3072,hnsw/float32/3072,hnsw/sq8/1024,ivf/float32/3072,ivf/sq8/1024"
+
+
+class RateLimiter:
+    """
+    スレッド間で共有するリクエスト数/分の制限（リクエスト開始間隔を一定以上空ける）
+    """
+
+    def __init__(self, max_per_minute=None):
+        self.interval = 60.0 / max_per_minute if max_per_minute else 0.0
+        self._lock = threading.Lock()
+        self._next_time = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_time)
+            self._next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class EmbeddingCheckpoint:
+    """
+    embedding済みバッチをディスクに保存し、中断後の再開や差分更新で再利用する。
+    ラベル文字列 -> ベクトル の対応を batch_<hash>.npz として保存する（モデルごと）
+    """
+
+    def __init__(self, directory, model):
+        self.directory = directory
+        self.model = model
+        os.makedirs(directory, exist_ok=True)
+
+    def _files(self):
+        return sorted(
+            os.path.join(self.directory, name) for name in os.listdir(self.directory)
+            if name.endswith(".npz") and not name.endswith(".tmp.npz")
+        )
+
+    def load(self):
+        vectors = {}
+        for path in self._files():
+            try:
+                with np.load(path) as data:
+                    if str(data["model"]) != self.model:
+                        continue
+                    vectors.update(zip(data["labels"].tolist(), data["vectors"]))
+            except (OSError, KeyError, ValueError) as e:
+                # 書き込み途中で中断されたファイルなどは無視する
+                print(f"Ignoring broken checkpoint {path}: {e}")
+        return vectors
+
+    def _write(self, name, labels, vectors):
+        path = os.path.join(self.directory, name)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, model=np.array(self.model), labels=np.array(labels), vectors=np.asarray(vectors, dtype='float32'))
+        os.replace(tmp_path, path)
+
+    def save_batch(self, labels, vectors):
+        digest = hashlib.sha1("\n".join(labels).encode("utf-8")).hexdigest()
+        self._write(f"batch_{digest}.npz", labels, vectors)
+
+    def compact(self, labels, vectors):
+        """
+        現在のラベル分だけを1ファイルにまとめ、バッチファイルを削除する
+        """
+        self._write("embeddings.npz", labels, vectors)
+        for path in self._files():
+            if os.path.basename(path) != "embeddings.npz":
+                os.remove(path)
+
+
+def embed_labels(client, deployment_name, labels, batch_size=100, concurrency=1, max_rpm=None, max_retries=5, checkpoint=None):
+    """
+    ラベルをbatch_size件ずつembeddingし、(N, dim) の行列を返す。
+    バッチはconcurrency並列・max_rpmリクエスト/分以内で送信し、失敗時は指数バックオフで再試行する。
+    checkpointを渡すと完了したバッチから順にディスクへ保存する
+    """
+    limiter = RateLimiter(max_rpm)
+    batches = [labels[i:i+batch_size] for i in range(0, len(labels), batch_size)]
+
+    def embed_batch(batch):
+        for attempt in range(max_retries + 1):
+            limiter.wait()
+            try:
+                response = client.embeddings.create(
+                    model=deployment_name,
+                    input=batch,
+                )
+                vectors = np.array(
+                    [item.embedding for item in sorted(response.data, key=lambda d: d.index)], dtype='float32'
+                )
+                if checkpoint is not None:
+                    checkpoint.save_batch(batch, vectors)
+                return vectors
+            except Exception as e:
+                if attempt == max_retries:
+                    raise
+                wait = min(60.0, 2 ** attempt) * (0.5 + random.random())
+                print(f"Embedding request failed ({e}); retrying in {wait:.1f}s")
+                time.sleep(wait)
+
+    results = [None] * len(batches)
+    failed = 0
+    done = 0
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = {executor.submit(embed_batch, batch): i for i, batch in enumerate(batches)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+                done += len(batches[i])
+                print(f"Embedded {done}/{len(labels)}")
+            except Exception as e:
+                failed += 1
+                print(f"Batch {i} failed: {e}")
+    if failed:
+        raise RuntimeError(f"{failed} embedding batches failed; completed batches are checkpointed, rerun to resume")
+    if not results:
+        return np.zeros((0, 0), dtype='float32')
+    return np.concatenate(results)
+
+
+def diff_labels(previous_sidecar, omim_map):
+    """
+    前回のサイドカー(.json)と現在のomim_mappingを比較し、追加・変更・削除されたOMIM IDを返す
+    """
+    previous = dict(zip(previous_sidecar.get("omim_ids", []), previous_sidecar.get("labels", [])))
+    added = [omim_id for omim_id in omim_map if omim_id not in previous]
+    changed = [omim_id for omim_id, label in omim_map.items() if omim_id in previous and previous[omim_id] != label]
+    removed = [omim_id for omim_id in previous if omim_id not in omim_map]
+    return added, changed, removed
+
+
+def vectors_from_previous_index(index_path, previous_sidecar):
+    """
+    前回のインデックスがfull次元のFlat(float32)なら、そこからラベルのベクトルを復元する
+    （チェックポイントがない既存インデックスからの差分更新用）
+    """
+    if not os.path.exists(index_path) or previous_sidecar.get("dimensions") or previous_sidecar.get("storage", "float32") != "float32" \
+            or previous_sidecar.get("index_type", "flat") != "flat":
+        return {}
+    index = faiss.read_index(index_path)
+    vectors = index.reconstruct_n(0, index.ntotal)
+    return dict(zip(previous_sidecar.get("labels", []), vectors))
+
+
+def truncate_embeddings(embeddings, dimensions):
+    """
+    Matryoshka表現の切り詰め: 先頭dimensions次元を取り出してL2正規化する。
+    text-embedding-3系ではAPIのdimensionsパラメータと同じ結果になる
+    """
+    vectors = np.ascontiguousarray(embeddings[:, :dimensions], dtype='float32')
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def factory_string(index_type, storage, dimensions, hnsw_m=32, ivf_nlist=256, pq_m=None):
+    """
+    index_type / storage の組み合わせからFAISSのindex_factory文字列を作る
+    """
+    pq_m = pq_m or max(1, dimensions // 16)
+    if storage == "pq" and dimensions % pq_m != 0:
+        raise ValueError(f"dimensions ({dimensions}) must be divisible by pq_m ({pq_m})")
+    codes = {"float32": "Flat", "float16": "SQfp16", "sq8": "SQ8", "pq": f"PQ{pq_m}x8"}[storage]
+    if index_type == "flat":
+        return codes
+    if index_type == "hnsw":
+        if storage == "pq":
+            # HNSW+PQ は内積メトリックに対応していないため使わない
+            raise ValueError("hnsw index does not support pq storage with inner product; use flat/pq or ivf/pq")
+        return f"HNSW{hnsw_m}" if storage == "float32" else f"HNSW{hnsw_m}_{codes}"
+    if index_type == "ivf":
+        return f"IVF{ivf_nlist},{codes}"
+    raise ValueError(f"unknown index type: {index_type}")
+
+
+def search_params(index_type, nprobe=16, ef_search=128):
+    """
+    検索時パラメータ（faiss.ParameterSpace形式）。サイドカーに保存して読み込み側で適用する
+    """
+    if index_type == "hnsw":
+        return f"efSearch={ef_search}"
+    if index_type == "ivf":
+        return f"nprobe={nprobe}"
+    return ""
+
+
+def build_index(vectors, index_type="flat", storage="float32", hnsw_m=32, ivf_nlist=256, pq_m=None, nprobe=16, ef_search=128):
+    """
+    L2正規化済みベクトルから内積（コサイン類似度）インデックスを作成する
+    """
+    dimensions = vectors.shape[1]
+    index = faiss.index_factory(
+        dimensions,
+        factory_string(index_type, storage, dimensions, hnsw_m, min(ivf_nlist, len(vectors)), pq_m),
+        faiss.METRIC_INNER_PRODUCT
+    )
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    params = search_params(index_type, nprobe, ef_search)
+    if params:
+        faiss.ParameterSpace().set_index_parameters(index, params)
+    return index
+
+
+def current_rss_bytes():
+    """
+    現在のプロセスのRSS（Linuxのみ。取得できない場合は0）
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def parse_benchmark_configs(spec):
+    """
+    "flat/float32/1024,hnsw/sq8/3072" 形式の文字列を (index_type, storage, dimensions) のリストに変換
+    """
+    configs = []
+    for item in spec.split(","):
+        index_type, storage, dimensions = item.strip().split("/")
+        if index_type not in INDEX_TYPES or storage not in STORAGE_TYPES:
+            raise ValueError(f"invalid benchmark config: {item}")
+        configs.append((index_type, storage, int(dimensions)))
+    return configs
+
+
+def benchmark_indexes(label_vectors, query_vectors, configs, build_kwargs):
+    """
+    full次元のFlatインデックスを基準に、各設定の recall@1・閾値判定の一致率・検索レイテンシ・サイズ・RSS増分を測る
+    label_vectors, query_vectors: full次元・L2正規化済み
+    """
+    reference = build_index(label_vectors)
+    ref_sim, ref_ids = reference.search(query_vectors, 1)
+    ref_accept = ref_sim[:, 0] >= SIM_THRESHOLD
+    print(f"  - reference flat index accepts {np.mean(ref_accept):.1%} of queries at the {SIM_THRESHOLD} threshold")
+
+    results = []
+    for index_type, storage, dimensions in configs:
+        try:
+            rss_before = current_rss_bytes()
+            index = build_index(truncate_embeddings(label_vectors, dimensions), index_type, storage, **build_kwargs)
+            rss_delta = current_rss_bytes() - rss_before
+        except (ValueError, RuntimeError) as e:
+            print(f"  - skip {index_type}/{storage}/{dimensions}: {e}")
+            continue
+        queries = truncate_embeddings(query_vectors, dimensions)
+        start = time.perf_counter()
+        for i in range(len(queries)):
+            index.search(queries[i:i+1], 1)
+        latency_ms = (time.perf_counter() - start) / max(1, len(queries)) * 1000
+        sim, ids = index.search(queries, 1)
+        accept = sim[:, 0] >= SIM_THRESHOLD
+        results.append({
+            "index_type": index_type,
+            "storage": storage,
+            "dimensions": dimensions,
+            "recall_at_1": float(np.mean(ids[:, 0] == ref_ids[:, 0])),
+            "threshold_agreement": float(np.mean(accept == ref_accept)),
+            "reference_accept_rate": float(np.mean(ref_accept)),
+            "mean_abs_sim_diff": float(np.mean(np.abs(sim[:, 0] - ref_sim[:, 0]))),
+            "latency_ms": latency_ms,
+            "index_bytes": int(faiss.serialize_index(index).nbytes),
+            "rss_delta_bytes": int(rss_delta),
+        })
+        del index
+    return results
+
+
+def print_benchmark(results):
+    print(f"{'config':<24}{'recall@1':>10}{'thr.agree':>11}{'|dsim|':>9}{'lat(ms)':>10}{'size(MB)':>10}{'rss(MB)':>10}")
+    for r in results:
+        name = f"{r['index_type']}/{r['storage']}/{r['dimensions']}"
+        print(f"{name:<24}{r['recall_at_1']:>10.3f}{r['threshold_agreement']:>11.3f}{r['mean_abs_sim_diff']:>9.3f}"
+              f"{r['latency_ms']:>10.3f}{r['index_bytes'] / 2**20:>10.1f}{r['rss_delta_bytes'] / 2**20:>10.1f}")
+
+
+def label_variants(label):
+    """
+    OMIMラベルから、LLMが出力しそうな（ラベルそのものではない）疾患名を作る:
+    病型の番号を落とした名前、","を除いた名前、SYNDROME/DISEASEを入れ替えた名前（別名も含めラベルと同じものは除く）
+    """
+    parts = [part.strip() for part in label.split(";") if part.strip()]
+    if not parts:
+        return []
+    name = parts[0]
+    variants = [re.sub(r",?\s*(TYPE\s+)?[0-9]+[A-Z]?$", "", name), name.replace(",", "")]
+    if re.search(r"\bSYNDROME\b", name):
+        variants.append(re.sub(r"\bSYNDROME\b", "DISEASE", name))
+    elif re.search(r"\bDISEASE\b", name):
+        variants.append(re.sub(r"\bDISEASE\b", "SYNDROME", name))
+    labels = {canonical_name(part) for part in parts}
+    return [variant for variant in dict.fromkeys(canonical_name(v) for v in variants) if variant and variant not in labels]
+
+
+def benchmark_queries(omim_map, n, seed=0, cache_db=None):
+    """
+    ベンチマーク用のクエリ文字列をn件: まず正規化キャッシュにある疾患名（実際にLLMが出力した名前）、
+    足りない分はOMIMラベルの変形（label_variants）から選ぶ。
+    インデックスのラベルそのものは類似度がほぼ1になり、閾値判定の一致率を確認できないので使わない。
+    戻り値: (クエリのリスト, {"cache": 件数, "variants": 件数})
+    """
+    rng = random.Random(seed)
+    labels = {canonical_name(part) for label in omim_map.values() for part in label.split(";") if part.strip()}
+    held_out = [name for name in (cached_disease_names(cache_db) if cache_db else []) if name not in labels]
+    queries = rng.sample(held_out, min(n, len(held_out)))
+    from_cache = len(queries)
+    seen = set(queries)
+    omim_labels = list(omim_map.values())
+    rng.shuffle(omim_labels)
+    for label in omim_labels:
+        if len(queries) >= n:
+            break
+        # 別のOMIMのラベルと同じ名前になった変形も使わない
+        variants = [variant for variant in label_variants(label) if variant not in seen and variant not in labels]
+        if variants:
+            variant = rng.choice(variants)
+            queries.append(variant)
+            seen.add(variant)
+    return queries, {"cache": from_cache, "variants": len(queries) - from_cache}
+
+
 def main():
     parser = argparse.ArgumentParser(description="Create FAISS index for OMIM disease labels using Azure OpenAI embeddings")
-    parser.add_argument('-j', '--json', required=True, help='Path to omim_mapping.json')
+    parser.add_argument('-j', '--json', help='Path to omim_mapping.json')
     parser.add_argument('-o', '--output', default='omim_label_index', help='Output index file path (without extension)')
     parser.add_argument('--tenant', default='dbcls', help='Azure tenant name')
     parser.add_argument('--region', default='japaneast', help='Azure region')
     parser.add_argument('--model', default='text-embedding-3-large', help='Azure OpenAI embedding model')
+    parser.add_argument('--batch-size', type=int, default=100, help='Labels per embeddings request')
+    parser.add_argument('--concurrency', type=int, default=4, help='Concurrent embeddings requests')
+    parser.add_argument('--max-rpm', type=int, default=None, help='Maximum embeddings requests per minute')
+    parser.add_argument('--max-retries', type=int, default=5, help='Retries per failed batch')
+    parser.add_argument('--checkpoint-dir', default=None, help='Directory for embedded batch checkpoints (default: <output>.ckpt)')
+    parser.add_argument('--dimensions', type=int, default=None, help='Reduced embedding dimensions (Matryoshka truncation; queries use the API dimensions parameter)')
+    parser.add_argument('--index-type', choices=INDEX_TYPES, default='flat', help='FAISS index type')
+    parser.add_argument('--storage', choices=STORAGE_TYPES, default='float32', help='Vector storage (float32, float16, 8-bit scalar quantization, product quantization)')
+    parser.add_argument('--hnsw-m', type=int, default=32, help='HNSW neighbors per node')
+    parser.add_argument('--ef-search', type=int, default=128, help='HNSW efSearch at query time')
+    parser.add_argument('--ivf-nlist', type=int, default=256, help='IVF number of clusters')
+    parser.add_argument('--nprobe', type=int, default=16, help='IVF clusters visited at query time')
+    parser.add_argument('--pq-m', type=int, default=None, help='PQ sub-quantizers (default: dimensions/16)')
+    parser.add_argument('--sidecar-only', action='store_true', help='Only convert the existing <output>.json sidecar to the binary sidecar (no embedding)')
+    parser.add_argument('--benchmark', action='store_true', help='Benchmark index options against the full-dimension flat index')
+    parser.add_argument('--benchmark-configs', default=DEFAULT_BENCHMARK_CONFIGS, help='Comma-separated index_type/storage/dimensions list to benchmark')
+    parser.add_argument('--benchmark-queries', type=int, default=500, help='Number of benchmark queries')
+    parser.add_argument('--benchmark-cache', default=os.environ.get("NORMALIZE_CACHE_DB", os.path.join(CACHE_DIR, "normalize_cache.sqlite3")),
+                        help='Normalization cache whose disease names (real LLM outputs) are used as benchmark queries')
     args = parser.parse_args()
 
+    output_base = args.output
+    if args.sidecar_only:
+        with open(f"{output_base}.json", encoding="utf-8") as f:
+            sidecar = json.load(f)
+        write_label_store(output_base, sidecar.pop("omim_ids"), sidecar.pop("labels"), meta=sidecar)
+        print(f"Binary sidecar written next to {output_base}.bin")
+        return
+    if not args.json:
+        parser.error("-j/--json is required")
+
     # Azure OpenAIの設定
     deployment_name = f"{args.region}-{args.model}"
     endpoint = f"https://{args.tenant}-{args.region}.openai.azure.com/"
@@ -45,34 +422,68 @@ def main():
 
     print(f"Loaded {len(disease_labels)} disease labels.")
 
-    # ベクトル化
-    print("Embedding disease labels with Azure OpenAI...")
-    batch_size = 100
-    embeddings = []
-    for i in range(0, len(disease_labels), batch_size):
-        batch = disease_labels[i:i+batch_size]
-        response = client.embeddings.create(
-            model=deployment_name,
-            input=batch,
-        )
-        batch_vectors = [item.embedding for item in response.data]
-        embeddings.extend(batch_vectors)
-        print(f"Embedded {i+len(batch)}/{len(disease_labels)}")
+    checkpoint = EmbeddingCheckpoint(args.checkpoint_dir or f"{output_base}.ckpt", deployment_name)
 
-    embeddings = np.array(embeddings, dtype='float32')
+    # 前回のサイドカーとの差分を確認し、変更のないラベルは保存済みのベクトルを再利用する
+    known_vectors = checkpoint.load()
+    if os.path.exists(f"{output_base}.json"):
+        with open(f"{output_base}.json", encoding="utf-8") as f:
+            previous_sidecar = json.load(f)
+        added, changed, removed = diff_labels(previous_sidecar, omim_map)
+        print(f"Diff against previous index: {len(added)} added, {len(changed)} changed, {len(removed)} removed.")
+        for label, vector in vectors_from_previous_index(f"{output_base}.bin", previous_sidecar).items():
+            known_vectors.setdefault(label, vector)
+
+    # ベクトル化（full次元で取得し、必要に応じて切り詰める）
+    to_embed = [label for label in dict.fromkeys(disease_labels) if label not in known_vectors]
+    print(f"Embedding {len(to_embed)} disease labels with Azure OpenAI ({len(disease_labels) - len(to_embed)} reused)...")
+    if to_embed:
+        new_vectors = embed_labels(
+            client, deployment_name, to_embed,
+            batch_size=args.batch_size, concurrency=args.concurrency, max_rpm=args.max_rpm,
+            max_retries=args.max_retries, checkpoint=checkpoint
+        )
+        known_vectors.update(zip(to_embed, new_vectors))
+    embeddings = np.array([known_vectors[label] for label in disease_labels], dtype='float32')
+    checkpoint.compact(disease_labels, embeddings)
     print(f"Embedding shape: {embeddings.shape}")
+    faiss.normalize_L2(embeddings)
+
+    build_kwargs = {
+        "hnsw_m": args.hnsw_m, "ivf_nlist": args.ivf_nlist, "pq_m": args.pq_m,
+        "nprobe": args.nprobe, "ef_search": args.ef_search,
+    }
+
+    if args.benchmark:
+        print("Benchmarking index options against the flat index...")
+        queries, sources = benchmark_queries(omim_map, args.benchmark_queries, cache_db=args.benchmark_cache)
+        print(f"  - {len(queries)} queries: {sources['cache']} from the normalization cache, {sources['variants']} label variants")
+        query_vectors = embed_labels(client, deployment_name, queries, concurrency=args.concurrency, max_rpm=args.max_rpm)
+        faiss.normalize_L2(query_vectors)
+        results = benchmark_indexes(embeddings, query_vectors, parse_benchmark_configs(args.benchmark_configs), build_kwargs)
+        print_benchmark(results)
+        with open(f"{output_base}.benchmark.json", "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
 
     # FAISSインデックス作成（コサイン類似度）
-    index = faiss.IndexFlatIP(embeddings.shape[1])
-    faiss.normalize_L2(embeddings)
-    index.add(embeddings)
+    dimensions = args.dimensions or embeddings.shape[1]
+    vectors = truncate_embeddings(embeddings, dimensions) if dimensions != embeddings.shape[1] else embeddings
+    index = build_index(vectors, args.index_type, args.storage, **build_kwargs)
 
-    # 保存
-    output_base = args.output
+    # 保存（読み込み側で同じ次元・検索パラメータを使えるようにサイドカーに記録）
+    meta = {
+        "model": args.model,
+        "dimensions": dimensions if dimensions != FULL_DIMENSIONS else None,
+        "index_type": args.index_type,
+        "storage": args.storage,
+        "search_params": search_params(args.index_type, args.nprobe, args.ef_search),
+    }
     faiss.write_index(index, f"{output_base}.bin")
+    # 実行時はmmap可能なバイナリサイドカーを読む。JSONは次回の差分計算用
+    write_label_store(output_base, omim_ids, disease_labels, meta=meta)
     with open(f"{output_base}.json", "w", encoding="utf-8") as f:
-        json.dump({"omim_ids": omim_ids, "labels": disease_labels}, f, ensure_ascii=False, indent=2)
+        json.dump({"omim_ids": omim_ids, "labels": disease_labels, **meta}, f, ensure_ascii=False, indent=2)
     print(f"Index and mapping saved to {output_base}.bin and {output_base}.json")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
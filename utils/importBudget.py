@@ -0,0 +1,58 @@
+#measure import/startup time of the agent package (python -X importtime) and check it against a budget.
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_STATEMENT = "import agent.agent_pipeline as p; p.RareDiseaseDiagnosisPipeline()"
+
+
+def run_importtime(statement):
+    """
+    新しいインタプリタで statement を -X importtime 付きで実行し、
+    (壁時計時間[秒], [(累積us, 自身us, モジュール名), ...]) を返す
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT_DIR + os.pathsep + env.get("PYTHONPATH", "")
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=ROOT_DIR, env=env, capture_output=True, text=True
+    )
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(f"startup statement failed:\n{proc.stderr[-2000:]}")
+    modules = []
+    for line in proc.stderr.splitlines():
+        # "import time:  self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        modules.append((int(cumulative_us), int(self_us), name.rstrip()))
+    return wall, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check startup time of the agent package against a budget")
+    parser.add_argument('--budget', type=float, default=1.0, help='Maximum allowed wall time in seconds')
+    parser.add_argument('--statement', default=DEFAULT_STATEMENT, help='Python statement to time')
+    parser.add_argument('--top', type=int, default=15, help='Number of slowest imports to show')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs to take the best wall time from')
+    args = parser.parse_args()
+
+    runs = [run_importtime(args.statement) for _ in range(max(1, args.repeat))]
+    wall, modules = min(runs, key=lambda r: r[0])
+
+    print(f"Slowest imports (cumulative) for: {args.statement}")
+    for cumulative_us, self_us, name in sorted(modules, reverse=True)[:args.top]:
+        print(f"  {cumulative_us / 1000:>9.1f} ms  {self_us / 1000:>8.1f} ms  {name}")
+    print(f"Startup wall time: {wall:.3f}s (budget {args.budget:.3f}s)")
+    if wall > args.budget:
+        print("FAIL: startup exceeds budget")
+        sys.exit(1)
+    print("OK")
+
+if __name__ == "__main__":
+    main()